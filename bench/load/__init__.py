@@ -0,0 +1,8 @@
+"""End-to-end load benchmark for the proxy.
+
+Run with python -m bench.load.  A local origin server and a CONNECT
+echo target stand in for the internet, the Proxy runs in a child
+process (so its peak RSS can be measured on its own) and a threaded
+load generator drives it.  Results are written as JSON and can be
+compared against a previous run to catch regressions.
+"""
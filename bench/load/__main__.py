@@ -0,0 +1,225 @@
+"""Sweep proxy settings under load and save the results as JSON.
+
+Every combination of --workers, --threads, --maxsize and --sizes gets
+a fresh proxy process.  Compare against a previous run with --compare.
+"""
+from __future__ import print_function
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+
+from .client import http_load, tunnel_load
+from .origin import Origin, EchoServer
+
+
+def _freeport():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+
+def _serve(kwargs, conn, quiet, workers):
+    """Run a Proxy until told to stop, then report peak RSS in KiB.
+
+    With workers > 1, the RSS is that of the largest worker.
+    """
+    import resource
+    import threading
+    from jhsiao.proxy.proxy import Proxy
+    from jhsiao.proxy.workers import Supervisor
+    if quiet:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+    if workers > 1:
+        p = Supervisor(kwargs, workers)
+        t = threading.Thread(target=p.run)
+        t.start()
+    else:
+        p = Proxy(**kwargs)
+        p.start()
+    try:
+        conn.recv()
+    finally:
+        p.stop()
+        if workers > 1:
+            t.join()
+            rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        else:
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            rss //= 1024
+        conn.send(rss)
+
+
+class ProxyProcess(object):
+    """A Proxy running in a child process."""
+    def __init__(self, quiet=True, workers=1, **kwargs):
+        kwargs.setdefault('ip', '127.0.0.1')
+        kwargs.setdefault('port', _freeport())
+        self.addr = (kwargs['ip'], kwargs['port'])
+        ctx = multiprocessing.get_context('spawn')
+        self.conn, child = ctx.Pipe()
+        self.proc = ctx.Process(
+            target=_serve, args=(kwargs, child, quiet, workers))
+        self.proc.start()
+        child.close()
+        deadline = time.time() + 10
+        while 1:
+            try:
+                socket.create_connection(self.addr, 1).close()
+                break
+            except socket.error:
+                if time.time() > deadline or not self.proc.is_alive():
+                    self.close()
+                    raise RuntimeError('proxy did not start')
+                time.sleep(0.05)
+
+    def close(self):
+        """Stop the proxy, return its peak RSS in KiB."""
+        rss = None
+        try:
+            self.conn.send(None)
+            if self.conn.poll(30):
+                rss = self.conn.recv()
+        except (EOFError, OSError):
+            pass
+        self.proc.join(5)
+        if self.proc.is_alive():
+            self.proc.terminate()
+            self.proc.join()
+        self.conn.close()
+        return rss
+
+
+def version():
+    """Return a description of the checked-out source."""
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT).decode('utf-8').strip()
+    except Exception:
+        return None
+
+
+def compare(old, new, keys=('rps', 'p50', 'p99', 'p999', 'tunnel_mbps', 'peak_rss')):
+    """Print the ratio new/old for results with matching settings."""
+    def key(result):
+        return (
+            result.get('workers', 1), result['threads'], result['maxsize'],
+            result['size'])
+    previous = dict([(key(r), r) for r in old['results']])
+    for result in new['results']:
+        prev = previous.get(key(result))
+        if prev is None:
+            continue
+        ratios = []
+        for k in keys:
+            if prev.get(k) and result.get(k) is not None:
+                ratios.append('{} {:.2f}x'.format(k, result[k] / prev[k]))
+        print(
+            'workers={} threads={} maxsize={} size={}:'.format(*key(result)),
+            ', '.join(ratios))
+
+
+def main():
+    p = argparse.ArgumentParser(prog='python -m bench.load', description=__doc__)
+    p.add_argument('-w', '--workers', type=int, nargs='+', default=[1],
+        help='proxy worker process counts to sweep')
+    p.add_argument('-t', '--threads', type=int, nargs='+', default=[1, 4, 16],
+        help='proxy handler thread counts to sweep')
+    p.add_argument('-m', '--maxsize', type=int, nargs='+', default=[0],
+        help='proxy maxsize values to sweep, 0 for unlimited')
+    p.add_argument('-s', '--sizes', type=int, nargs='+', default=[0, 1024, 1<<20],
+        help='response body sizes to sweep')
+    p.add_argument('-c', '--concurrency', type=int, default=16,
+        help='concurrent client connections')
+    p.add_argument('-d', '--duration', type=float, default=5,
+        help='seconds of http load per setting')
+    p.add_argument('--latency', type=float, default=0,
+        help='origin response delay in seconds')
+    p.add_argument('--chunked', action='store_true',
+        help='origin sends chunked responses')
+    p.add_argument('--tunnels', type=int, default=8,
+        help='concurrent CONNECT tunnels, 0 to skip')
+    p.add_argument('--tunnel-bytes', type=int, default=1<<24,
+        help='bytes echoed through each tunnel')
+    p.add_argument(
+        '--engine', choices=('threads', 'asyncio', 'loops'), default='threads')
+    p.add_argument('-o', '--output', help='json file to write results to')
+    p.add_argument('--compare', help='previous json results to compare with')
+    p.add_argument('-v', '--verbose', action='store_true',
+        help='show proxy output')
+    args = p.parse_args()
+
+    origin = Origin(latency=args.latency, chunked=args.chunked)
+    echo = EchoServer()
+    results = []
+    try:
+        settings = [
+            (workers, threads, maxsize, size)
+            for workers in args.workers for threads in args.threads
+            for maxsize in args.maxsize for size in args.sizes]
+        for workers, threads, maxsize, size in settings:
+            proxy = ProxyProcess(
+                quiet=not args.verbose, workers=workers, numthreads=threads,
+                maxsize=maxsize or None, engine=args.engine)
+            try:
+                result = http_load(
+                    proxy.addr, [origin.url(size)], args.concurrency,
+                    args.duration)
+                if args.tunnels:
+                    tunnel = tunnel_load(
+                        proxy.addr, echo.addr, args.tunnels, args.tunnel_bytes)
+                    result['tunnel_mbps'] = tunnel['mbps']
+                    result['tunnel_errors'] = tunnel['errors']
+            finally:
+                rss = proxy.close()
+            result.update(
+                workers=workers, threads=threads, maxsize=maxsize, size=size,
+                peak_rss=rss)
+            results.append(result)
+            print(
+                'workers={workers:<2} threads={threads:<3} maxsize={maxsize:<4}'
+                ' size={size:<8} {rps:9.1f} req/s p50 {p50ms:7.2f}ms'
+                ' p99 {p99ms:7.2f}ms p999 {p999ms:7.2f}ms errors {errors}'
+                ' tunnel {tunnel:8.1f}MB/s rss {peak_rss}KiB'.format(
+                    p50ms=(result['p50'] or 0)*1e3,
+                    p99ms=(result['p99'] or 0)*1e3,
+                    p999ms=(result['p999'] or 0)*1e3,
+                    tunnel=result.get('tunnel_mbps', 0), **result))
+            sys.stdout.flush()
+    finally:
+        origin.close()
+        echo.close()
+    data = dict(
+        version=version(),
+        date=datetime.datetime.now().isoformat(),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        settings=dict(
+            concurrency=args.concurrency, duration=args.duration,
+            latency=args.latency, chunked=args.chunked, tunnels=args.tunnels,
+            tunnel_bytes=args.tunnel_bytes, engine=args.engine),
+        results=results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), data)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""Concurrent load generators.
+
+Each worker thread keeps one persistent connection to the proxy and
+reconnects whenever the proxy closes it or a response cannot be
+delimited.
+"""
+from __future__ import print_function
+__all__ = ['percentile', 'http_load', 'tunnel_load']
+import math
+import socket
+import threading
+import time
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return None
+    idx = max(0, min(len(values), int(math.ceil(pct/100.0 * len(values)))) - 1)
+    return values[idx]
+
+
+class _Conn(object):
+    """A keep-alive http connection to the proxy."""
+    def __init__(self, proxyaddr, timeout):
+        self.sock = socket.create_connection(proxyaddr, timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.r = self.sock.makefile('rb')
+
+    def close(self):
+        self.r.close()
+        self.sock.close()
+
+    def _discard(self, amt):
+        read = self.r.read
+        while amt > 0:
+            chunk = read(min(amt, 0x10000))
+            if not chunk:
+                raise EOFError('truncated body')
+            amt -= len(chunk)
+
+    def request(self, url):
+        """Send a GET and read the response.
+
+        Return (status, bodysize, keepalive).
+        """
+        host = url.split('/', 3)[2]
+        self.sock.sendall(
+            'GET {} HTTP/1.1\r\nHost: {}\r\n\r\n'.format(url, host).encode('ascii'))
+        line = self.r.readline()
+        if not line:
+            raise EOFError('connection closed')
+        status = int(line.split(None, 2)[1])
+        length = None
+        chunked = False
+        keepalive = True
+        line = self.r.readline()
+        while line.strip():
+            k, _, v = line.decode('latin1').partition(':')
+            k = k.strip().lower()
+            v = v.strip()
+            if k == 'content-length':
+                length = int(v)
+            elif k == 'transfer-encoding':
+                chunked = v.lower().endswith('chunked')
+            elif k == 'connection':
+                keepalive = v.lower() != 'close'
+            line = self.r.readline()
+        if not line:
+            raise EOFError('truncated head')
+        size = 0
+        if chunked:
+            while 1:
+                line = self.r.readline()
+                if not line:
+                    raise EOFError('truncated chunk')
+                amt = int(line.split(b';', 1)[0], 16)
+                if not amt:
+                    while self.r.readline().strip():
+                        pass
+                    break
+                self._discard(amt)
+                if self.r.read(2) != b'\r\n':
+                    raise ValueError('bad chunk terminator')
+                size += amt
+        elif length is not None:
+            self._discard(length)
+            size = length
+        else:
+            # Cannot delimit the body, start over on a new connection.
+            keepalive = False
+        return status, size, keepalive
+
+
+def _httpworker(proxyaddr, urls, deadline, timeout, out):
+    latencies = []
+    statuses = {}
+    errors = 0
+    nbytes = 0
+    conn = None
+    i = 0
+    now = time.time()
+    while now < deadline:
+        url = urls[i % len(urls)]
+        i += 1
+        try:
+            if conn is None:
+                conn = _Conn(proxyaddr, timeout)
+            status, size, keepalive = conn.request(url)
+        except Exception:
+            errors += 1
+            if conn is not None:
+                conn.close()
+                conn = None
+            now = time.time()
+            continue
+        end = time.time()
+        latencies.append(end - now)
+        now = end
+        statuses[status] = statuses.get(status, 0) + 1
+        nbytes += size
+        if not keepalive:
+            conn.close()
+            conn = None
+    if conn is not None:
+        conn.close()
+    out.append((latencies, statuses, errors, nbytes))
+
+
+def http_load(proxyaddr, urls, concurrency=8, duration=5, timeout=10):
+    """GET urls round-robin through the proxy from concurrent connections.
+
+    Return dict of requests, rps, latency percentiles (seconds),
+    statuses, errors, and MB/s of response bodies.
+    """
+    out = []
+    start = time.time()
+    deadline = start + duration
+    threads = [
+        threading.Thread(
+            target=_httpworker, args=(proxyaddr, urls, deadline, timeout, out))
+        for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    latencies = []
+    statuses = {}
+    errors = 0
+    nbytes = 0
+    for lats, stats, errs, amt in out:
+        latencies.extend(lats)
+        for k, v in stats.items():
+            statuses[k] = statuses.get(k, 0) + v
+        errors += errs
+        nbytes += amt
+    latencies.sort()
+    ok = statuses.get(200, 0)
+    return dict(
+        requests=len(latencies), rps=ok / elapsed,
+        p50=percentile(latencies, 50), p99=percentile(latencies, 99),
+        p999=percentile(latencies, 99.9),
+        statuses=dict([(str(k), v) for k, v in statuses.items()]),
+        errors=errors, mbps=nbytes / elapsed / 1e6)
+
+
+def _tunnel(proxyaddr, target, total, chunk, timeout, out):
+    sock = socket.create_connection(proxyaddr, timeout)
+    try:
+        sock.sendall(
+            'CONNECT {0}:{1} HTTP/1.1\r\nHost: {0}:{1}\r\n\r\n'.format(
+                *target).encode('ascii'))
+        head = b''
+        while b'\r\n\r\n' not in head:
+            data = sock.recv(1)
+            if not data:
+                raise EOFError('closed before CONNECT response')
+            head += data
+        if head.split(None, 2)[1] != b'200':
+            raise ValueError(head.split(b'\r\n', 1)[0])
+        def writer():
+            data = memoryview(b'x' * chunk)
+            remain = total
+            try:
+                while remain > 0:
+                    sock.sendall(data[:remain])
+                    remain -= chunk
+                sock.shutdown(socket.SHUT_WR)
+            except socket.error:
+                pass
+        t = threading.Thread(target=writer)
+        t.start()
+        buf = bytearray(0x10000)
+        received = 0
+        try:
+            amt = sock.recv_into(buf)
+            while amt:
+                received += amt
+                amt = sock.recv_into(buf)
+        finally:
+            t.join()
+        out.append(received)
+    finally:
+        sock.close()
+
+
+def tunnel_load(proxyaddr, target, tunnels=8, total=1<<24, chunk=0x10000, timeout=10):
+    """Echo total bytes through each of tunnels CONNECT tunnels to target.
+
+    Return dict of MB/s (bytes echoed back) and failed tunnels.
+    """
+    out = []
+    errs = []
+    def run():
+        try:
+            _tunnel(proxyaddr, target, total, chunk, timeout, out)
+        except Exception as e:
+            errs.append(e)
+    start = time.time()
+    threads = [threading.Thread(target=run) for _ in range(tunnels)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    return dict(
+        mbps=sum(out) / elapsed / 1e6,
+        errors=len(errs) + len([amt for amt in out if amt != total]))
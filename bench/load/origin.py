@@ -0,0 +1,147 @@
+"""Local stand-ins for origin servers.
+
+Origin serves GET /<size> with a body of size bytes.  The query can
+override the server defaults: chunked=1 to send the body with chunked
+transfer-encoding and latency=<seconds> to delay the response.
+
+EchoServer echoes back everything it receives, used as a CONNECT target.
+"""
+from __future__ import print_function
+__all__ = ['Origin', 'EchoServer']
+import socket
+import threading
+import time
+try:
+    from http.server import BaseHTTPRequestHandler
+    from socketserver import ThreadingTCPServer, BaseRequestHandler
+    from urllib.parse import urlsplit, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from SocketServer import ThreadingTCPServer, BaseRequestHandler
+    from urlparse import urlsplit, parse_qs
+
+
+class _Server(ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+    def __init__(self, addr, handler, **attrs):
+        ThreadingTCPServer.__init__(self, addr, handler)
+        for k, v in attrs.items():
+            setattr(self, k, v)
+
+
+class _Background(object):
+    """Run a _Server in a daemon thread."""
+    def __init__(self, server):
+        self.server = server
+        self.addr = server.server_address[:2]
+        self.t = threading.Thread(target=server.serve_forever)
+        self.t.daemon = True
+        self.t.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.t.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _OriginHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    chunksize = 0x4000
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        try:
+            size = int(parts.path.strip('/') or 0)
+        except ValueError:
+            self.send_error(404)
+            return
+        chunked = query.get('chunked', [str(int(server.chunked))])[0] == '1'
+        latency = float(query.get('latency', [server.latency])[0])
+        if latency:
+            time.sleep(latency)
+        body = server.body(size)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Cache-Control', 'no-store')
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            view = memoryview(body)
+            step = self.chunksize
+            for i in range(0, size, step):
+                piece = view[i:i+step]
+                self.wfile.write('{:x}\r\n'.format(len(piece)).encode('ascii'))
+                self.wfile.write(piece)
+                self.wfile.write(b'\r\n')
+            self.wfile.write(b'0\r\n\r\n')
+        else:
+            self.send_header('Content-Length', str(size))
+            self.end_headers()
+            self.wfile.write(body)
+
+
+class Origin(_Background):
+    """A threaded HTTP/1.1 origin server."""
+    def __init__(self, ip='127.0.0.1', port=0, latency=0, chunked=False):
+        """Initialize.
+
+        latency: default seconds to wait before responding.
+        chunked: default to chunked responses.
+        """
+        self.bodies = {}
+        self.lock = threading.Lock()
+        super(Origin, self).__init__(_Server(
+            (ip, port), _OriginHandler, latency=latency, chunked=chunked,
+            body=self.body))
+
+    def body(self, size):
+        """Return a body of size bytes."""
+        ret = self.bodies.get(size)
+        if ret is None:
+            with self.lock:
+                ret = self.bodies.setdefault(size, b'x' * size)
+        return ret
+
+    def url(self, size, **query):
+        """Return url for a response of size bytes."""
+        ret = 'http://{}:{}/{}'.format(self.addr[0], self.addr[1], size)
+        if query:
+            ret += '?' + '&'.join(
+                ['{}={}'.format(k, v) for k, v in sorted(query.items())])
+        return ret
+
+
+class _EchoHandler(BaseRequestHandler):
+    def handle(self):
+        sock = self.request
+        buf = bytearray(0x10000)
+        view = memoryview(buf)
+        try:
+            amt = sock.recv_into(buf)
+            while amt:
+                sock.sendall(view[:amt])
+                amt = sock.recv_into(buf)
+            sock.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+
+
+class EchoServer(_Background):
+    """A threaded tcp echo server."""
+    def __init__(self, ip='127.0.0.1', port=0):
+        super(EchoServer, self).__init__(_Server((ip, port), _EchoHandler))
@@ -0,0 +1,96 @@
+"""Compare MultiForwarder throughput with and without splice/shards.
+
+Each tunnel is a pair of connected tcp sockets forwarded in one
+direction.  A writer thread per tunnel pushes data in and a reader
+thread drains the other end.
+"""
+from __future__ import print_function
+import argparse
+import socket
+import threading
+import time
+
+from jhsiao.ipc import sockets
+from jhsiao.proxy.multiforward import MultiForwarder, ShardedForwarder
+
+def _pair(listener):
+    c = socket.create_connection(listener.getsockname())
+    s, _ = listener.accept()
+    return c, s
+
+def _writer(sock, total, chunk):
+    data = memoryview(b'x' * chunk)
+    remain = total
+    while remain > 0:
+        sock.sendall(data[:remain])
+        remain -= chunk
+    sock.shutdown(socket.SHUT_WR)
+
+def _reader(sock, counts, idx):
+    buf = bytearray(0x10000)
+    total = 0
+    amt = sock.recv_into(buf)
+    while amt:
+        total += amt
+        amt = sock.recv_into(buf)
+    counts[idx] = total
+
+def run(tunnels, total, chunk, splice, shards=1, processes=False):
+    """Forward total bytes through each tunnel, return MB/s."""
+    if shards > 1 or processes:
+        forwarder = ShardedForwarder(
+            shards, processes=processes, splice=splice)
+    else:
+        forwarder = MultiForwarder(splice=splice)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('localhost', 0))
+    listener.listen(tunnels*2)
+    threads = []
+    counts = [0] * tunnels
+    socks = []
+    try:
+        for i in range(tunnels):
+            win, fin = _pair(listener)
+            fout, rout = _pair(listener)
+            socks.extend((win, rout))
+            forwarder.add(
+                sockets.Sockfile(fin, 'rb'), sockets.Sockfile(fout, 'wb'),
+                False)
+            threads.append(threading.Thread(target=_writer, args=(win, total, chunk)))
+            threads.append(threading.Thread(target=_reader, args=(rout, counts, i)))
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+    finally:
+        forwarder.close()
+        listener.close()
+        for s in socks:
+            s.close()
+    assert counts == [total] * tunnels, counts
+    return tunnels * total / elapsed / 1e6
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('-n', '--tunnels', type=int, default=4)
+    p.add_argument('-s', '--size', type=int, default=256, help='MB per tunnel')
+    p.add_argument('-c', '--chunk', type=int, default=0x10000)
+    p.add_argument(
+        '--shards', type=int, nargs='*', default=[1],
+        help='shard counts to sweep')
+    p.add_argument('--processes', action='store_true', help='process shards')
+    args = p.parse_args()
+    total = args.size * 1000000
+    for shards in args.shards:
+        for splice in (False, True):
+            desc = 'shards={} splice={}'.format(shards, splice)
+            try:
+                rate = run(
+                    args.tunnels, total, args.chunk, splice, shards,
+                    args.processes)
+            except ValueError as e:
+                print('{}: {}'.format(desc, e))
+            else:
+                print('{}: {:.1f} MB/s'.format(desc, rate))
@@ -0,0 +1,80 @@
+"""Accept-path cost of allow/block matching with many networks.
+
+Compares the previous linear scan over (nums, masks) pairs against the
+NetTrie lookup and the IPFilter (trie + LRU of recent decisions).
+"""
+from __future__ import print_function
+import argparse
+import random
+import timeit
+
+from jhsiao.proxy.nets import NetTrie
+from jhsiao.proxy.proxy import Server, IPFilter
+
+def netbits2mask(nbits, v6):
+    """Convert network prefix bitcount into a sequence of masks.
+
+    Parallel to Server.ip2nums.
+    """
+    if v6:
+        IPV6BITS = 128
+        IPV6MASK = 0xFFFFFFFFFFFFFFFF
+        if nbits > 64:
+            return (IPV6MASK, (IPV6MASK << (IPV6BITS-nbits)) & IPV6MASK)
+        else:
+            return ((IPV6MASK << (64-nbits)) & IPV6MASK, 0)
+    else:
+        IPV4BITS = 32
+        IPV4MASK = 0xFFFFFFFF
+        return ((IPV4MASK << (IPV4BITS-nbits)) & IPV4MASK,)
+
+def linear_compile(nets):
+    ret = []
+    for net, maskbits in nets:
+        nums = Server.ip2nums(net)
+        masks = netbits2mask(maskbits, ':' in net)
+        ret.append((tuple([n&m for n,m in zip(nums, masks)]), masks))
+    return ret
+
+def linear_match(ipnums, targets):
+    for target, masks in targets:
+        if len(ipnums) == len(target) and all(
+                [inum & tmask == tnum
+                for inum, tnum, tmask
+                in zip(ipnums, target, masks)]):
+            return True
+    return False
+
+def randip(rng):
+    return '.'.join([str(rng.randrange(256)) for _ in range(4)])
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('-n', '--nets', type=int, nargs='*', default=[10, 1000, 10000, 50000])
+    p.add_argument('-c', '--clients', type=int, default=1000, help='distinct client ips')
+    p.add_argument('-r', '--repeat', type=int, default=5)
+    args = p.parse_args()
+    rng = random.Random(0)
+    clients = [randip(rng) for _ in range(args.clients)]
+    for n in args.nets:
+        nets = [(randip(rng), rng.randrange(16, 33)) for _ in range(n)]
+        linear = linear_compile(nets)
+        trie = NetTrie([(Server.ip2nums(net), bits) for net, bits in nets])
+        ipfilter = IPFilter((), nets, cachesize=args.clients)
+        nums = [Server.ip2nums(ip) for ip in clients]
+        for ip, num in zip(clients, nums):
+            assert linear_match(num, linear) == trie.match(num) == (not ipfilter(ip))
+        results = [
+            ('linear', lambda: [linear_match(num, linear) for num in nums]),
+            ('trie', lambda: [trie.match(num) for num in nums]),
+            ('ip2nums+trie', lambda: [trie.match(Server.ip2nums(ip)) for ip in clients]),
+            ('ipfilter', lambda: [ipfilter(ip) for ip in clients]),
+        ]
+        for name, func in results:
+            if name == 'linear' and n * args.clients > 10**7:
+                number = 1
+            else:
+                number = 3
+            best = min(timeit.repeat(func, number=number, repeat=args.repeat)) / number
+            print('{:>6} nets {:>13}: {:9.3f} us/accept'.format(
+                n, name, best / len(clients) * 1e6))
@@ -0,0 +1,106 @@
+"""Compare request head parsing with Startline/Headers and RequestParser.
+
+The old classes are shown both on a buffered file and on an unbuffered
+raw file like the socket file handleloop used to read from, where every
+readline reads one byte at a time.
+"""
+from __future__ import print_function
+import argparse
+import io
+import timeit
+
+from jhsiao.proxy.http import Startline, Headers, RequestParser
+
+HEADS = dict(
+    curl=(
+        b'GET http://example.com/ HTTP/1.1\r\n'
+        b'Host: example.com\r\n'
+        b'User-Agent: curl/8.5.0\r\n'
+        b'Accept: */*\r\n'
+        b'Proxy-Connection: Keep-Alive\r\n\r\n'),
+    browser=(
+        b'GET http://www.example.com/articles/2024/06/some-article-title?ref=home HTTP/1.1\r\n'
+        b'Host: www.example.com\r\n'
+        b'User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:126.0) Gecko/20100101 Firefox/126.0\r\n'
+        b'Accept: text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8\r\n'
+        b'Accept-Language: en-US,en;q=0.5\r\n'
+        b'Accept-Encoding: gzip, deflate, br, zstd\r\n'
+        b'Referer: http://www.example.com/\r\n'
+        b'Connection: keep-alive\r\n'
+        b'Cookie: session=6b0f3c2e9a8d4f1b; theme=dark; _ga=GA1.2.1234567890.1700000000; _gid=GA1.2.987654321.1700000000\r\n'
+        b'Upgrade-Insecure-Requests: 1\r\n'
+        b'Sec-Fetch-Dest: document\r\n'
+        b'Sec-Fetch-Mode: navigate\r\n'
+        b'Sec-Fetch-Site: same-origin\r\n'
+        b'Sec-Fetch-User: ?1\r\n'
+        b'Priority: u=0, i\r\n'
+        b'If-None-Match: "5f3e-61b2c8a1b3f40"\r\n'
+        b'If-Modified-Since: Tue, 04 Jun 2024 10:15:00 GMT\r\n\r\n'),
+    api=(
+        b'POST http://api.example.com/v2/items HTTP/1.1\r\n'
+        b'Host: api.example.com\r\n'
+        b'Authorization: Bearer ' + b'a' * 800 + b'\r\n'
+        b'Content-Type: application/json\r\n'
+        b'Content-Length: 2\r\n'
+        b'Accept: application/json\r\n'
+        b'X-Request-Id: 0b5c9e2f-7d4a-4a53-9c1e-2f6d8b3a1e77\r\n'
+        b'X-Forwarded-For: 10.0.0.1, 10.0.0.2\r\n'
+        b'Traceparent: 00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01\r\n\r\n'
+        b'{}'),
+)
+
+class RawFile(io.RawIOBase):
+    """Unbuffered file over bytes."""
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        amt = min(len(buf), len(self.data) - self.pos)
+        buf[:amt] = self.data[self.pos:self.pos+amt]
+        self.pos += amt
+        return amt
+
+def old(f):
+    line = Startline(f)
+    headers = Headers(f)
+    return line.method, line.resource, headers.get('host')
+
+def new(f):
+    parser = RequestParser.read(f)
+    return (
+        parser.startline.method, parser.startline.resource,
+        parser.headers.get('host'))
+
+def feed(data):
+    parser = RequestParser()
+    parser.feed(data)
+    return (
+        parser.startline.method, parser.startline.resource,
+        parser.headers.get('host'))
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('-n', '--number', type=int, default=10000)
+    p.add_argument('-r', '--repeat', type=int, default=5)
+    args = p.parse_args()
+    for name, head in sorted(HEADS.items()):
+        cases = [
+            ('Startline/Headers raw', lambda: old(RawFile(head))),
+            ('Startline/Headers buffered', lambda: old(io.BufferedReader(RawFile(head)))),
+            ('RequestParser.read', lambda: new(io.BufferedReader(RawFile(head)))),
+            ('RequestParser.feed', lambda: feed(head)),
+        ]
+        expected = cases[0][1]()
+        base = None
+        for label, func in cases:
+            assert func() == expected, (label, func(), expected)
+            number = max(1, args.number // 20) if label.endswith('raw') else args.number
+            best = min(timeit.repeat(func, number=number, repeat=args.repeat)) / number
+            if base is None:
+                base = best
+            print('{:>8} ({:4d}B) {:>27}: {:8.2f} us  {:6.1f}x'.format(
+                name, len(head), label, best * 1e6, base / best))
@@ -1,4 +1,5 @@
 from jhsiao.proxy.proxy import Proxy
+from jhsiao.proxy.workers import Supervisor
 import argparse
 import sys
 import time
@@ -25,15 +26,195 @@ if __name__ == '__main__':
     p.add_argument(
         '-a', '--allow', help='sequence of ip/subnetmask to allow, eg. 1.2.3.4/24',
         nargs='*', action='append')
+    p.add_argument(
+        '--ip-cache', help='number of recent client ip allow/block decisions to cache',
+        type=int, default=1024)
     p.add_argument(
         '-m', '--max',
         help=(
             'maximum outstanding requests.  Once reached, start denying requests'
             ' with 503 Service Unavailable'), type=int, default=None)
+    p.add_argument(
+        '--ip-rate', help='requests per second allowed per client ip',
+        type=float, default=None)
+    p.add_argument(
+        '--ip-burst', help='requests an idle client ip may make at once',
+        type=float, default=None)
+    p.add_argument(
+        '--ip-max-active', help='max queued or in progress requests per client ip',
+        type=int, default=None)
+    p.add_argument(
+        '--queue-deadline',
+        help='answer 503 to requests that waited this many seconds for a handler',
+        type=float, default=None)
+    p.add_argument(
+        '--queueing', help='order to handle queued requests in',
+        choices=('fifo', 'lifo', 'codel'), default='fifo')
+    p.add_argument(
+        '--codel-target', help='max queue wait in seconds while overloaded (codel)',
+        type=float, default=0.005)
+    p.add_argument(
+        '--codel-interval',
+        help='seconds the queue must stay nonempty to count as overloaded (codel)',
+        type=float, default=0.1)
+    p.add_argument(
+        '--max-request-line', help='max length of a request line',
+        type=int, default=8192)
+    p.add_argument(
+        '--max-headers', help='max number of request headers',
+        type=int, default=100)
+    p.add_argument(
+        '--max-head-size', help='max size of a request line and headers',
+        type=int, default=0x10000)
+    p.add_argument(
+        '-w', '--workers',
+        help='number of worker processes sharing the address with SO_REUSEPORT',
+        type=int, default=1)
     p.add_argument(
         '-t', '--threads', help='number of handler threads', type=int, default=1)
+    p.add_argument(
+        '--loop-threads', help='handler threads per poll loop of the loops'
+        ' engine', type=int, default=4)
     p.add_argument(
         '--timeout', help='timeout in seconds', type=float, default=60)
+    p.add_argument(
+        '--header-timeout', help='seconds a client has to send a request head',
+        type=float, default=10)
+    p.add_argument(
+        '--idle-timeout', help='close kept-alive client connections idle this many seconds',
+        type=float, default=60)
+    p.add_argument(
+        '--request-timeout', help='abort requests taking longer than this many seconds',
+        type=float, default=None)
+    p.add_argument(
+        '--pipeline-budget',
+        help='max ready keep-alive requests a handler serves before returning the client to the poller',
+        type=int, default=16)
+    p.add_argument(
+        '--connect-timeout', help='timeout in seconds for CONNECT upstream connects',
+        type=float, default=10)
+    p.add_argument(
+        '--dns-ttl', help='seconds to cache resolved names', type=float, default=60)
+    p.add_argument(
+        '--dns-neg-ttl', help='seconds to cache failed name lookups',
+        type=float, default=5)
+    p.add_argument(
+        '--dns-size', help='max number of cached names', type=int, default=1024)
+    p.add_argument(
+        '--eyeballs-delay', help='seconds between racing connects to a name\'s addresses',
+        type=float, default=0.25)
+    p.add_argument(
+        '--pool-size', help='max persistent upstream connections per host',
+        type=int, default=10)
+    p.add_argument(
+        '--pool-hosts', help='max upstream hosts to keep connection pools for',
+        type=int, default=100)
+    p.add_argument(
+        '--pool-idle', help='close upstream connections idle for this many seconds',
+        type=float, default=30)
+    p.add_argument(
+        '--pool-lifetime', help='close upstream connections older than this many seconds',
+        type=float, default=300)
+    p.add_argument(
+        '--shards', help='number of tunnel forwarding loops', type=int, default=1)
+    p.add_argument(
+        '--shard-placement', help='how to choose a shard for new tunnels',
+        choices=('least', 'hash'), default='least')
+    p.add_argument(
+        '--shard-processes', help='run forwarding loops in separate processes',
+        action='store_true')
+    p.add_argument(
+        '--tunnel-budget',
+        help='max bytes buffered by all tunnels, reads pause while it is used up',
+        type=int)
+    p.add_argument(
+        '--tunnel-slab', help='size of the buffers tunnels take from the budget',
+        type=int, default=0x4000)
+    p.add_argument(
+        '--cache-mem', help='bytes of GET responses to cache in memory',
+        type=int, default=0)
+    p.add_argument(
+        '--cache-object', help='max size of a response cached in memory',
+        type=int, default=1<<20)
+    p.add_argument(
+        '--cache-dir', help='directory to cache GET responses in')
+    p.add_argument(
+        '--cache-disk', help='bytes of GET responses to cache in --cache-dir',
+        type=int, default=1<<30)
+    p.add_argument(
+        '--gzip', help='gzip text responses for clients that accept it',
+        action='store_true')
+    p.add_argument(
+        '--gzip-level', help='gzip compression level', type=int, default=6)
+    p.add_argument(
+        '--gzip-min-size', help='do not gzip responses smaller than this',
+        type=int, default=1024)
+    p.add_argument(
+        '--gzip-cached-max', help='largest cached response to gzip when'
+        ' it is served', type=int, default=8<<20)
+    p.add_argument(
+        '--gzip-cpu', help='fraction of a cpu to spend gzipping, default no limit',
+        type=float)
+    p.add_argument(
+        '--collapse', help='send GETs for a url being fetched the response'
+        ' as it arrives instead of fetching it again', action='store_true')
+    p.add_argument(
+        '--collapse-buffer',
+        help='bytes of a response after which no more GETs can follow it,'
+        ' and bytes a following GET can fall behind before it is dropped',
+        type=int, default=1<<20)
+    p.add_argument(
+        '--trace', help='number of latest request spans to keep, dumped as'
+        ' Chrome trace json on SIGUSR1', type=int, default=0)
+    p.add_argument(
+        '--profile-seconds', help='how long to profile on SIGUSR2',
+        type=float, default=10)
+    p.add_argument(
+        '--profile-max', help='longest profile /debug/profile can ask for,'
+        ' default 6 times --profile-seconds', type=float)
+    p.add_argument(
+        '--profile-dir', help='directory for profiles and traces,'
+        ' default the temp directory')
+    p.add_argument(
+        '--debug-endpoints', help='serve /debug/trace and /debug/profile'
+        ' to loopback clients', action='store_true')
+    p.add_argument(
+        '--debug-allow', help='sequence of ip/subnetmask besides loopback'
+        ' allowed to use the debug endpoints', nargs='*')
+    p.add_argument(
+        '--access-log', help='file for the access log, default stdout')
+    p.add_argument(
+        '--access-log-format', help='access log line format',
+        choices=('text', 'json'), default='text')
+    p.add_argument(
+        '--access-log-sample', help='fraction of requests to log',
+        type=float, default=1)
+    p.add_argument(
+        '--access-log-max-bytes', help='rotate the access log at this size, 0 to never',
+        type=int, default=0)
+    p.add_argument(
+        '--access-log-backups', help='number of rotated access logs to keep',
+        type=int, default=5)
+    p.add_argument(
+        '--parent', dest='parents', action='append', default=[],
+        help='parent proxy host:port[=weight] to go through instead of direct,'
+        ' repeat for more parents')
+    p.add_argument(
+        '--parent-vnodes', help='hash ring points per unit of parent weight',
+        type=int, default=100)
+    p.add_argument(
+        '--parent-max-fails', help='consecutive failures to mark a parent down',
+        type=int, default=3)
+    p.add_argument(
+        '--parent-check', help='seconds between parent health checks, > 0',
+        type=float, default=5)
+    p.add_argument(
+        '--engine', help='request handling engine, asyncio ignores the'
+        ' thread, shard, tunnel budget, queueing, pool host/idle/lifetime,'
+        ' header/idle/request timeout and pipeline budget options, writes no'
+        ' access log records and cannot be used with the cache, gzip,'
+        ' collapse, trace or --access-log options',
+        choices=('threads', 'asyncio', 'loops'), default='threads')
     args = p.parse_args()
     idx = args.bindaddr.find(':')
     if idx < 0:
@@ -48,11 +229,75 @@ if __name__ == '__main__':
         kwargs['allowed'] = list(map(mask2pair, args.allow))
     if args.block:
         kwargs['blocked'] = list(map(mask2pair, args.block))
+    kwargs['ipcachesize'] = args.ip_cache
     kwargs['maxsize'] = args.max
+    kwargs['iprate'] = args.ip_rate
+    kwargs['ipburst'] = args.ip_burst
+    kwargs['ipmaxactive'] = args.ip_max_active
+    kwargs['queuedeadline'] = args.queue_deadline
+    kwargs['queueing'] = args.queueing
+    kwargs['codeltarget'] = args.codel_target
+    kwargs['codelinterval'] = args.codel_interval
+    kwargs['maxrequestline'] = args.max_request_line
+    kwargs['maxheaders'] = args.max_headers
+    kwargs['maxheadsize'] = args.max_head_size
     kwargs['numthreads'] = args.threads
+    kwargs['loopthreads'] = args.loop_threads
     kwargs['timeout'] = args.timeout
+    kwargs['headertimeout'] = args.header_timeout
+    kwargs['idletimeout'] = args.idle_timeout
+    kwargs['requesttimeout'] = args.request_timeout
+    kwargs['pipelinebudget'] = args.pipeline_budget
+    kwargs['connecttimeout'] = args.connect_timeout
+    kwargs['dnsttl'] = args.dns_ttl
+    kwargs['dnsnegttl'] = args.dns_neg_ttl
+    kwargs['dnssize'] = args.dns_size
+    kwargs['eyeballsdelay'] = args.eyeballs_delay
+    kwargs['poolsize'] = args.pool_size
+    kwargs['poolhosts'] = args.pool_hosts
+    kwargs['poolidle'] = args.pool_idle
+    kwargs['poollifetime'] = args.pool_lifetime
+    kwargs['shards'] = args.shards
+    kwargs['shardplacement'] = args.shard_placement
+    kwargs['shardprocesses'] = args.shard_processes
+    kwargs['tunnelbudget'] = args.tunnel_budget
+    kwargs['tunnelslab'] = args.tunnel_slab
+    kwargs['engine'] = args.engine
+    kwargs['accesslog'] = args.access_log
+    kwargs['accesslogformat'] = args.access_log_format
+    kwargs['accesslogsample'] = args.access_log_sample
+    kwargs['accesslogmaxbytes'] = args.access_log_max_bytes
+    kwargs['accesslogbackups'] = args.access_log_backups
+    kwargs['parents'] = args.parents
+    kwargs['parentvnodes'] = args.parent_vnodes
+    kwargs['parentmaxfails'] = args.parent_max_fails
+    kwargs['parentcheck'] = args.parent_check
+    kwargs['cachemem'] = args.cache_mem
+    kwargs['cacheobject'] = args.cache_object
+    kwargs['cachedir'] = args.cache_dir
+    kwargs['cachedisk'] = args.cache_disk
+    kwargs['gzip'] = args.gzip
+    kwargs['gziplevel'] = args.gzip_level
+    kwargs['gzipmin'] = args.gzip_min_size
+    kwargs['gzipcpu'] = args.gzip_cpu
+    kwargs['gzipcached'] = args.gzip_cached_max
+    kwargs['collapse'] = args.collapse
+    kwargs['collapsebuffer'] = args.collapse_buffer
+    kwargs['trace'] = args.trace
+    kwargs['profileseconds'] = args.profile_seconds
+    kwargs['profiledir'] = args.profile_dir
+    kwargs['profilemax'] = args.profile_max
+    kwargs['debugendpoints'] = args.debug_endpoints
+    if args.debug_allow:
+        kwargs['debugallowed'] = list(map(mask2pair, args.debug_allow))
+    if args.workers > 1:
+        if not port:
+            raise SystemExit('--workers needs an explicit port')
+        Supervisor(kwargs, args.workers).run()
+        sys.exit(0)
     p = Proxy(**kwargs)
     p.start()
+    p.handlesignals()
     # run() does not respond to keyboard interrupt
     # neither does thread.join()
     try:
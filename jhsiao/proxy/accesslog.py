@@ -0,0 +1,162 @@
+"""Access log written in batches by a background thread.
+
+Request handling only appends a tuple to a deque (atomic, no lock).
+The writer thread formats queued records and writes them with one
+write() per batch.
+"""
+from __future__ import print_function
+__all__ = ['AccessLog']
+from collections import deque
+import datetime
+import json
+import os
+import random
+import sys
+import threading
+import time
+import traceback
+
+FIELDS = ('time', 'client', 'method', 'url', 'status', 'bytes', 'upstream', 'total')
+
+def timestamp(t):
+    """Format epoch seconds like Proxy.log."""
+    now = datetime.datetime.fromtimestamp(t)
+    return now.strftime('%Y-%m-%d %H:%M:%S.{:02d}'.format(now.microsecond//10000))
+
+def _seconds(value):
+    return '-' if value is None else '{:.6f}'.format(value)
+
+class AccessLog(object):
+    """Structured access log and diagnostic messages.
+
+    record() queues a request's fields, message() queues a free-form
+    line.  Both return immediately.  Until start() and after close(),
+    lines are written directly.
+    """
+    def __init__(
+            self, path=None, fmt='text', sample=1, maxbytes=0, backups=5,
+            interval=0.2):
+        """Initialize.
+
+        path: file to append to, None for stdout.
+        fmt: 'text' for space separated fields or 'json' for json lines.
+            Messages are always text.
+        sample: fraction of requests to record.
+        maxbytes: rotate path once it exceeds this size, 0 to never.
+        backups: number of rotated files to keep as path.1, path.2...
+        interval: seconds between batches.
+        """
+        if fmt not in ('text', 'json'):
+            raise ValueError('Unknown access log format {!r}'.format(fmt))
+        self.path = path
+        self.fmt = fmt
+        self.sample = sample
+        self.maxbytes = maxbytes
+        self.backups = backups
+        self.interval = interval
+        self.q = deque()
+        self.f = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.t = None
+
+    def record(self, client, method, url, status, nbytes, upstream, total):
+        """Record a request.
+
+        upstream: seconds until the upstream response head, or None.
+        total: seconds spent on the request.
+        """
+        if self.sample < 1 and random.random() >= self.sample:
+            return
+        self.q.append(
+            (time.time(), client, method, url, status, nbytes, upstream, total))
+        if self.t is None:
+            self.flush()
+
+    def message(self, *args):
+        """Log a diagnostic line, args are joined like print()."""
+        self.q.append((time.time(), args))
+        if self.t is None:
+            self.flush()
+
+    def format(self, item):
+        if len(item) == 2:
+            t, args = item
+            return '{}: {}\n'.format(timestamp(t), ' '.join(map(str, args)))
+        if self.fmt == 'json':
+            return json.dumps(dict(zip(FIELDS, item)), sort_keys=True) + '\n'
+        t, client, method, url, status, nbytes, upstream, total = item
+        return '{}: {} {} {} {} {} {} {}\n'.format(
+            timestamp(t), client, method, url,
+            '-' if status is None else status, nbytes,
+            _seconds(upstream), _seconds(total))
+
+    def _open(self):
+        if self.f is None:
+            if self.path is None:
+                self.f = sys.stdout
+            else:
+                self.f = open(self.path, 'a')
+        return self.f
+
+    def _rotate(self):
+        self.f.close()
+        self.f = None
+        path = self.path
+        for idx in range(self.backups - 1, 0, -1):
+            src = '{}.{}'.format(path, idx)
+            if os.path.exists(src):
+                os.replace(src, '{}.{}'.format(path, idx + 1))
+        if self.backups:
+            os.replace(path, path + '.1')
+        else:
+            os.remove(path)
+
+    def flush(self):
+        """Write everything queued so far."""
+        q = self.q
+        lines = []
+        with self.lock:
+            try:
+                while 1:
+                    lines.append(self.format(q.popleft()))
+            except IndexError:
+                pass
+            if not lines:
+                return
+            f = self._open()
+            f.write(''.join(lines))
+            f.flush()
+            if (
+                    self.maxbytes and self.path is not None
+                    and f.tell() >= self.maxbytes):
+                self._rotate()
+
+    def _loop(self):
+        stopped = self.stopped
+        while not stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                traceback.print_exc()
+
+    def start(self):
+        """Start writing in a background thread."""
+        if self.t is None:
+            self.stopped.clear()
+            self.t = threading.Thread(target=self._loop)
+            self.t.daemon = True
+            self.t.start()
+
+    def close(self):
+        """Stop the background thread and write what is left."""
+        t = self.t
+        if t is not None:
+            self.stopped.set()
+            t.join()
+            self.t = None
+        self.flush()
+        with self.lock:
+            if self.f is not None and self.path is not None:
+                self.f.close()
+            self.f = None
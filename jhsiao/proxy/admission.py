@@ -0,0 +1,174 @@
+"""Admission control and queueing policy.
+
+Admission limits each client ip with a token bucket and a cap on
+requests in progress.  QueuePolicy decides which queued request to
+handle next and when a request has waited too long to be worth
+handling.
+"""
+__all__ = ['Admission', 'LockedAdmission', 'QueuePolicy']
+from collections import OrderedDict
+import threading
+
+_TOKENS = 0
+_LAST = 1
+_ACTIVE = 2
+
+class Admission(object):
+    """Per client ip rate limits and concurrency caps.
+
+    Not thread-safe, LockedAdmission is for several poll threads.
+    """
+    def __init__(self, rate=None, burst=None, maxactive=None, maxips=4096):
+        """Initialize.
+
+        rate: requests per second allowed per ip, None for no limit.
+        burst: requests an idle ip may make at once, defaults to
+            max(1, rate).
+        maxactive: max queued or in progress requests per ip, None for
+            no limit.
+        maxips: number of ips to remember.  Ips with requests in
+            progress are never forgotten.
+        """
+        self.rate = rate
+        if burst is None and rate is not None:
+            burst = max(1, rate)
+        self.burst = burst
+        self.maxactive = maxactive
+        self.maxips = maxips
+        self.ips = OrderedDict()
+
+    def __bool__(self):
+        return self.rate is not None or self.maxactive is not None
+    __nonzero__ = __bool__
+
+    def admit(self, ip, now):
+        """Try to start a request from ip.
+
+        Return None if admitted, otherwise 'rate' or 'concurrency'.
+        Admitted requests must be release()d when done.
+        """
+        if not self:
+            return None
+        ips = self.ips
+        state = ips.get(ip)
+        if state is None:
+            if len(ips) >= self.maxips:
+                self._evict(len(ips) - self.maxips + 1)
+            state = ips[ip] = [self.burst, now, 0]
+        else:
+            ips.move_to_end(ip)
+        if self.maxactive is not None and state[_ACTIVE] >= self.maxactive:
+            return 'concurrency'
+        if self.rate is not None:
+            tokens = min(
+                self.burst, state[_TOKENS] + (now - state[_LAST]) * self.rate)
+            state[_LAST] = now
+            if tokens < 1:
+                state[_TOKENS] = tokens
+                return 'rate'
+            state[_TOKENS] = tokens - 1
+        state[_ACTIVE] += 1
+        return None
+
+    def release(self, ip):
+        """A request admitted for ip is done."""
+        state = self.ips.get(ip)
+        if state is not None and state[_ACTIVE]:
+            state[_ACTIVE] -= 1
+
+    def active(self, ip):
+        """Return the number of requests in progress for ip."""
+        state = self.ips.get(ip)
+        return state[_ACTIVE] if state is not None else 0
+
+    def _evict(self, excess):
+        """Forget up to excess idle ips, least recently seen first."""
+        ips = self.ips
+        for ip in list(ips):
+            if excess <= 0:
+                break
+            if not ips[ip][_ACTIVE]:
+                del ips[ip]
+                excess -= 1
+
+
+class LockedAdmission(Admission):
+    """Admission shared by several poll threads."""
+    def __init__(self, *args, **kwargs):
+        super(LockedAdmission, self).__init__(*args, **kwargs)
+        self.lock = threading.Lock()
+
+    def admit(self, ip, now):
+        with self.lock:
+            return super(LockedAdmission, self).admit(ip, now)
+
+    def release(self, ip):
+        with self.lock:
+            super(LockedAdmission, self).release(ip)
+
+    def active(self, ip):
+        with self.lock:
+            return super(LockedAdmission, self).active(ip)
+
+
+class QueuePolicy(object):
+    """Choose queued requests to handle or shed.
+
+    mode:
+        'fifo': oldest first.
+        'lifo': newest first so the requests handled are the ones
+            whose clients are most likely still waiting.
+        'codel': oldest first until the queue has not been empty for
+            interval seconds, then newest first and requests that
+            waited longer than target are shed.  Otherwise requests
+            that waited longer than interval are shed.
+    deadline: requests that waited longer than this many seconds are
+        always shed, None for no limit.
+
+    Methods must be called with the queue's lock held.
+    """
+    modes = ('fifo', 'lifo', 'codel')
+    def __init__(self, mode='fifo', deadline=None, target=0.005, interval=0.1):
+        if mode not in self.modes:
+            raise ValueError('Unknown queueing {!r}'.format(mode))
+        self.mode = mode
+        self.deadline = float('inf') if deadline is None else deadline
+        self.target = target
+        self.interval = interval
+        self.lastempty = None
+
+    def emptied(self, now):
+        """Note that the queue was empty at now."""
+        self.lastempty = now
+
+    def overloaded(self, now):
+        """Return whether the queue has been standing too long."""
+        return (
+            self.mode == 'codel' and self.lastempty is not None
+            and now - self.lastempty > self.interval)
+
+    def limit(self, now):
+        """Return the max seconds a request may wait at now."""
+        if self.mode != 'codel':
+            return self.deadline
+        elif self.overloaded(now):
+            return min(self.deadline, self.target)
+        else:
+            return min(self.deadline, self.interval)
+
+    def take(self, q, now):
+        """Pop the next item from non-empty deque q.
+
+        Items have a .queued time.  Return (item, shed).  Expired items
+        at the front are returned first to be shed.
+        """
+        limit = self.limit(now)
+        if now - q[0].queued > limit:
+            item = q.popleft()
+        elif self.mode == 'lifo' or self.overloaded(now):
+            item = q.pop()
+        else:
+            item = q.popleft()
+        if not q:
+            self.lastempty = now
+        return item, now - item.queued > limit
@@ -0,0 +1,524 @@
+"""asyncio proxy engine.
+
+Client parsing, upstream requests, CONNECT setup and tunnel relaying are
+coroutines on a single event loop so the number of in-flight requests is
+not capped by the number of handler threads.  Message bodies are relayed
+with their original framing (content-length or chunked).
+"""
+from __future__ import print_function
+__all__ = ['AsyncEngine']
+import asyncio
+import io
+import socket
+import ssl
+import time
+import traceback
+from urllib.parse import urlsplit
+
+from .http import Headers, HTTPError, RequestParser
+from .parents import connectrequest, parsestatus
+from .proxy import IPFilter, SERVICE_UNAVAILABLE, TOO_MANY_REQUESTS
+
+BUFSIZE = 0x10000
+HOP_HEADERS = frozenset([
+    'connection', 'proxy-connection', 'keep-alive', 'te', 'trailer',
+    'upgrade', 'proxy-authorization', 'proxy-authenticate', 'host'])
+
+def _peername(writer):
+    peer = writer.get_extra_info('peername')
+    if isinstance(peer, tuple):
+        return '{}:{}'.format(*peer[:2])
+    return str(peer)
+
+def _bodylength(headers):
+    """Return content length, None if chunked, 0 if no body."""
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        return None
+    dlen = headers.get('content-length')
+    if dlen is None:
+        return 0
+    try:
+        return int(dlen.split(',')[0])
+    except ValueError:
+        raise HTTPError(400, 'Bad Request')
+
+class _Refused(Exception):
+    """A parent proxy answered a CONNECT with args (code, reason)."""
+
+class AsyncEngine(object):
+    """Serve a Proxy's configuration with asyncio."""
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.filter = IPFilter(proxy.allowed, proxy.blocked, proxy.ipcachesize)
+        self.timeout = proxy.timeout
+        self.maxsize = proxy.maxsize
+        self.maxidle = proxy.poolargs['maxperhost']
+        self.inflight = 0
+        self.idle = {}
+        self.tasks = set()
+        self.loop = None
+        self._stop = None
+        self._ssl = None
+
+    def run(self):
+        """Run the event loop until stop()."""
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._stop = asyncio.Event()
+        self.loop = loop
+        try:
+            loop.run_until_complete(self._main())
+        finally:
+            self.loop = None
+            loop.close()
+
+    def stop(self):
+        """Stop the event loop, can be called from other threads."""
+        loop = self.loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._stop.set)
+
+    def wake(self):
+        """Run the proxy's signalled work on the event loop."""
+        loop = self.loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self.proxy.runsignalled)
+
+    async def _main(self):
+        proxy = self.proxy
+        server = await asyncio.start_server(
+            self._serve, proxy.addr[0], proxy.addr[1], reuse_address=True,
+            reuse_port=proxy.reuseport or None)
+        proxy.bound(server.sockets[0])
+        try:
+            if proxy.running:
+                await self._stop.wait()
+        finally:
+            server.close()
+            tasks = list(self.tasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await server.wait_closed()
+            for conns in self.idle.values():
+                for reader, writer in conns:
+                    writer.close()
+            self.idle.clear()
+
+    async def _read(self, coro):
+        return await asyncio.wait_for(coro, self.timeout)
+
+    async def _serve(self, reader, writer):
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        peer = _peername(writer)
+        metrics = self.proxy.metrics
+        admission = self.proxy.admission
+        metrics.connections.inc()
+        try:
+            ip = writer.get_extra_info('peername')[0].split('%', 1)[0]
+            if not self.filter(ip):
+                self.proxy.log('blocked ip', ip)
+                metrics.blocked.inc()
+                writer.write(b'HTTP/1.1 403 Forbidden\r\n\r\n')
+                await writer.drain()
+                return
+            keep = True
+            while keep:
+                parser = RequestParser(**self.proxy.headlimits)
+                while not parser.done:
+                    try:
+                        head = await self._read(reader.readuntil(b'\r\n\r\n'))
+                    except asyncio.IncompleteReadError:
+                        return
+                    except asyncio.LimitOverrunError:
+                        raise HTTPError(431, 'Request Header Fields Too Large')
+                    parser.feed(head)
+                startline = parser.startline
+                headers = parser.headers
+                method = startline.method.upper()
+                self.proxy.log(peer, method, startline.resource)
+                if method == 'GET':
+                    response = self.proxy.localresponse(
+                        startline, writer.get_extra_info('sockname'), ip)
+                    if response is not None:
+                        writer.write(response)
+                        await writer.drain()
+                        continue
+                if self.inflight >= self.maxsize:
+                    metrics.rejected.labels('full').inc()
+                    writer.write(SERVICE_UNAVAILABLE)
+                    await writer.drain()
+                    return
+                reason = admission.admit(ip, time.time())
+                if reason is not None:
+                    metrics.rejected.labels(reason).inc()
+                    writer.write(TOO_MANY_REQUESTS)
+                    await writer.drain()
+                    return
+                func = getattr(self, 'do_'+method, None)
+                if func is None:
+                    metrics.requests.labels('other').inc()
+                    func = self.default
+                else:
+                    metrics.requests.labels(method).inc()
+                self.inflight += 1
+                try:
+                    keep = await func(reader, writer, startline, headers)
+                finally:
+                    self.inflight -= 1
+                    admission.release(ip)
+                await writer.drain()
+        except HTTPError as e:
+            self.proxy.log(peer, e.code, ':', e.args[0])
+            if e.code > 0:
+                writer.write('HTTP/1.1 {} {}\r\n\r\n'.format(
+                    e.code, e.args[0]).encode('utf-8'))
+        except (asyncio.TimeoutError, asyncio.CancelledError, ConnectionError):
+            pass
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self.tasks.discard(task)
+            writer.close()
+
+    async def default(self, reader, writer, startline, headers):
+        self.proxy.log(_peername(writer), startline.method, 'unsupported')
+        writer.write(b'HTTP/1.1 501 Not Implemented\r\n\r\n')
+        return True
+
+    async def _pipe(self, src, dst):
+        """Copy src to dst until eof, then half-close dst."""
+        try:
+            data = await src.read(BUFSIZE)
+            while data:
+                dst.write(data)
+                await dst.drain()
+                data = await src.read(BUFSIZE)
+            if dst.can_write_eof():
+                dst.write_eof()
+        except Exception:
+            dst.close()
+
+    async def _race(self, host, port):
+        """Return a socket connected by racing host's addresses."""
+        loop = asyncio.get_running_loop()
+        resolver = self.proxy.resolver
+        addrs = resolver.cached(host, port)
+        if addrs is None:
+            addrs = await loop.run_in_executor(
+                None, resolver.resolve, host, port)
+        addrs.reverse()
+
+        async def attempt(info):
+            family, socktype, proto, _, addr = info
+            sock = socket.socket(family, socktype, proto)
+            sock.setblocking(False)
+            try:
+                await loop.sock_connect(sock, addr)
+            except BaseException:
+                sock.close()
+                raise
+            return sock, addr
+
+        pending = set()
+        err = None
+        try:
+            while addrs or pending:
+                if addrs:
+                    pending.add(asyncio.ensure_future(attempt(addrs.pop())))
+                done, pending = await asyncio.wait(
+                    pending, timeout=resolver.delay if addrs else None,
+                    return_when=asyncio.FIRST_COMPLETED)
+                winner = None
+                for task in done:
+                    if task.exception() is not None:
+                        err = task.exception()
+                    elif winner is None:
+                        winner = task.result()
+                    else:
+                        task.result()[0].close()
+                if winner is not None:
+                    resolver.prefer(host, port, winner[1])
+                    return winner[0]
+        finally:
+            for task in pending:
+                task.cancel()
+        raise err
+
+    async def _connect(self, host, port, timeout, ctx=None):
+        """Return (reader, writer) connected to host:port."""
+        sock = await asyncio.wait_for(self._race(host, port), timeout)
+        return await asyncio.wait_for(asyncio.open_connection(
+            sock=sock, ssl=ctx, server_hostname=host if ctx else None),
+            timeout)
+
+    async def _connectparent(self, parent, host, port):
+        """Return (reader, writer) tunneled to host:port by parent.
+
+        Raise _Refused if the parent did not reply 2xx.
+        """
+        rreader, rwriter = await self._connect(
+            parent.host, parent.port, self.proxy.connecttimeout)
+        try:
+            rwriter.write(connectrequest(host, port))
+            head = await asyncio.wait_for(
+                rreader.readuntil(b'\r\n\r\n'), self.proxy.connecttimeout)
+            code, reason = parsestatus(head)
+        except Exception:
+            rwriter.close()
+            raise
+        if not 200 <= code < 300:
+            rwriter.close()
+            raise _Refused(code, reason)
+        return rreader, rwriter
+
+    async def do_CONNECT(self, reader, writer, startline, headers):
+        host, port = startline.resource.rsplit(':', 1)
+        host = host.strip('[]')
+        proxy = self.proxy
+        parent = proxy.parent('{}:{}'.format(host, port))
+        try:
+            if parent is None:
+                rreader, rwriter = await self._connect(
+                    host, int(port), proxy.connecttimeout)
+            else:
+                rreader, rwriter = await self._connectparent(
+                    parent, host, int(port))
+                proxy.parents.succeeded(parent)
+        except _Refused as e:
+            proxy.parents.succeeded(parent)
+            code, reason = e.args
+            proxy.log('Parent {} refused {}: {} {}'.format(
+                parent, startline.resource, code, reason))
+            writer.write((
+                'HTTP/1.1 {} {}\r\nContent-Length: 0\r\n'
+                'Connection: close\r\n\r\n').format(code, reason).encode('utf-8'))
+            return False
+        except Exception:
+            status = '404 Not Found'
+            if parent is None:
+                proxy.log('Failed to connect to {}:{}'.format(host, port))
+            else:
+                proxy.parents.failed(parent)
+                proxy.log('Failed to connect to {}:{} through {}'.format(
+                    host, port, parent))
+                status = '502 Bad Gateway'
+            msg = traceback.format_exc().encode('utf-8')
+            writer.write((
+                'HTTP/1.1 ' + status + '\r\n'
+                'Content-Type: text\r\n'
+                'Content-length: {}\r\n\r\n').format(len(msg)).encode('utf-8'))
+            writer.write(msg)
+            return False
+        writer.write(b'HTTP/1.1 200 OK\r\n\r\n')
+        try:
+            await writer.drain()
+            await asyncio.gather(
+                self._pipe(reader, rwriter), self._pipe(rreader, writer))
+        finally:
+            rwriter.close()
+        return False
+
+    async def _copyn(self, src, dst, amt):
+        while amt:
+            data = await self._read(src.read(min(amt, BUFSIZE)))
+            if not data:
+                raise asyncio.IncompleteReadError(b'', amt)
+            dst.write(data)
+            await dst.drain()
+            amt -= len(data)
+
+    async def _copychunked(self, src, dst):
+        """Copy a chunked body verbatim."""
+        while 1:
+            line = await self._read(src.readuntil(b'\n'))
+            dst.write(line)
+            try:
+                size = int(line.split(b';', 1)[0].strip(), 16)
+            except ValueError:
+                raise HTTPError(-4, 'Bad chunk size {!r}'.format(line))
+            if not size:
+                while line not in (b'\r\n', b'\n'):
+                    line = await self._read(src.readuntil(b'\n'))
+                    dst.write(line)
+                await dst.drain()
+                return
+            await self._copyn(src, dst, size+2)
+
+    async def _copybody(self, src, dst, length):
+        if length is None:
+            await self._copychunked(src, dst)
+        elif length:
+            await self._copyn(src, dst, length)
+
+    async def _sendbody(self, src, dst, length):
+        await self._copybody(src, dst, length)
+        await dst.drain()
+
+    async def _exchange(self, reader, writer, ureader, uwriter, length):
+        """Send the request body upstream while reading the response head.
+
+        Interim responses such as 100 Continue are relayed as they come
+        so a client that waits for one before sending its body (Expect:
+        100-continue) is not stalled.  Return (head, sent), sent is
+        False if the final response came before the whole body was sent.
+        """
+        send = asyncio.ensure_future(self._sendbody(reader, uwriter, length))
+        head = None
+        try:
+            while 1:
+                head = asyncio.ensure_future(ureader.readuntil(b'\r\n\r\n'))
+                if not send.done():
+                    await asyncio.wait(
+                        (send, head), return_when=asyncio.FIRST_COMPLETED)
+                if head.done():
+                    resphead = head.result()
+                else:
+                    send.result()
+                    resphead = await self._read(head)
+                if resphead[9:10] != b'1' or resphead[9:12] == b'101':
+                    return resphead, send.done() and not send.exception()
+                writer.write(resphead)
+                await writer.drain()
+        finally:
+            send.cancel()
+            if head is not None:
+                head.cancel()
+
+    async def _dial(self, key):
+        """Return (reader, writer, reused) for upstream key."""
+        conns = self.idle.get(key)
+        while conns:
+            reader, writer = conns.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        scheme, host, port = key
+        ctx = None
+        if scheme == 'parent':
+            reader, writer = await self._connect(
+                host, port, self.proxy.connecttimeout)
+            return reader, writer, False
+        if scheme == 'https':
+            if self._ssl is None:
+                self._ssl = ssl.create_default_context()
+            ctx = self._ssl
+        reader, writer = await self._connect(host, port, self.timeout, ctx)
+        return reader, writer, False
+
+    def _release(self, key, reader, writer):
+        conns = self.idle.setdefault(key, [])
+        if len(conns) < self.maxidle:
+            conns.append((reader, writer))
+        else:
+            writer.close()
+
+    async def _basic(self, reader, writer, startline, headers):
+        # Forward the path and query as the client quoted them.
+        url = urlsplit(startline.rawresource)
+        scheme = url.scheme.lower()
+        if scheme not in ('http', 'https') or not url.hostname:
+            raise HTTPError(400, 'Bad Request')
+        port = url.port or (443 if scheme == 'https' else 80)
+        key = (scheme, url.hostname, port)
+        path = url.path or '/'
+        if url.query:
+            path += '?' + url.query
+        hostheader = url.hostname
+        if ':' in hostheader:
+            hostheader = '[{}]'.format(hostheader)
+        if url.port is not None:
+            hostheader = '{}:{}'.format(hostheader, url.port)
+        parent = None
+        if scheme == 'http':
+            # https would need TLS over a tunnel through the parent.
+            parent = self.proxy.parent('{}:{}'.format(url.hostname, port))
+        if parent is not None:
+            key = ('parent', parent.host, parent.port)
+            path = 'http://{}{}'.format(hostheader, path)
+        lines = [
+            '{} {} HTTP/1.1'.format(startline.method.upper(), path),
+            'Host: {}'.format(hostheader)]
+        for k, v in headers.items():
+            if k not in HOP_HEADERS:
+                lines.append('{}: {}'.format(k, v))
+        lines.append('\r\n')
+        reqhead = '\r\n'.join(lines).encode('utf-8')
+        reqlength = _bodylength(headers)
+
+        for attempt in range(2):
+            try:
+                ureader, uwriter, reused = await self._dial(key)
+            except Exception:
+                if parent is not None:
+                    self.proxy.parents.failed(parent)
+                return self._error(writer)
+            try:
+                uwriter.write(reqhead)
+                resphead, sent = await self._exchange(
+                    reader, writer, ureader, uwriter, reqlength)
+                break
+            except (asyncio.IncompleteReadError, ConnectionError):
+                uwriter.close()
+                if not reused or reqlength != 0:
+                    return self._error(writer)
+            except Exception:
+                uwriter.close()
+                return self._error(writer)
+        else:
+            raise HTTPError(502, 'Bad Gateway')
+        if parent is not None:
+            self.proxy.parents.succeeded(parent)
+        f = io.BytesIO(resphead)
+        status = f.readline().decode('utf-8').strip().split(None, 2)
+        respheaders = Headers(f)
+        self.proxy.log(
+            _peername(writer), startline.resource, *status[1:])
+        code = int(status[1])
+        writer.write(resphead)
+        # Without the whole request body sent, neither connection is
+        # at a message boundary.
+        reusable = sent and (
+            'close' not in respheaders.get('connection', '').lower()
+            and status[0].upper() != 'HTTP/1.0')
+        keep = sent
+        try:
+            if (
+                    startline.method.upper() == 'HEAD'
+                    or code in (204, 304) or 100 <= code < 200):
+                pass
+            elif (
+                    respheaders.get('content-length') is None
+                    and 'chunked' not in respheaders.get(
+                        'transfer-encoding', '').lower()):
+                data = await self._read(ureader.read(BUFSIZE))
+                while data:
+                    writer.write(data)
+                    await writer.drain()
+                    data = await self._read(ureader.read(BUFSIZE))
+                reusable = keep = False
+            else:
+                await self._copybody(ureader, writer, _bodylength(respheaders))
+        except Exception:
+            uwriter.close()
+            raise
+        if reusable:
+            self._release(key, ureader, uwriter)
+        else:
+            uwriter.close()
+        return keep
+
+    def _error(self, writer):
+        traceback.print_exc()
+        data = traceback.format_exc().encode('utf-8')
+        writer.write(
+            b'HTTP/1.1 500 Server Error\r\n'
+            b'Content-Type: text\r\n')
+        writer.write('Content-Length: {}\r\n\r\n'.format(len(data)).encode('utf-8'))
+        writer.write(data)
+        return False
+
+    do_GET = _basic
+    do_POST = _basic
+    do_PUT = _basic
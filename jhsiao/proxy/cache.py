@@ -0,0 +1,541 @@
+"""HTTP/1.1 response cache (subset of RFC 9111).
+
+Supports Cache-Control max-age/s-maxage/no-store/no-cache/private,
+Expires, heuristic freshness from Last-Modified, revalidation with
+ETag/Last-Modified conditional requests, and Vary.  A response may
+also be stored in a content encoding the proxy applied (gzip) next to
+its identity representation.
+
+Entries live in a size-bounded in-memory LRU and/or a persistent disk
+tier.  Disk entries are a json metadata file and a body file so hits
+can be sent with sendfile.  Only complete bodies are stored.
+"""
+from __future__ import print_function, division
+__all__ = ['HTTPCache']
+from collections import OrderedDict
+import calendar
+import email.utils
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import traceback
+
+HOP_HEADERS = frozenset([
+    'connection', 'keep-alive', 'proxy-connection', 'te', 'trailer',
+    'transfer-encoding', 'upgrade', 'proxy-authenticate',
+    'proxy-authorization', 'content-length', 'age'])
+CACHEABLE_STATUS = frozenset([200, 203, 300, 301, 308, 404, 410])
+HEURISTIC_MAX = 86400
+
+def parse_cc(value):
+    """Parse a Cache-Control value into dict of directive: value/True."""
+    ret = {}
+    if not value:
+        return ret
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        k, sep, v = part.partition('=')
+        ret[k.strip().lower()] = v.strip().strip('"') if sep else True
+    return ret
+
+def parse_date(value):
+    """Parse an http date into a timestamp or None."""
+    if not value:
+        return None
+    try:
+        parsed = email.utils.parsedate_tz(value)
+    except Exception:
+        return None
+    if parsed is None:
+        return None
+    return calendar.timegm(parsed[:9]) - (parsed[9] or 0)
+
+def _seconds(value):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return None
+
+class Entry(object):
+    """A stored response variant."""
+    __slots__ = (
+        'url', 'status', 'reason', 'headers', 'vary', 'stored', 'age',
+        'lifetime', 'nocache', 'etag', 'lastmod', 'size', 'body', 'path',
+        'encoding', 'rawsize')
+
+    def __init__(
+            self, url, status, reason, headers, vary, stored, age,
+            lifetime, nocache, size, body=None, path=None, encoding=None,
+            rawsize=None):
+        """Initialize.
+
+        encoding: content encoding applied by the proxy, None if the
+            body is as the origin sent it.
+        rawsize: size of the body before encoding.
+        """
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.vary = vary
+        self.stored = stored
+        self.age = age
+        self.lifetime = lifetime
+        self.nocache = nocache
+        self.size = size
+        self.body = body
+        self.path = path
+        self.encoding = encoding
+        self.rawsize = rawsize
+        self.etag = self.lastmod = None
+        for k, v in headers:
+            k = k.lower()
+            if k == 'etag':
+                self.etag = v
+            elif k == 'last-modified':
+                self.lastmod = v
+
+    def currentage(self, now):
+        return self.age + max(0, now - self.stored)
+
+    def fresh(self, now):
+        return not self.nocache and self.currentage(now) < self.lifetime
+
+    def matches(self, reqheaders):
+        """Return whether the request selects this variant."""
+        for name, value in self.vary.items():
+            if reqheaders.get(name, '') != value:
+                return False
+        return True
+
+    def conditional(self, reqheaders):
+        """Return request headers dict with validators added."""
+        ret = dict(reqheaders.items())
+        if self.etag:
+            ret['If-None-Match'] = self.etag
+        if self.lastmod:
+            ret['If-Modified-Since'] = self.lastmod
+        return ret
+
+    def head(self, now):
+        """Return the response head bytes to send for this entry."""
+        lines = ['HTTP/1.1 {} {}'.format(self.status, self.reason)]
+        lines.extend(['{}: {}'.format(k, v) for k, v in self.headers])
+        lines.append('Age: {}'.format(int(self.currentage(now))))
+        lines.append('Content-Length: {}'.format(self.size))
+        lines.append('\r\n')
+        return '\r\n'.join(lines).encode('utf-8')
+
+    def meta(self):
+        return dict(
+            url=self.url, status=self.status, reason=self.reason,
+            headers=self.headers, vary=self.vary, stored=self.stored,
+            age=self.age, lifetime=self.lifetime, nocache=self.nocache,
+            size=self.size, encoding=self.encoding, rawsize=self.rawsize)
+
+
+class _Store(object):
+    """Collect a response body for insertion into the cache."""
+    def __init__(self, cache, entry):
+        self.cache = cache
+        self.entry = entry
+        self.chunks = [] if cache.memsize else None
+        self.f = None
+        if cache.diskdir is not None:
+            fd, path = tempfile.mkstemp(dir=cache.diskdir, suffix='.tmp')
+            self.f = os.fdopen(fd, 'wb')
+            self.tmppath = path
+
+    def write(self, data):
+        entry = self.entry
+        entry.size += len(data)
+        if self.chunks is not None:
+            if entry.size > self.cache.maxobject:
+                self.chunks = None
+            else:
+                self.chunks.append(bytes(data))
+        if self.f is not None:
+            if entry.size > self.cache.disksize:
+                self._droptmp()
+            else:
+                try:
+                    self.f.write(data)
+                except Exception:
+                    traceback.print_exc()
+                    self._droptmp()
+
+    def _droptmp(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+            try:
+                os.remove(self.tmppath)
+            except OSError:
+                pass
+
+    def finish(self):
+        """Body complete, insert into cache.
+
+        Return the inserted Entry or None if it was not stored.
+        """
+        body = None if self.chunks is None else b''.join(self.chunks)
+        path = None
+        if self.f is not None:
+            try:
+                self.f.close()
+                self.f = None
+                path = self.cache._commit(self.entry, self.tmppath)
+            except Exception:
+                traceback.print_exc()
+                self._droptmp()
+        if body is not None or path is not None:
+            return self.cache._insert(self.entry, body, path)
+        return None
+
+    def abort(self):
+        """Body incomplete, discard."""
+        self.chunks = None
+        self._droptmp()
+
+    def variant(self, encoding, headers):
+        """Return a _Store for the body in encoding with headers."""
+        return self.cache.variant(self.entry, encoding, headers)
+
+
+class HTTPCache(object):
+    """Two-tier response cache keyed by url and Vary headers."""
+    def __init__(self, memsize=64<<20, maxobject=1<<20, diskdir=None, disksize=1<<30):
+        """Initialize.
+
+        memsize: max bytes of bodies kept in memory.
+        maxobject: max body size kept in memory.
+        diskdir: directory for the disk tier, None to disable.
+        disksize: max bytes of bodies kept on disk.
+        """
+        self.memsize = memsize
+        self.maxobject = maxobject
+        self.diskdir = diskdir
+        self.disksize = disksize
+        self.lock = threading.Lock()
+        self.mem = OrderedDict()
+        self.memused = 0
+        self.disk = OrderedDict()
+        self.diskused = 0
+        self.counts = dict(
+            hits=0, memhits=0, diskhits=0, misses=0, revalidated=0,
+            stored=0, bytessaved=0, memevictions=0, diskevictions=0)
+        if diskdir is not None:
+            if not os.path.isdir(diskdir):
+                os.makedirs(diskdir)
+            self._load()
+
+    def _count(self, key, amt=1):
+        with self.lock:
+            self.counts[key] += amt
+
+    def stats(self):
+        """Return dict of counts, hit ratio, and tier usage."""
+        with self.lock:
+            ret = dict(self.counts)
+            ret['memused'] = self.memused
+            ret['diskused'] = self.diskused
+        lookups = ret['hits'] + ret['misses']
+        ret['hitratio'] = ret['hits'] / lookups if lookups else 0.0
+        return ret
+
+    # disk tier
+    def _name(self, entry):
+        key = [entry.url, sorted(entry.vary.items())]
+        if entry.encoding is not None:
+            key.append(entry.encoding)
+        key = json.dumps(key)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def _load(self):
+        """Index existing disk entries, oldest first."""
+        metas = []
+        for fname in os.listdir(self.diskdir):
+            path = os.path.join(self.diskdir, fname)
+            if fname.endswith('.tmp'):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            elif fname.endswith('.meta'):
+                try:
+                    with open(path) as f:
+                        meta = json.load(f)
+                    meta['headers'] = [tuple(h) for h in meta['headers']]
+                    entry = Entry(**meta)
+                    entry.path = path[:-len('.meta')] + '.body'
+                    if os.path.getsize(entry.path) != entry.size:
+                        raise ValueError('size mismatch')
+                    metas.append((os.path.getmtime(path), entry))
+                except Exception:
+                    traceback.print_exc()
+        metas.sort(key=lambda item: item[0])
+        with self.lock:
+            for _, entry in metas:
+                self._put(self.disk, entry)
+                self.diskused += entry.size
+            self._evictdisk()
+
+    def _commit(self, entry, tmppath):
+        """Move a completed body into place and write its metadata."""
+        base = os.path.join(self.diskdir, self._name(entry))
+        path = base + '.body'
+        os.rename(tmppath, path)
+        metatmp = base + '.meta.tmp'
+        with open(metatmp, 'w') as f:
+            json.dump(entry.meta(), f)
+        os.rename(metatmp, base + '.meta')
+        return path
+
+    def _unlink(self, entry):
+        for path in (entry.path, entry.path[:-len('.body')] + '.meta'):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _evictdisk(self):
+        while self.diskused > self.disksize and self.disk:
+            _, entries = self.disk.popitem(last=False)
+            for entry in entries:
+                self.diskused -= entry.size
+                self.counts['diskevictions'] += 1
+                self._unlink(entry)
+
+    # memory tier
+    def _evictmem(self):
+        while self.memused > self.memsize and self.mem:
+            _, entries = self.mem.popitem(last=False)
+            for entry in entries:
+                self.memused -= entry.size
+                self.counts['memevictions'] += 1
+
+    @staticmethod
+    def _put(tier, entry):
+        """Add entry to tier replacing same variant.
+
+        Return replaced entry or None.
+        """
+        entries = tier.get(entry.url)
+        if entries is None:
+            tier[entry.url] = [entry]
+            return None
+        tier.move_to_end(entry.url)
+        for i, other in enumerate(entries):
+            if other.vary == entry.vary and other.encoding == entry.encoding:
+                entries[i] = entry
+                return other
+        entries.append(entry)
+        return None
+
+    def _insert(self, entry, body, path):
+        """Insert entry into the tiers, return the one to serve."""
+        ret = entry
+        with self.lock:
+            self.counts['stored'] += 1
+            if body is not None:
+                memory = Entry(**entry.meta())
+                memory.body = body
+                memory.path = path
+                ret = memory
+                old = self._put(self.mem, memory)
+                self.memused += memory.size - (0 if old is None else old.size)
+                self._evictmem()
+            if path is not None:
+                entry.path = path
+                old = self._put(self.disk, entry)
+                self.diskused += entry.size
+                if old is not None:
+                    self.diskused -= old.size
+                    if old.path != path:
+                        self._unlink(old)
+                self._evictdisk()
+        return ret
+
+    @staticmethod
+    def _find(tier, url, reqheaders, encodings):
+        """Return the matching entry, preferring one in encodings."""
+        entries = tier.get(url)
+        found = None
+        if entries:
+            for entry in entries:
+                if not entry.matches(reqheaders):
+                    continue
+                if entry.encoding in encodings:
+                    found = entry
+                    break
+                elif entry.encoding is None and found is None:
+                    found = entry
+            if found is not None:
+                tier.move_to_end(url)
+        return found
+
+    # public interface
+    def lookup(self, url, reqheaders, encodings=()):
+        """Return a stored Entry for the request or None.
+
+        encodings: proxy applied encodings the client accepts.  A
+            variant in one of them is preferred over the identity.
+        Entry may be stale, check Entry.fresh().
+        """
+        with self.lock:
+            entry = self._find(self.mem, url, reqheaders, encodings)
+            if entry is None or (encodings and entry.encoding is None):
+                other = self._find(self.disk, url, reqheaders, encodings)
+                if other is not None and (
+                        entry is None or other.encoding is not None):
+                    entry = other
+        if entry is None:
+            self._count('misses')
+        return entry
+
+    def mustrevalidate(self, reqheaders):
+        """Return whether the request forbids serving a stored response."""
+        cc = parse_cc(reqheaders.get('cache-control'))
+        return (
+            'no-cache' in cc or _seconds(cc.get('max-age')) == 0
+            or 'no-cache' in reqheaders.get('pragma', ''))
+
+    def store(self, url, reqheaders, status, reason, respheaders):
+        """Return a _Store for the response body, or None if uncacheable.
+
+        respheaders: sequence of (header, value) pairs.
+        """
+        now = time.time()
+        if status not in CACHEABLE_STATUS:
+            return None
+        reqcc = parse_cc(reqheaders.get('cache-control'))
+        if 'no-store' in reqcc or reqheaders.get('authorization'):
+            return None
+        info = {}
+        for k, v in respheaders:
+            k = k.lower()
+            info[k] = info[k] + ',' + v if k in info else v
+        cc = parse_cc(info.get('cache-control'))
+        if 'no-store' in cc or 'private' in cc:
+            return None
+        varynames = [
+            name.strip().lower()
+            for name in info.get('vary', '').split(',') if name.strip()]
+        if '*' in varynames:
+            return None
+        date = parse_date(info.get('date')) or now
+        lifetime = _seconds(cc.get('s-maxage'))
+        if lifetime is None:
+            lifetime = _seconds(cc.get('max-age'))
+        if lifetime is None and 'expires' in info:
+            expires = parse_date(info['expires'])
+            lifetime = 0 if expires is None else max(0, expires - date)
+        if lifetime is None:
+            lastmod = parse_date(info.get('last-modified'))
+            if lastmod is not None:
+                lifetime = min(HEURISTIC_MAX, max(0, date - lastmod) // 10)
+            elif 'etag' in info:
+                lifetime = 0
+            else:
+                return None
+        nocache = 'no-cache' in cc
+        if (lifetime == 0 or nocache) and not (
+                'etag' in info or 'last-modified' in info):
+            return None
+        entry = Entry(
+            url, status, reason,
+            [(k, v) for k, v in respheaders if k.lower() not in HOP_HEADERS],
+            dict([(name, reqheaders.get(name, '')) for name in varynames]),
+            now, _seconds(info.get('age')) or 0, lifetime, nocache, 0)
+        return _Store(self, entry)
+
+    def variant(self, entry, encoding, headers):
+        """Return a _Store for entry's body in encoding with headers.
+
+        The variant has the same freshness as entry.
+        """
+        meta = entry.meta()
+        meta.update(headers=headers, encoding=encoding, size=0)
+        return _Store(self, Entry(**meta))
+
+    def refresh(self, entry, respheaders):
+        """Update entry with the headers of a 304 response.
+
+        The copy of the same response in the other tier is updated too.
+        Return the updated entry.
+        """
+        updates = OrderedDict()
+        for k, v in respheaders:
+            if k.lower() not in HOP_HEADERS:
+                updates.setdefault(k.lower(), []).append((k, v))
+        headers = [
+            (k, v) for k, v in entry.headers if k.lower() not in updates]
+        for pairs in updates.values():
+            headers.extend(pairs)
+        cc = parse_cc(', '.join([v for k, v in headers if k.lower() == 'cache-control']))
+        info = dict([(k.lower(), v) for k, v in headers])
+        now = time.time()
+        lifetime = _seconds(cc.get('s-maxage'))
+        if lifetime is None:
+            lifetime = _seconds(cc.get('max-age'))
+        if lifetime is None and 'expires' in info:
+            expires = parse_date(info['expires'])
+            date = parse_date(info.get('date')) or now
+            lifetime = 0 if expires is None else max(0, expires - date)
+        if lifetime is None:
+            lifetime = entry.lifetime
+        with self.lock:
+            copies = [entry]
+            for tier in (self.mem, self.disk):
+                for other in tier.get(entry.url, ()):
+                    if other is not entry and (
+                            other.vary == entry.vary
+                            and other.encoding == entry.encoding
+                            and other.etag == entry.etag
+                            and other.size == entry.size):
+                        copies.append(other)
+            for other in copies:
+                other.headers = headers
+                other.stored = now
+                other.age = 0
+                other.lifetime = lifetime
+                other.nocache = 'no-cache' in cc
+            self.counts['revalidated'] += 1
+        if entry.path is not None and os.path.exists(entry.path):
+            try:
+                self._commit(entry, entry.path)
+            except Exception:
+                traceback.print_exc()
+        return entry
+
+    def served(self, entry):
+        """Record a hit served from entry."""
+        with self.lock:
+            counts = self.counts
+            counts['hits'] += 1
+            counts['memhits' if entry.body is not None else 'diskhits'] += 1
+            counts['bytessaved'] += entry.size
+
+    def missed(self):
+        """Record a stale entry that was fetched again."""
+        self._count('misses')
+
+    def open(self, entry):
+        """Open the disk body of entry or return None if it is gone."""
+        try:
+            f = open(entry.path, 'rb')
+        except (OSError, IOError, TypeError):
+            return None
+        if os.fstat(f.fileno()).st_size != entry.size:
+            # replaced by a newer variant
+            f.close()
+            return None
+        return f
+
+    def close(self):
+        pass
@@ -0,0 +1,284 @@
+"""Collapsed forwarding of concurrent identical GETs.
+
+The first GET for a url fetches it upstream as the leader of a Flight.
+Identical GETs that arrive while it is in flight follow it instead of
+fetching it again: they are sent the bytes the leader sends its client
+as the leader sends them.  A response is shared unless it is private,
+sets cookies or varies on request headers a follower does not match.
+Followers of a response that is not shared fetch it themselves.
+
+Followers can join until the leader has relayed maxbuffer bytes.  After
+that the body is buffered only until every follower has sent it, and
+followers that fall more than maxbuffer bytes or maxchunks chunks behind
+the leader are dropped so the buffer stays bounded.  A follower that
+waits longer than the read timeout for the leader gives up.
+"""
+__all__ = ['Collapser', 'Flight', 'collapsible', 'shareable']
+import threading
+
+from .cache import parse_cc
+
+UNCOLLAPSIBLE = (
+    'authorization', 'range', 'if-range', 'if-match', 'if-none-match',
+    'if-modified-since', 'if-unmodified-since', 'content-length',
+    'transfer-encoding')
+
+def collapsible(reqheaders):
+    """Return whether a GET may lead or follow a Flight.
+
+    Requests with credentials, ranges, conditions or bodies may get a
+    response other requests cannot use.
+    """
+    for name in UNCOLLAPSIBLE:
+        if reqheaders.get(name) is not None:
+            return False
+    return True
+
+def shareable(respheaders):
+    """Return Vary names if a response can be shared, else None."""
+    vary = []
+    for k, v in respheaders:
+        lk = k.lower()
+        if lk == 'set-cookie':
+            return None
+        elif lk == 'cache-control' and 'private' in parse_cc(v):
+            return None
+        elif lk == 'vary':
+            vary.extend([
+                name.strip().lower() for name in v.split(',') if name.strip()])
+    if '*' in vary:
+        return None
+    return vary
+
+
+class Follower(object):
+    """A request following a Flight."""
+    __slots__ = ('pos', 'dropped')
+    def __init__(self):
+        self.pos = 0
+        self.dropped = False
+
+
+class Flight(object):
+    """An upstream fetch other requests can follow."""
+    def __init__(self, collapser, key, reqheaders):
+        self.collapser = collapser
+        self.key = key
+        self.reqheaders = reqheaders
+        self.cond = threading.Condition(threading.Lock())
+        self.joinable = True
+        self.followers = set()
+        self.head = None
+        self.status = None
+        self.vary = None
+        self.delimited = True
+        self.chunks = []
+        self.base = 0
+        self.size = 0
+        self.buffered = 0
+        self.complete = False
+        self.done = False
+
+    # leader
+    def share(self, head, status, delimited, respheaders):
+        """Response head was sent.
+
+        Return whether the body should be passed to write().
+        """
+        vary = shareable(respheaders)
+        with self.cond:
+            self.head = head
+            self.status = status
+            self.delimited = delimited
+            self.vary = vary
+            if vary is None:
+                self.joinable = False
+                self.chunks = None
+            self.cond.notify_all()
+        if vary is None:
+            self.collapser.remove(self)
+            return False
+        return True
+
+    def write(self, data):
+        """Body bytes were sent.
+
+        Return whether later bytes should still be passed.
+        """
+        close = False
+        with self.cond:
+            if self.chunks is None:
+                return False
+            self.chunks.append(data)
+            self.size += len(data)
+            self.buffered += len(data)
+            if self.joinable and self.size > self.collapser.maxbuffer:
+                self.joinable = False
+                close = True
+            if not self.joinable:
+                self._trim()
+            if not self.joinable and not self.followers:
+                self.chunks = None
+            elif self.followers:
+                self.cond.notify_all()
+            ret = self.chunks is not None
+        if close:
+            self.collapser.remove(self)
+        return ret
+
+    def finish(self, complete):
+        """The leader is done, complete if the whole response was sent.
+
+        Only the first call counts.
+        """
+        with self.cond:
+            if self.done:
+                return
+            self.complete = complete
+            self.done = True
+            self.joinable = False
+            self.cond.notify_all()
+        self.collapser.remove(self)
+
+    # followers
+    def wait(self, follower, reqheaders):
+        """Wait for the response head.
+
+        Return the head if it can be sent for reqheaders, else None.
+        The follower leaves the flight if it cannot or if the leader
+        takes longer than the timeout.
+        """
+        timeout = self.collapser.timeout
+        with self.cond:
+            while self.head is None and not self.done:
+                if not self.cond.wait(timeout):
+                    break
+            vary = self.vary
+            if self.head is not None and vary is not None:
+                leader = self.reqheaders
+                for name in vary:
+                    if reqheaders.get(name, '') != leader.get(name, ''):
+                        break
+                else:
+                    return self.head
+        self.leave(follower)
+        return None
+
+    def read(self, follower):
+        """Yield body bytes as the leader sends them.
+
+        Stop early if the follower is dropped for falling behind or the
+        leader sends nothing for the timeout.  follower.dropped is set
+        then.
+        """
+        cond = self.cond
+        timeout = self.collapser.timeout
+        while 1:
+            with cond:
+                while (
+                        not follower.dropped
+                        and follower.pos >= self.base + len(self.chunks)
+                        and not self.done):
+                    if not cond.wait(timeout):
+                        self._drop(follower)
+                if follower.dropped:
+                    return
+                chunks = self.chunks[follower.pos - self.base:]
+                if not chunks:
+                    return
+                follower.pos += len(chunks)
+                self._trim()
+            for chunk in chunks:
+                yield chunk
+
+    def leave(self, follower):
+        with self.cond:
+            self.followers.discard(follower)
+            if self.chunks is not None:
+                if self.followers:
+                    self._trim()
+                elif not self.joinable:
+                    self.chunks = None
+
+    def _trim(self):
+        """Drop chunks every follower has read.  Lock must be held.
+
+        Once the buffer is over the limits, the followers holding the
+        oldest chunk are dropped until it is not or only the newest
+        chunk is left.
+        """
+        if self.joinable:
+            return
+        collapser = self.collapser
+        chunks = self.chunks
+        while self.followers:
+            low = min([f.pos for f in self.followers])
+            n = low - self.base
+            if n:
+                self.buffered -= sum([len(chunk) for chunk in chunks[:n]])
+                del chunks[:n]
+                self.base = low
+            if len(chunks) <= 1 or (
+                    self.buffered <= collapser.maxbuffer
+                    and len(chunks) <= collapser.maxchunks):
+                return
+            for follower in list(self.followers):
+                if follower.pos == low:
+                    self._drop(follower)
+
+    def _drop(self, follower):
+        """Drop a follower that fell behind.  Lock must be held."""
+        follower.dropped = True
+        self.followers.discard(follower)
+
+
+class Collapser(object):
+    """Flights by request key."""
+    def __init__(self, maxbuffer=1<<20, maxchunks=1024, timeout=60):
+        """Initialize.
+
+        maxbuffer: bytes of a response after which no more requests
+            can follow it, and bytes a follower can fall behind.
+        maxchunks: chunks a follower can fall behind.
+        timeout: seconds a follower waits for the leader to send more.
+        """
+        self.maxbuffer = maxbuffer
+        self.maxchunks = maxchunks
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.counts = dict(leaders=0, followers=0)
+
+    def join(self, key, reqheaders):
+        """Return (Flight, Follower) for a request.
+
+        Follower is None if the request leads the Flight and should
+        fetch the response, passing it to Flight.share() and write()
+        and calling Flight.finish() when done.  Otherwise the request
+        follows it with Flight.wait() and read().
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                with flight.cond:
+                    if flight.joinable:
+                        follower = Follower()
+                        flight.followers.add(follower)
+                        self.counts['followers'] += 1
+                        return flight, follower
+            flight = self.flights[key] = Flight(self, key, reqheaders)
+            self.counts['leaders'] += 1
+            return flight, None
+
+    def remove(self, flight):
+        """Stop requests from following flight."""
+        with self.lock:
+            if self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
+
+    def stats(self):
+        """Return dict of counts and flights in progress."""
+        with self.lock:
+            ret = dict(self.counts)
+            ret['inflight'] = len(self.flights)
+        return ret
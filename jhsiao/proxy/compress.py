@@ -0,0 +1,180 @@
+"""Streaming gzip compression of relayed responses.
+
+Text-like responses are gzipped for clients that accept it.  The cpu
+time spent compressing is measured per chunk and limited to a fraction
+of a cpu with a token bucket.  While it is used up, responses are sent
+as they are.
+"""
+from __future__ import division
+__all__ = ['Compressor', 'GzipStream', 'accepts', 'gzipheaders']
+import threading
+import time
+import zlib
+
+COMPRESSIBLE = (
+    'text/', 'application/json', 'application/javascript',
+    'application/x-javascript', 'application/xml', 'application/xhtml+xml',
+    'application/rss+xml', 'application/atom+xml', 'image/svg+xml')
+
+def accepts(value, coding='gzip'):
+    """Return whether an Accept-Encoding value allows coding."""
+    star = 0
+    for part in (value or '').split(','):
+        name, _, params = part.partition(';')
+        name = name.strip().lower()
+        q = 1.0
+        for param in params.split(';'):
+            k, _, v = param.partition('=')
+            if k.strip().lower() == 'q':
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0
+        if name in (coding, 'x-' + coding):
+            return q > 0
+        elif name == '*':
+            star = q
+    return star > 0
+
+def gzipheaders(headers):
+    """Return response header pairs for the gzipped representation.
+
+    Length and framing headers are dropped, strong ETags are made weak
+    and Accept-Encoding is added to Vary.
+    """
+    ret = []
+    vary = []
+    for k, v in headers:
+        lk = k.lower()
+        if lk in ('content-length', 'transfer-encoding', 'content-encoding'):
+            continue
+        elif lk == 'etag' and not v.startswith('W/'):
+            v = 'W/' + v
+        elif lk == 'vary':
+            vary.extend([name.strip() for name in v.split(',') if name.strip()])
+            continue
+        ret.append((k, v))
+    if 'accept-encoding' not in [name.lower() for name in vary]:
+        vary.append('Accept-Encoding')
+    ret.append(('Vary', ', '.join(vary)))
+    ret.append(('Content-Encoding', 'gzip'))
+    return ret
+
+class GzipStream(object):
+    """Compress one response body."""
+    def __init__(self, compressor):
+        self.compressor = compressor
+        self.z = zlib.compressobj(compressor.level, zlib.DEFLATED, 31)
+        self.nin = 0
+        self.nout = 0
+        self.cpu = 0.0
+
+    def _run(self, func, *args):
+        start = time.thread_time()
+        out = func(*args)
+        cpu = time.thread_time() - start
+        self.cpu += cpu
+        self.nout += len(out)
+        self.compressor.charge(cpu)
+        return out
+
+    def compress(self, data):
+        """Return compressed bytes available so far, maybe empty."""
+        self.nin += len(data)
+        return self._run(self.z.compress, data)
+
+    def finish(self):
+        """Return the rest of the compressed body."""
+        out = self._run(self.z.flush)
+        self.compressor.finished(self)
+        return out
+
+
+class Compressor(object):
+    """Decide which responses to gzip and account for the cpu used."""
+    def __init__(
+            self, level=6, minsize=1024, cpubudget=None, types=COMPRESSIBLE):
+        """Initialize.
+
+        level: zlib compression level.
+        minsize: do not compress bodies known to be smaller.
+        cpubudget: fraction of a cpu to spend compressing on average
+            (with bursts up to a second of it), None for no limit.
+        types: compressible content type prefixes.
+        """
+        self.level = level
+        self.minsize = minsize
+        self.cpubudget = cpubudget
+        self.types = tuple(types)
+        self.lock = threading.Lock()
+        self.tokens = cpubudget
+        self.last = time.time()
+        self.counts = dict(
+            compressed=0, bytesin=0, bytesout=0, cpu=0.0, overbudget=0)
+
+    def charge(self, cpu):
+        """Spend cpu seconds of the budget."""
+        if self.cpubudget is not None:
+            with self.lock:
+                self.tokens -= cpu
+
+    def finished(self, stream):
+        with self.lock:
+            counts = self.counts
+            counts['compressed'] += 1
+            counts['bytesin'] += stream.nin
+            counts['bytesout'] += stream.nout
+            counts['cpu'] += stream.cpu
+
+    def allowed(self):
+        """Return whether the cpu budget allows starting a stream."""
+        budget = self.cpubudget
+        if budget is None:
+            return True
+        now = time.time()
+        with self.lock:
+            self.tokens = min(budget, self.tokens + (now - self.last) * budget)
+            self.last = now
+            if self.tokens > 0:
+                return True
+            self.counts['overbudget'] += 1
+            return False
+
+    def compressible(self, status, respheaders):
+        """Return whether a response's body should be gzipped."""
+        if status != 200:
+            return False
+        ctype = ''
+        for k, v in respheaders:
+            lk = k.lower()
+            if lk == 'content-encoding':
+                if v.strip().lower() != 'identity':
+                    return False
+            elif lk == 'content-length':
+                try:
+                    if int(v) < self.minsize:
+                        return False
+                except ValueError:
+                    return False
+            elif lk == 'content-type':
+                ctype = v.strip().lower()
+            elif lk == 'cache-control' and 'no-transform' in v.lower():
+                return False
+        return ctype.startswith(self.types)
+
+    def start(self, reqheaders, status, respheaders):
+        """Return a GzipStream for the response or None."""
+        if (
+                accepts(reqheaders.get('accept-encoding'))
+                and self.compressible(status, respheaders)
+                and self.allowed()):
+            return GzipStream(self)
+        return None
+
+    def stats(self):
+        """Return dict of counts and the compression ratio."""
+        with self.lock:
+            ret = dict(self.counts)
+        ret['ratio'] = (
+            ret['bytesout'] / ret['bytesin'] if ret['bytesin'] else 1.0)
+        return ret
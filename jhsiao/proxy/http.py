@@ -4,14 +4,20 @@ Parsing uses binary file
 because using TextIOWrapper may read more than needed so cannot then
 switch to using binary because some data was already grabbed by the
 text wrapper.
+
+RequestParser parses a whole request head from bytes instead and is
+what the proxy uses.  Startline and Headers parse from a file.
 """
+import abc
 import re
 from collections import defaultdict
 import sys
 if sys.version_info.major > 2:
     from urllib.parse import unquote
+    _ABC = abc.ABC
 else:
     from urllib import unquote
+    _ABC = abc.ABCMeta('_ABC', (object,), {})
 import io
 
 class HTTPError(Exception):
@@ -91,6 +97,300 @@ class Headers(object):
         return iter(self.info)
 
 
+class ParsedStartline(object):
+    """Startline from a RequestParser, decoded when accessed."""
+    def __init__(self, method, resource, version):
+        self._method = method
+        self._resource = resource
+        self.version = version
+
+    @property
+    def method(self):
+        return self._method.decode('ascii')
+
+    @property
+    def resource(self):
+        return unquote(self._resource.decode('utf-8'))
+
+    @property
+    def rawresource(self):
+        """The resource as sent, not unquoted."""
+        return self._resource.decode('utf-8')
+
+
+class ParsedHeaders(object):
+    """Headers from a RequestParser.
+
+    Same interface as Headers.  Values are kept as bytes and decoded
+    when read.
+    """
+    def __init__(self, index):
+        """Initialize.
+
+        index: dict of lowercase bytes name: [bytes values]
+        """
+        self.index = index
+
+    def __str__(self):
+        lines = [': '.join((k, v)) for k, v in self.items()]
+        return '\r\n'.join(lines)
+
+    def __getitem__(self, header):
+        """Get original separated values as a list."""
+        return [
+            v.decode('utf-8')
+            for v in self.index.get(header.encode('latin1'), ())]
+
+    def items(self):
+        for k, v in self.index.items():
+            yield (k.decode('latin1'), b','.join(v).decode('utf-8'))
+
+    def get(self, key, default=None):
+        """Get comma joined values."""
+        val = self.index.get(key.encode('latin1'))
+        if val is None:
+            return default
+        elif len(val) == 1:
+            return val[0].decode('utf-8')
+        else:
+            return b','.join(val).decode('utf-8')
+
+    def __contains__(self, key):
+        return key.encode('latin1') in self.index
+
+    def __iter__(self):
+        for k in self.index:
+            yield k.decode('latin1')
+
+    def __len__(self):
+        return len(self.index)
+
+
+class RequestParser(object):
+    """Incremental HTTP/1.x request head parser.
+
+    feed() buffers (partial) data until the blank line ending the head
+    is found, then splits the head into a ParsedStartline and
+    ParsedHeaders.  Lines must end with CRLF.
+    """
+    def __init__(self, maxline=8192, maxheaders=100, maxsize=0x10000):
+        """Initialize.
+
+        maxline: max length of the request line.
+        maxheaders: max number of header lines.
+        maxsize: max size of the whole head.
+        """
+        self.maxline = maxline
+        self.maxheaders = maxheaders
+        self.maxsize = maxsize
+        self.buf = bytearray()
+        self.done = False
+        self.startline = None
+        self.headers = None
+
+    def feed(self, data):
+        """Add data.
+
+        Return the number of bytes of data that belong to the head.
+        The rest is the start of the body or the next request.  Raise
+        HTTPError if the head is invalid or exceeds a limit.
+        """
+        buf = self.buf
+        start = len(buf)
+        if not start and not data.startswith(b'\r\n'):
+            # Usually the whole head arrives at once, parse it in place.
+            end = data.find(b'\r\n\r\n', 0, self.maxsize)
+            if end >= 0:
+                self._parse(data[:end])
+                self.done = True
+                return end + 4
+        scanfrom = max(0, start - 3)
+        buf += data
+        # Ignore empty lines before the request line.
+        skip = 0
+        while buf.startswith(b'\r\n', skip):
+            skip += 2
+        if skip:
+            del buf[:skip]
+            start -= skip
+            scanfrom = 0
+        end = buf.find(b'\r\n\r\n', scanfrom)
+        if end < 0:
+            if len(buf) > self.maxsize:
+                raise HTTPError(431, 'Request Header Fields Too Large')
+            if len(buf) > self.maxline and buf.find(b'\r\n', 0, self.maxline) < 0:
+                raise HTTPError(414, 'Request-URI Too Long')
+            return len(data)
+        end += 4
+        if end > self.maxsize:
+            raise HTTPError(431, 'Request Header Fields Too Large')
+        self._parse(bytes(buf[:end-4]))
+        del self.buf[:]
+        self.done = True
+        return end - start
+
+    def _parse(self, head):
+        lines = head.split(b'\r\n')
+        line = lines[0]
+        if len(line) > self.maxline:
+            raise HTTPError(414, 'Request-URI Too Long')
+        if len(lines) - 1 > self.maxheaders:
+            raise HTTPError(431, 'Request Header Fields Too Large')
+        nlines = len(lines) - 1
+        if head.count(b'\n') != nlines or head.count(b'\r') != nlines:
+            # bare CR or LF
+            raise HTTPError(400, 'Bad Request')
+        parts = line.split(None, 1)
+        if len(parts) != 2:
+            raise HTTPError(-2, 'Not Http')
+        method, rest = parts
+        parts = rest.rsplit(None, 1)
+        if len(parts) != 2 or not method.isalpha():
+            raise HTTPError(-2, 'Not Http')
+        resource, version = parts
+        high, dot, low = version[5:].partition(b'.')
+        if (
+                version[:5].upper() != b'HTTP/' or not dot
+                or not high.isdigit() or not low.isdigit()):
+            raise HTTPError(-2, 'Not Http')
+        self.startline = ParsedStartline(
+            method, resource, (int(high), int(low)))
+        index = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(b':')
+            if not sep or line[:1] in b' \t':
+                raise HTTPError(-3, 'Bad header: {!r}'.format(line))
+            name = name.strip().lower()
+            vals = index.get(name)
+            if vals is None:
+                index[name] = [value.strip()]
+            else:
+                vals.append(value.strip())
+        self.headers = ParsedHeaders(index)
+
+    @classmethod
+    def read(cls, f, **limits):
+        """Parse a request head from buffered binary file f.
+
+        Only the head is consumed from f.  Return the parser.
+        """
+        parser = cls(**limits)
+        data = f.peek()
+        while data:
+            amt = parser.feed(data)
+            f.read(amt)
+            if parser.done:
+                return parser
+            data = f.peek()
+        raise HTTPError(-1, 'Connection Closed')
+
+
+class Body(_ABC):
+    """Stream a message body from a binary file in bounded chunks.
+
+    read() returns at most the requested amount and b'' at the end.
+    Iterating yields chunks of at most chunksize bytes.  Subclasses
+    implement _read() for their framing.
+    """
+    def __init__(self, f, chunksize=0x10000):
+        self.f = f
+        self.chunksize = chunksize
+        self.done = False
+
+    @staticmethod
+    def fromheaders(f, headers, chunksize=0x10000):
+        """Return a Body for a request's headers or None if no body."""
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            return ChunkedBody(f, chunksize)
+        dlen = headers.get('content-length')
+        if dlen is None:
+            return None
+        try:
+            length = int(dlen.split(',')[0])
+        except ValueError:
+            raise HTTPError(400, 'Bad Content-Length')
+        if length < 0:
+            raise HTTPError(400, 'Bad Content-Length')
+        elif length == 0:
+            return None
+        return LengthBody(f, length, chunksize)
+
+    @abc.abstractmethod
+    def _read(self, amt):
+        """Read up to amt > 0 bytes, b'' if done."""
+
+    def read(self, amt=-1):
+        if amt is None or amt < 0:
+            return b''.join(iter(self))
+        elif amt == 0 or self.done:
+            return b''
+        return self._read(amt)
+
+    def __iter__(self):
+        chunksize = self.chunksize
+        data = self.read(chunksize)
+        while data:
+            yield data
+            data = self.read(chunksize)
+
+    def drain(self):
+        """Discard the rest of the body."""
+        for _ in self:
+            pass
+
+class LengthBody(Body):
+    """Body with a Content-Length."""
+    def __init__(self, f, length, chunksize=0x10000):
+        super(LengthBody, self).__init__(f, chunksize)
+        self.remain = self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def _read(self, amt):
+        data = self.f.read(min(amt, self.remain))
+        if not data:
+            raise HTTPError(-5, 'Incomplete body')
+        self.remain -= len(data)
+        self.done = not self.remain
+        return data
+
+class ChunkedBody(Body):
+    """Body with chunked transfer-encoding, yields decoded data."""
+    maxline = io.DEFAULT_BUFFER_SIZE
+    def __init__(self, f, chunksize=0x10000):
+        super(ChunkedBody, self).__init__(f, chunksize)
+        self.remain = 0
+
+    def _line(self):
+        line = self.f.readline(self.maxline)
+        if not line.endswith(b'\n'):
+            raise HTTPError(-5, 'Incomplete body')
+        return line
+
+    def _read(self, amt):
+        f = self.f
+        if not self.remain:
+            line = self._line()
+            try:
+                self.remain = int(line.split(b';', 1)[0].strip(), 16)
+            except ValueError:
+                raise HTTPError(-6, 'Bad chunk size {!r}'.format(line))
+            if not self.remain:
+                # trailers
+                while self._line().strip():
+                    pass
+                self.done = True
+                return b''
+        data = f.read(min(amt, self.remain))
+        if not data:
+            raise HTTPError(-5, 'Incomplete body')
+        self.remain -= len(data)
+        if not self.remain and self._line().strip():
+            raise HTTPError(-6, 'Missing chunk terminator')
+        return data
+
+
 'HTTP/1.1 200 OK'
 if __name__ == '__main__':
     sample = b'''POST /contact_form.php HTTP/1.1
@@ -0,0 +1,165 @@
+"""Per-thread poll loops engine.
+
+Each Loop thread has its own poller, timers, clients and a few handler
+threads.  It accepts from the shared listening socket and queues its
+clients' requests for its own handlers, so the poll loops do not
+contend on one queue and a slow request does not stall reading heads
+or running timers.  The metrics, cache, resolver, upstream pool and
+per client ip limits are still shared by all loops.  Accepts are
+spread with EPOLLEXCLUSIVE where the poller is epoll: only an idle
+loop waiting in poll is woken for a new connection.  Elsewhere every loop is woken and the ones that
+lose the race for accept() go back to polling.
+"""
+from __future__ import print_function
+__all__ = ['LoopEngine', 'Loop']
+from collections import deque
+import select
+import threading
+import time
+import traceback
+
+from jhsiao.ipc import sockets, polling
+
+from .admission import LockedAdmission, QueuePolicy
+from .proxy import PollLoop, Server, Event, StopServing, bind_reuseport
+from .timerwheel import TimerWheel
+
+EXCLUSIVE = getattr(select, 'EPOLLEXCLUSIVE', 0)
+
+class Loop(PollLoop):
+    """A poll loop with its own handler threads.
+
+    Stands in for the Proxy wherever Server, Client and Dialer are
+    given one.  The poller, timers, queue and locks are the loop's own,
+    admission is shared by all loops, other attributes are the Proxy's.
+    """
+    def __init__(self, proxy, sock, admission):
+        self.proxy = proxy
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.done = []
+        self.q = deque()
+        policy = proxy.queuepolicy
+        self.queuepolicy = QueuePolicy(
+            policy.mode, policy.deadline, policy.target, policy.interval)
+        self.ready = deque()
+        self.polling = False
+        self.ev = Event()
+        self.poller = polling.Poller()
+        self._timers = TimerWheel(now=time.time())
+        self.admission = admission
+        self.server = Server(self, sock)
+
+    def __getattr__(self, name):
+        return getattr(self.proxy, name)
+
+    @property
+    def running(self):
+        """Whether the handlers should keep going."""
+        return self.polling and self.proxy.running
+
+    def resume(self, client):
+        # Handle it on the next iteration instead of recursing.
+        self.ready.append(client)
+
+    def run(self):
+        self.polling = True
+        handlers = [
+            threading.Thread(target=self.handleloop)
+            for _ in range(max(1, self.proxy.loopthreads))]
+        for h in handlers:
+            h.start()
+        poller = self.poller
+        poller.register(self.ev, poller.RFLAGS)
+        flags = poller.RFLAGS
+        if EXCLUSIVE and flags == getattr(select, 'EPOLLIN', None):
+            flags |= EXCLUSIVE
+        poller.register(self.server, flags)
+        ready = self.ready
+        try:
+            timeout = None
+            while 1:
+                r, w, x = poller.poll(0 if ready else timeout)
+                self._dispatch(r)
+                self._dispatch(w)
+                self._dispatcherrors(r, w, x)
+                self._dispatch([ready.popleft() for _ in range(len(ready))])
+                timeout = self._runtimers()
+        except (StopServing, KeyboardInterrupt):
+            pass
+        except Exception:
+            traceback.print_exc()
+        finally:
+            with self.cond:
+                self.polling = False
+                self.cond.notify_all()
+            for h in handlers:
+                h.join()
+            poller.unregister(self.ev)
+            poller.unregister(self.server)
+            poller.close()
+
+    def stop(self):
+        """Wake the loop and its handlers so they see the proxy stopped."""
+        with self.cond:
+            self.ev.set()
+            self.cond.notify_all()
+
+    def close(self):
+        self.ev.close()
+
+
+class LoopEngine(object):
+    """Run proxy.numthreads Loops sharing one listening socket."""
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.loops = []
+
+    def run(self):
+        """Run until stop(), the calling thread runs the first loop."""
+        proxy = self.proxy
+        if proxy.reuseport:
+            sock = bind_reuseport(proxy.addr)
+        else:
+            sock = sockets.bind(proxy.addr)
+        proxy.bound(sock)
+        sock.listen(128)
+        sock.setblocking(False)
+        proxy.openshared()
+        threads = []
+        limits = proxy.admission
+        admission = LockedAdmission(
+            limits.rate, limits.burst, limits.maxactive, limits.maxips)
+        try:
+            self.loops = [
+                Loop(proxy, sock, admission)
+                for _ in range(max(1, proxy.numthreads))]
+            for loop in self.loops[1:]:
+                t = threading.Thread(target=loop.run)
+                t.start()
+                threads.append(t)
+            if not proxy.running:
+                # stop() before there were loops to wake
+                self.stop()
+            self.loops[0].run()
+        finally:
+            with proxy.lock:
+                proxy.running = False
+            self.stop()
+            for t in threads:
+                t.join()
+            for loop in self.loops:
+                loop.close()
+            proxy.closeshared()
+            sock.close()
+
+    def stop(self):
+        """Stop the loops, can be called from other threads."""
+        for loop in self.loops:
+            loop.stop()
+
+    def wake(self):
+        """Wake the first loop to run the proxy's signalled work."""
+        loops = self.loops
+        if loops:
+            loops[0].ev.set()
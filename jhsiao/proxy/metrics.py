@@ -0,0 +1,219 @@
+"""Counters, gauges and histograms rendered as Prometheus text.
+
+Updates take a per-metric lock and do a constant amount of work so
+they can be called on every request.  Histograms have fixed buckets.
+"""
+__all__ = [
+    'Registry', 'Counter', 'Gauge', 'Histogram', 'render_snapshots',
+    'LATENCY_BUCKETS', 'BYTE_BUCKETS']
+import bisect
+import threading
+from collections import OrderedDict
+
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1, 2.5, 5, 10, 30)
+BYTE_BUCKETS = tuple([1 << shift for shift in range(10, 34, 2)])
+
+def _fmtvalue(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+def _fmtlabels(names, values, extra=None):
+    pairs = [
+        '{}="{}"'.format(name, str(value).replace('\\', r'\\').replace(
+            '"', r'\"').replace('\n', r'\n'))
+        for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(extra)
+    if pairs:
+        return '{' + ','.join(pairs) + '}'
+    return ''
+
+
+class Counter(object):
+    """A monotonically increasing value.
+
+    func: if given, called at render time for the value instead, for
+        totals another object already counts.
+    """
+    kind = 'counter'
+    def __init__(self, name, help, labelnames=(), func=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.func = func
+        self.lock = threading.Lock()
+        self.children = {}
+        self._init()
+
+    def _init(self):
+        self.value = 0
+
+    def _copy(self):
+        """Return an unlabeled metric of the same kind."""
+        return type(self)(self.name, self.help)
+
+    def labels(self, *values):
+        """Return the child metric for label values."""
+        child = self.children.get(values)
+        if child is None:
+            child = self._copy()
+            with self.lock:
+                child = self.children.setdefault(values, child)
+        return child
+
+    def inc(self, amt=1):
+        with self.lock:
+            self.value += amt
+
+    def _samples(self):
+        """Return list of (suffix, extra label, value)."""
+        if self.func is not None:
+            return [('', None, self.func())]
+        return [('', None, self.value)]
+
+    def samples(self):
+        """Return list of (suffix, formatted labels, value)."""
+        if self.labelnames:
+            with self.lock:
+                items = sorted(self.children.items())
+        else:
+            items = [((), self)]
+        ret = []
+        for values, child in items:
+            with child.lock:
+                samples = child._samples()
+            for suffix, extra, value in samples:
+                ret.append((
+                    suffix, _fmtlabels(self.labelnames, values, extra), value))
+        return ret
+
+    def render(self, lines):
+        """Append exposition lines to lines."""
+        _render(lines, self.name, self.help, self.kind, self.samples())
+
+def _render(lines, name, help, kind, samples):
+    lines.append('# HELP {} {}'.format(name, help))
+    lines.append('# TYPE {} {}'.format(name, kind))
+    for suffix, labels, value in samples:
+        lines.append('{}{}{} {}'.format(name, suffix, labels, _fmtvalue(value)))
+
+
+class Gauge(Counter):
+    """A value that can go up and down.
+
+    func: if given, called at render time for the value instead.
+    """
+    kind = 'gauge'
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+    def dec(self, amt=1):
+        with self.lock:
+            self.value -= amt
+
+
+class Histogram(Counter):
+    """Counts of observations in fixed cumulative buckets."""
+    kind = 'histogram'
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, labelnames=()):
+        self.bounds = list(sorted(buckets))
+        super(Histogram, self).__init__(name, help, labelnames)
+
+    def _copy(self):
+        return Histogram(self.name, self.help, self.bounds)
+
+    def _init(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[idx] += 1
+            self.sum += value
+
+    def _samples(self):
+        ret = []
+        total = 0
+        for bound, count in zip(self.bounds + [float('inf')], self.counts):
+            total += count
+            ret.append(('_bucket', 'le="{}"'.format(_fmtvalue(bound)), total))
+        ret.append(('_sum', None, self.sum))
+        ret.append(('_count', None, total))
+        return ret
+
+
+class Registry(object):
+    """A named collection of metrics.
+
+    counter(), gauge() and histogram() return the existing metric if
+    the name is already registered.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def _get(self, cls, name, *args, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, *args, **kwargs)
+            elif type(metric) is not cls:
+                raise ValueError('{} is already a {}'.format(name, metric.kind))
+            return metric
+
+    def counter(self, name, help, labelnames=(), func=None):
+        return self._get(Counter, name, help, labelnames, func)
+
+    def gauge(self, name, help, labelnames=(), func=None):
+        return self._get(Gauge, name, help, labelnames, func)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, labelnames=()):
+        return self._get(Histogram, name, help, buckets, labelnames)
+
+    def render(self):
+        """Return all metrics in Prometheus text format."""
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+        lines = []
+        for _, metric in metrics:
+            metric.render(lines)
+        lines.append('')
+        return '\n'.join(lines)
+
+    def snapshot(self):
+        """Return current values as a json-serializable dict."""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return dict([
+            (metric.name, dict(
+                help=metric.help, kind=metric.kind,
+                samples=metric.samples()))
+            for metric in metrics])
+
+def render_snapshots(snapshots):
+    """Render the sum of Registry.snapshot()s in Prometheus text format."""
+    merged = {}
+    for snapshot in snapshots:
+        for name, info in snapshot.items():
+            metric = merged.get(name)
+            if metric is None:
+                metric = merged[name] = (info, OrderedDict())
+            totals = metric[1]
+            for suffix, labels, value in info['samples']:
+                key = (suffix, labels)
+                totals[key] = totals.get(key, 0) + value
+    lines = []
+    for name, (info, totals) in sorted(merged.items()):
+        _render(
+            lines, name, info['help'], info['kind'],
+            [(suffix, labels, value) for (suffix, labels), value in totals.items()])
+    lines.append('')
+    return '\n'.join(lines)
@@ -1,51 +1,175 @@
 from __future__ import print_function
-__all__ = ['MultiForwarder']
-import io
+__all__ = ['MultiForwarder', 'ShardedForwarder']
+import errno
+import os
+import select
+import socket
+import struct
 import threading
-import traceback
 import time
+import traceback
+from collections import deque
+
+from jhsiao.ipc import polling, pollable, sockets
+
+from .slabs import SlabPool
 
-from jhsiao.ipc import polling, pollable
+try:
+    _splice = os.splice
+    _SPLICE_FLAGS = os.SPLICE_F_MOVE|os.SPLICE_F_NONBLOCK
+except AttributeError:
+    _splice = None
+try:
+    import fcntl
+    _F_SETPIPE_SZ = fcntl.F_SETPIPE_SZ
+except (ImportError, AttributeError):
+    _F_SETPIPE_SZ = None
 
 class Forwarder(object):
-    """Class for 1-direction forwarding."""
-    def __init__(self, src, dst):
+    """Class for 1-direction forwarding.
+
+    Data is read into slabs from a SlabPool and written to dst without
+    blocking.  Slabs are returned as soon as their data is written.
+    While bufsize bytes are buffered or the pool is over budget, src is
+    not polled for reading so a slow dst only stalls its own source.
+    """
+    readsize = 0x40000
+    def __init__(self, src, dst, bufsize=0x40000, pool=None):
+        """Initialize.
+
+        pool: SlabPool to buffer from, None for an unlimited one.
+        """
         self.src = src
-        self.fileno = src.fileno
-        self.readinto = src.readinto
         self.dst = dst
-        self.o = io.BufferedWriter(dst)
-        self.flushtime = None
-        self.flush = self.o.flush
-        self.write = self.o.write
+        self.sfd = src.fileno()
+        self.dfd = dst.fileno()
+        os.set_blocking(self.sfd, False)
+        os.set_blocking(self.dfd, False)
+        self.eof = False
+        self.nbytes = 0
+        self.pool = SlabPool() if pool is None else pool
+        self.bufsize = bufsize
+        self.peak = 0
+        self.throttled = False
+        self.wake = None
+        self.started = time.time()
+        self._initbuf()
+
+    def _initbuf(self):
+        self.slabs = deque()
+        # start: offset in first slab, end: offset in last slab
+        self.start = self.end = 0
+        self.size = 0
 
     def __repr__(self):
         return '{}->{}'.format(self.src.name, self.dst.name)
 
-    def __call__(self, multi, flushtime):
-        """Forward a chunk.
+    def pending(self):
+        """Return number of buffered bytes not yet written."""
+        return self.size
 
-        buf: buffer to use for forwarding.
-        flushtime: timeout for flushing.
-        Return True if failure (src closed or failed to write to dst).
-        """
-        buf = multi._buf
+    def wantread(self):
+        return not self.eof and not self.throttled and self.pending() < self.bufsize
+
+    def wantwrite(self):
+        return self.pending() > 0
+
+    def finished(self):
+        return self.eof and not self.pending()
+
+    def _fill(self):
+        """Read once from src into the buffer."""
+        if not self.wantread():
+            return
+        pool = self.pool
+        slabsize = pool.slabsize
+        slabs = self.slabs
+        iov = []
+        if slabs and self.end < slabsize:
+            iov.append(memoryview(slabs[-1])[self.end:])
+        space = len(iov[0]) if iov else 0
+        want = min(self.bufsize - self.size, self.readsize) - space
+        fresh = []
+        if want > 0:
+            fresh = pool.acquire(-(-want // slabsize), None if iov else self.wake)
+            if not fresh and not iov:
+                # Over budget, wait for self.wake to be called.
+                self.throttled = True
+                return
+            iov.extend(fresh)
+        amt = None
         try:
-            amt = self.readinto(buf)
-        except Exception:
-            traceback.print_exc()
-            return True
-        if amt:
-            try:
-                self.write(buf[:amt])
-            except Exception:
-                traceback.print_exc()
-                return True
-            multi._wpending.add(self)
-            self.flushtime = flushtime
-            return False
+            amt = os.readv(self.sfd, iov)
+        except (BlockingIOError, InterruptedError):
+            pass
+        finally:
+            rest = 0
+            if amt:
+                rest = amt
+                if slabs and self.end < slabsize:
+                    taken = min(amt, slabsize - self.end)
+                    self.end += taken
+                    rest -= taken
+                self.size += amt
+                if self.size > self.peak:
+                    self.peak = self.size
+            used = -(-rest // slabsize)
+            if used:
+                slabs.extend(fresh[:used])
+                self.end = rest - (used - 1) * slabsize
+            if used < len(fresh):
+                pool.release(fresh[used:])
+        if amt == 0:
+            self.eof = True
+
+    def _drain(self):
+        """Write once from the buffer to dst."""
+        slabs = self.slabs
+        if not slabs:
+            return
+        if len(slabs) == 1:
+            iov = [memoryview(slabs[0])[self.start:self.end]]
         else:
-            return True
+            iov = list(slabs)
+            iov[0] = memoryview(iov[0])[self.start:]
+            iov[-1] = memoryview(iov[-1])[:self.end]
+        try:
+            amt = os.writev(self.dfd, iov)
+        except (BlockingIOError, InterruptedError):
+            return
+        self.nbytes += amt
+        self.size -= amt
+        if not self.size:
+            self.release()
+            return
+        start = self.start + amt
+        slabsize = self.pool.slabsize
+        if start >= slabsize:
+            done = [slabs.popleft() for _ in range(start // slabsize)]
+            start %= slabsize
+            self.pool.release(done)
+        self.start = start
+
+    def release(self):
+        """Return all slabs to the pool, dropping unwritten data."""
+        if self.slabs:
+            self.pool.release(list(self.slabs))
+        self._initbuf()
+
+    def readable(self):
+        """Read src and write what can be written.
+
+        Return True if finished (src closed and buffer drained).
+        """
+        self._fill()
+        if self.pending():
+            self._drain()
+        return self.finished()
+
+    def writable(self):
+        """Write buffered data, return True if finished."""
+        self._drain()
+        return self.finished()
 
     def close(self, multi):
         """Close a forwarder.
@@ -55,67 +179,200 @@ class Forwarder(object):
         """
         src = self.src
         dst = self.dst
-        try:
-            multi._poller.unregister(self)
-        except Exception:
-            traceback.print_exc()
-        try:
-            self.flush()
-        except Exception:
-            traceback.print_exc()
+        self.release()
+        if multi.tunnelbytes is not None:
+            multi.tunnelbytes.observe(self.nbytes)
+        if multi.tunnelpeak is not None:
+            multi.tunnelpeak.observe(self.peak)
+        if multi.tracer is not None:
+            multi.tracer.span(
+                'tunnel', self.started, time.time(), 'tunnel',
+                direction=repr(self), bytes=self.nbytes, peak=self.peak)
         with multi.lock:
-            srcs = multi.srcs
-            dsts = multi.dsts
-            sfd = src.fileno()
-            dfd = dst.fileno()
-            multi._wpending.discard(self)
-            srcs.pop(sfd, None)
-            dsts.discard(dfd)
-            dst_is_src = dfd in srcs
-            src_is_dst = sfd in dsts
-        if src_is_dst:
+            multi.srcs.pop(self.sfd, None)
+            multi.dsts.discard(self.dfd)
+        multi._throttled.discard(self)
+        srcend = multi._endpoints.get(self.sfd)
+        dstend = multi._endpoints.get(self.dfd)
+        if srcend is not None and srcend.out is self:
+            srcend.out = None
+        if dstend is not None and dstend.into is self:
+            dstend.into = None
+        if srcend is not None and srcend.into is not None:
             print('shut down src', src.name)
             try:
                 src.shutdown(src.SHUT_RD)
             except Exception:
                 traceback.print_exc()
-        else:
-            try:
-                print('closing src', src.name)
-                src.close()
-            except Exception:
-                pass
-        if dst_is_src:
+        if dstend is not None and dstend.out is not None:
             print('shut down dst', dst.name)
-            try:
-                self.o.detach()
-            except Exception:
-                traceback.print_exc()
             try:
                 dst.shutdown(dst.SHUT_WR)
             except Exception:
                 traceback.print_exc()
+        for end in (srcend, dstend):
+            if end is not None:
+                multi._update(end)
+
+class SpliceForwarder(Forwarder):
+    """Forward through a pipe with splice(2).
+
+    Data moves socket->pipe->socket inside the kernel and never enters
+    python memory.  The pipe is the bounded buffer.  Space in the pipe
+    is reserved from the pool in slabs so the budget covers it too,
+    and given back when the pipe is empty.  Falls back to Forwarder
+    behavior if the fds do not support splice.
+    """
+    def __init__(self, src, dst, bufsize=0x40000, pool=None):
+        super(SpliceForwarder, self).__init__(src, dst, bufsize, pool)
+        self.pr, self.pw = os.pipe()
+        size = bufsize
+        if _F_SETPIPE_SZ is not None:
+            try:
+                size = fcntl.fcntl(self.pw, _F_SETPIPE_SZ, bufsize)
+            except OSError:
+                size = 0x10000
         else:
+            size = 0x10000
+        self.pipesize = size
+        self.inpipe = 0
+        self.credit = 0
+
+    def pending(self):
+        return self.inpipe
+
+    def wantread(self):
+        return not self.eof and not self.throttled and self.inpipe < self.pipesize
+
+    def _fallback(self):
+        """Switch to buffered forwarding, keeping data in the pipe."""
+        data = b''
+        if self.inpipe:
+            data = os.read(self.pr, self.inpipe)
+        self._closepipe()
+        pool = self.pool
+        slabsize = pool.slabsize
+        # Reservations become the slabs holding the pipe's data.
+        used = -(-len(data) // slabsize)
+        slabs = pool.fill(used)
+        pool.release(reserved=self.credit // slabsize - used)
+        self.credit = 0
+        self.__class__ = Forwarder
+        self._initbuf()
+        for idx, slab in enumerate(slabs):
+            chunk = data[idx*slabsize:(idx+1)*slabsize]
+            slab[:len(chunk)] = chunk
+            self.end = len(chunk)
+        self.slabs.extend(slabs)
+        self.size = len(data)
+
+    def release(self):
+        if self.credit:
+            self.pool.release(reserved=self.credit // self.pool.slabsize)
+            self.credit = 0
+        self.inpipe = 0
+        super(SpliceForwarder, self).release()
+
+    def _fill(self):
+        if not self.wantread():
+            return
+        pool = self.pool
+        slabsize = pool.slabsize
+        want = min(self.pipesize, self.inpipe + self.readsize)
+        if self.credit < want:
+            self.credit += pool.reserve(
+                -(-(want - self.credit) // slabsize),
+                self.wake if self.credit <= self.inpipe else None) * slabsize
+            if self.credit <= self.inpipe:
+                # Over budget, wait for self.wake to be called.
+                self.throttled = True
+                return
+        try:
+            amt = _splice(
+                self.sfd, self.pw, min(self.pipesize, self.credit) - self.inpipe,
+                flags=_SPLICE_FLAGS)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            if e.errno == errno.EINVAL:
+                # fds do not support splice, use regular forwarding.
+                self._fallback()
+                return Forwarder._fill(self)
+            raise
+        if amt:
+            self.inpipe += amt
+            if self.inpipe > self.peak:
+                self.peak = self.inpipe
+        else:
+            self.eof = True
+
+    def _drain(self):
+        try:
+            amt = _splice(self.pr, self.dfd, self.inpipe, flags=_SPLICE_FLAGS)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            if e.errno == errno.EINVAL:
+                self._fallback()
+                return Forwarder._drain(self)
+            raise
+        self.nbytes += amt
+        self.inpipe -= amt
+        if not self.inpipe:
+            self.release()
+
+    def _closepipe(self):
+        for fd in (self.pr, self.pw):
             try:
-                print('closing dst', dst.name)
-                self.o.close()
+                os.close(fd)
             except Exception:
                 traceback.print_exc()
 
+    def close(self, multi):
+        """Close forwarder and its pipe."""
+        super(SpliceForwarder, self).close(multi)
+        self._closepipe()
+
+class Endpoint(object):
+    """A forwarded file, polled for its forwarders.
+
+    out: Forwarder reading from the file.
+    into: Forwarder writing to the file.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.fileno = f.fileno
+        self.out = None
+        self.into = None
+        self.flags = None
+
+    def readable(self, multi):
+        """Return the forwarder to update, if any."""
+        return self.out
+
+    def writable(self, multi):
+        return self.into
+
 class StopForwarding(Exception):
     pass
 class Event(pollable.Pollable):
-    def __call__(self, multi, flushtime):
+    def readable(self, multi):
         with multi.lock:
             self.clear()
             if not multi.running:
                 raise StopForwarding()
-            poller = multi._poller
-            for f in multi.pending:
-                print('adding', f)
-                poller.register(f, 'r')
+            pending = list(multi.pending)
             del multi.pending[:]
-        return False
+            unthrottle = multi.unthrottle
+            multi.unthrottle = False
+        for f in pending:
+            print('adding', f)
+            multi._start(f)
+        if unthrottle:
+            multi._unthrottle()
+
+    def writable(self, multi):
+        pass
 
     def close(self, multi=None):
         if multi is not None:
@@ -126,20 +383,50 @@ class Event(pollable.Pollable):
         super(Event, self).close()
 class MultiForwarder(object):
     """Forward data from multiple pairs."""
-    def __init__(self, flushdelay=0.01):
+    def __init__(
+            self, bufsize=0x40000, splice=None, tunnelbytes=None,
+            budget=None, slabsize=0x4000, pool=None, tunnelpeak=None,
+            tracer=None):
+        """Initialize.
+
+        bufsize: max bytes buffered per direction.  Reading from a
+            source pauses while its buffer is full.
+        splice: use splice(2) forwarding.  None to use it if available.
+        tunnelbytes: metrics.Histogram to observe the bytes forwarded
+            in each direction when it closes.
+        budget: max bytes buffered by all directions together, None
+            for no limit.  Reading pauses while it is used up.
+        slabsize: size of the buffers directions take from the budget.
+        pool: SlabPool to share with other forwarders instead of
+            budget and slabsize.
+        tunnelpeak: metrics.Histogram to observe the most bytes each
+            direction had buffered when it closes.
+        tracer: tracing.Tracer to record a span for each direction
+            when it closes.
+        """
+        if splice is None:
+            splice = _splice is not None
+        elif splice and _splice is None:
+            raise ValueError('splice is not supported on this platform')
+        self.forwarder = SpliceForwarder if splice else Forwarder
+        self.bufsize = bufsize
+        self.pool = SlabPool(budget, slabsize) if pool is None else pool
+        self.tunnelbytes = tunnelbytes
+        self.tunnelpeak = tunnelpeak
+        self.tracer = tracer
         self.lock = threading.Lock()
         self.pending = []
+        self.unthrottle = False
         self.ev = Event()
         self.running = True
         self.srcs = {}
         self.dsts = set()
         self.t = threading.Thread(target=self.loop)
         # loop-only variables
-        self._flushdelay = flushdelay
         self._poller = polling.Poller()
         self._poller.register(self.ev, 'r')
-        self._wpending = set()
-        self._buf = memoryview(bytearray(io.DEFAULT_BUFFER_SIZE))
+        self._endpoints = {}
+        self._throttled = set()
         self.t.start()
 
     def add(self, f1, f2, duplex=True):
@@ -154,40 +441,136 @@ class MultiForwarder(object):
                 elif src.fileno() in self.srcs:
                     raise ValueError('Already forwarding from {}'.format(src.name))
             for src, dst in pairs:
-                f = Forwarder(src, dst)
+                f = self.forwarder(src, dst, self.bufsize, self.pool)
+                f.wake = self._wake
                 self.pending.append(f)
                 self.srcs[src.fileno()] = f
                 self.dsts.add(dst.fileno())
             self.ev.set()
 
+    def load(self):
+        """Return number of forwarded directions."""
+        return len(self.srcs)
+
+    def buffered(self):
+        """Return (current, peak) bytes charged to the budget.
+
+        This is slabs holding data plus splice pipe space reserved.
+        """
+        pool = self.pool
+        return pool.inuse, pool.peak
+
+    def tunnels(self):
+        """Return list of (name, buffered, peak) per direction."""
+        with self.lock:
+            forwarders = list(self.srcs.values())
+        return [(repr(f), f.pending(), f.peak) for f in forwarders]
+
+    def _wake(self):
+        """Called by the pool when slabs are released."""
+        with self.lock:
+            if self.running:
+                self.unthrottle = True
+                self.ev.set()
+
+    def _unthrottle(self):
+        """Poll throttled forwarders for reading again."""
+        throttled = self._throttled
+        self._throttled = set()
+        for f in throttled:
+            f.throttled = False
+            end = self._endpoints.get(f.sfd)
+            if end is not None:
+                self._update(end)
+
+    def _endpoint(self, f):
+        end = self._endpoints.get(f.fileno())
+        if end is None:
+            end = self._endpoints[f.fileno()] = Endpoint(f)
+        return end
+
+    def _start(self, f):
+        """Start polling for a new forwarder."""
+        self._endpoint(f.src).out = f
+        self._endpoint(f.dst).into = f
+        self._update(self._endpoints[f.sfd])
+        self._update(self._endpoints[f.dfd])
+
+    def _update(self, end):
+        """Poll end for what its forwarders need.
+
+        Close it if it is no longer used.
+        """
+        poller = self._poller
+        if end.out is None and end.into is None:
+            if end.flags is not None:
+                try:
+                    poller.unregister(end)
+                except Exception:
+                    traceback.print_exc()
+            self._endpoints.pop(end.fileno(), None)
+            try:
+                print('closing', end.f.name)
+                end.f.close()
+            except Exception:
+                traceback.print_exc()
+            return
+        flags = 0
+        if end.out is not None and end.out.wantread():
+            flags |= poller.RFLAGS
+        if end.into is not None and end.into.wantwrite():
+            flags |= poller.WFLAGS
+        flags = flags or None
+        if flags == end.flags:
+            return
+        try:
+            if flags is None:
+                poller.unregister(end)
+            elif end.flags is None:
+                poller.register(end, flags)
+            else:
+                poller.modify(end, flags)
+        except Exception:
+            traceback.print_exc()
+        end.flags = flags
+
+    def _dispatch(self, items, method):
+        """Call method of forwarders for items, return touched ones."""
+        touched = set()
+        for item in items:
+            f = getattr(item, method)(self)
+            if f is None or f in touched:
+                continue
+            touched.add(f)
+            try:
+                if getattr(f, method)():
+                    f.close(self)
+                    continue
+            except OSError:
+                # EPIPE, ECONNRESET and such: an end went away.
+                f.close(self)
+                continue
+            except Exception:
+                traceback.print_exc()
+                f.close(self)
+                continue
+            if f.throttled:
+                self._throttled.add(f)
+            self._update(self._endpoints[f.sfd])
+            self._update(self._endpoints[f.dfd])
+        return touched
+
     def loop(self):
         poller = self._poller
-        flushdelay = self._flushdelay
-        wpending = self._wpending
-        ptime = None
         try:
             while 1:
-                r, w, x = poller.poll(ptime)
-                now = time.time()
-                if r:
-                    endtime = now + flushdelay
-                    toremove = [item for item in r if item(self, endtime)]
-                    for thing in toremove:
-                        thing.close(self)
-                else:
-                    endtime = None
-                for f in wpending.difference(r):
-                    tm = f.flushtime
-                    if tm <= now:
-                        try:
-                            f.flush()
-                        except Exception:
-                            f.close(self)
-                        else:
-                            wpending.discard(f)
-                    elif endtime is None or tm < endtime:
-                        endtime = tm
-                ptime = None if endtime is None else endtime - now
+                r, w, x = poller.poll(None)
+                self._dispatch(r, 'readable')
+                self._dispatch(w, 'writable')
+                if x:
+                    # errors and hangups, let the reads/writes report them
+                    self._dispatch(x, 'readable')
+                    self._dispatch(x, 'writable')
         except StopForwarding:
             print('loop exit')
         except Exception:
@@ -201,7 +584,15 @@ class MultiForwarder(object):
                 toclose.extend(self.srcs.values())
                 self.srcs.clear()
             for f in toclose:
-                f.close(self)
+                self._endpoint(f.src)
+                self._endpoint(f.dst)
+            for end in list(self._endpoints.values()):
+                end.out = end.into = None
+                self._update(end)
+            for f in toclose:
+                f.release()
+                if isinstance(f, SpliceForwarder):
+                    f._closepipe()
             poller.unregister(self.ev)
             self.ev.close()
             poller.close()
@@ -217,3 +608,199 @@ class MultiForwarder(object):
 
     def __del__(self):
         self.close()
+
+def _shardmain(sock, kwargs, interval=1):
+    """Run a MultiForwarder for pairs received over sock.
+
+    A reply of (adds, load, current, peak) is sent after each add and
+    whenever the load or buffering changed in the last interval seconds,
+    so closed tunnels are reported too.
+    """
+    from multiprocessing.reduction import recvfds
+    multi = MultiForwarder(**kwargs)
+    adds = 0
+    last = None
+    try:
+        while 1:
+            if select.select([sock], (), (), interval)[0]:
+                duplex = sock.recv(1)
+                if not duplex:
+                    break
+                files = [
+                    sockets.Sockfile(socket.socket(fileno=fd), 'rwb')
+                    for fd in recvfds(sock, 2)]
+                try:
+                    multi.add(files[0], files[1], duplex == b'd')
+                except Exception:
+                    traceback.print_exc()
+                    for f in files:
+                        f.close()
+                adds += 1
+            reply = (adds, multi.load()) + tuple(multi.buffered())
+            if reply != last:
+                sock.sendall(ProcessShard.loadstruct.pack(*reply))
+                last = reply
+    finally:
+        multi.close()
+        sock.close()
+
+class ProcessShard(object):
+    """A MultiForwarder running in a separate process.
+
+    Pairs are sent to the child with SCM_RIGHTS and closed in this
+    process.  The child answers each add with its load and buffered
+    bytes and reports them again when tunnels close.
+    """
+    loadstruct = struct.Struct('>LLQQ')
+    def __init__(self, **kwargs):
+        import multiprocessing
+        from multiprocessing.reduction import sendfds
+        self._sendfds = sendfds
+        self.sock, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        ctx = multiprocessing.get_context('spawn')
+        self.p = ctx.Process(target=_shardmain, args=(child, kwargs))
+        self.p.daemon = True
+        self.p.start()
+        child.close()
+        self.lock = threading.Lock()
+        self._load = 0
+        self._buffered = (0, 0)
+        self._unanswered = deque()
+        self._answered = 0
+        self._reply = b''
+
+    def load(self):
+        """Return load estimate: last reported load plus unanswered adds."""
+        with self.lock:
+            self._readloads()
+            return self._load + sum(self._unanswered)
+
+    def buffered(self):
+        """Return (current, peak) buffered bytes as last reported."""
+        with self.lock:
+            self._readloads()
+            return self._buffered
+
+    def tunnels(self):
+        """Per direction buffering is not reported across processes."""
+        return []
+
+    def _readloads(self):
+        size = self.loadstruct.size
+        data = self._reply
+        while 1:
+            try:
+                chunk = self.sock.recv(0x1000, socket.MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                break
+            if not chunk:
+                break
+            data += chunk
+        nreplies = len(data) // size
+        if nreplies:
+            reply = self.loadstruct.unpack_from(data, (nreplies-1)*size)
+            adds, self._load = reply[:2]
+            self._buffered = reply[2:]
+            for _ in range(adds - self._answered):
+                self._unanswered.popleft()
+            self._answered = adds
+        self._reply = data[nreplies*size:]
+
+    def add(self, f1, f2, duplex=True):
+        """Send Sockfiles to the child and close them here."""
+        with self.lock:
+            if self.sock is None:
+                raise RuntimeError('Cannot add if shard has stopped.')
+            self.sock.sendall(b'd' if duplex else b's')
+            self._sendfds(self.sock, [f1.fileno(), f2.fileno()])
+            self._unanswered.append(2 if duplex else 1)
+            self._readloads()
+        f1.close()
+        f2.close()
+
+    def close(self):
+        with self.lock:
+            if self.sock is None:
+                return
+            try:
+                self.sock.shutdown(socket.SHUT_WR)
+            except Exception:
+                traceback.print_exc()
+        self.p.join()
+        with self.lock:
+            self.sock.close()
+            self.sock = None
+
+class ShardedForwarder(object):
+    """Spread forwarding pairs across multiple forwarding loops.
+
+    Each shard is a MultiForwarder with its own thread (or process),
+    poller and buffers.
+    """
+    def __init__(self, shards=2, placement='least', processes=False, **kwargs):
+        """Initialize.
+
+        shards: number of shards.
+        placement: 'least' to add to the shard with least load, 'hash'
+            to choose by hash of the first file's name.
+        processes: run shards in separate processes.  tunnelbytes,
+            tunnelpeak and tracer are ignored, metrics are not
+            collected across processes.  Each process gets an equal
+            part of budget.
+        kwargs: MultiForwarder kwargs.  Thread shards share one
+            budget.
+        """
+        if placement not in ('least', 'hash'):
+            raise ValueError('Unknown placement {!r}'.format(placement))
+        self.placement = placement
+        budget = kwargs.pop('budget', None)
+        slabsize = kwargs.pop('slabsize', 0x4000)
+        if processes:
+            kwargs.pop('tunnelbytes', None)
+            kwargs.pop('tunnelpeak', None)
+            kwargs.pop('tracer', None)
+            if budget is not None:
+                budget = max(budget // shards, slabsize)
+            kwargs.update(budget=budget, slabsize=slabsize)
+        elif 'pool' not in kwargs:
+            kwargs['pool'] = SlabPool(budget, slabsize)
+        cls = ProcessShard if processes else MultiForwarder
+        self.shards = [cls(**kwargs) for _ in range(shards)]
+
+    def _pick(self, f):
+        shards = self.shards
+        if self.placement == 'hash':
+            return shards[hash(f.name) % len(shards)]
+        return min(shards, key=lambda shard: shard.load())
+
+    def add(self, f1, f2, duplex=True):
+        """Add Sockfiles to a shard."""
+        self._pick(f1).add(f1, f2, duplex)
+
+    def load(self):
+        return sum([shard.load() for shard in self.shards])
+
+    def buffered(self):
+        """Return (current, peak) bytes buffered by all shards.
+
+        With process shards, peak is the sum of the shards' peaks.
+        """
+        pool = getattr(self.shards[0], 'pool', None)
+        if pool is not None:
+            return pool.inuse, pool.peak
+        current = peak = 0
+        for shard in self.shards:
+            c, p = shard.buffered()
+            current += c
+            peak += p
+        return current, peak
+
+    def tunnels(self):
+        ret = []
+        for shard in self.shards:
+            ret.extend(shard.tunnels())
+        return ret
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
@@ -0,0 +1,88 @@
+"""Indexed network matching.
+
+Networks are stored in a binary radix trie per address size so a lookup
+walks at most one node per prefix bit instead of scanning every
+network.
+"""
+__all__ = ['NetTrie']
+
+_CHILD0 = 0
+_CHILD1 = 1
+_TERMINAL = 2
+
+class NetTrie(object):
+    """Binary trie of ipv4 and ipv6 networks.
+
+    Addresses are given as sequences of ints like Server.ip2nums: one
+    32-bit int for ipv4, two 64-bit ints for ipv6.
+    """
+    def __init__(self, nets=()):
+        """Initialize.
+
+        nets: sequence of (nums, prefixbits)
+        """
+        self.roots = {}
+        self.size = 0
+        for nums, nbits in nets:
+            self.add(nums, nbits)
+
+    @staticmethod
+    def _flatten(nums):
+        """Convert nums to (int value, bitcount)."""
+        if len(nums) == 1:
+            return nums[0], 32
+        else:
+            return (nums[0] << 64) | nums[1], 128
+
+    def add(self, nums, nbits):
+        """Add network nums/nbits."""
+        value, total = self._flatten(nums)
+        nbits = max(0, min(nbits, total))
+        node = self.roots.get(len(nums))
+        if node is None:
+            node = self.roots[len(nums)] = [None, None, False]
+        shift = total - 1
+        for _ in range(nbits):
+            if node[_TERMINAL]:
+                # Already covered by a shorter prefix.
+                return
+            bit = (value >> shift) & 1
+            child = node[bit]
+            if child is None:
+                child = node[bit] = [None, None, False]
+            node = child
+            shift -= 1
+        if not node[_TERMINAL]:
+            self.size += 1 - self._count(node)
+            node[_TERMINAL] = True
+            node[_CHILD0] = node[_CHILD1] = None
+
+    @classmethod
+    def _count(cls, node):
+        """Count networks under node."""
+        if node is None:
+            return 0
+        elif node[_TERMINAL]:
+            return 1
+        return cls._count(node[_CHILD0]) + cls._count(node[_CHILD1])
+
+    def match(self, nums):
+        """Return whether nums is in any network."""
+        node = self.roots.get(len(nums))
+        if node is None:
+            return False
+        value, shift = self._flatten(nums)
+        while not node[_TERMINAL]:
+            shift -= 1
+            node = node[(value >> shift) & 1]
+            if node is None:
+                return False
+        return True
+
+    def __len__(self):
+        """Number of networks not covered by a shorter prefix."""
+        return self.size
+
+    def __bool__(self):
+        return bool(self.roots)
+    __nonzero__ = __bool__
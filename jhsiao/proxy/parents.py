@@ -0,0 +1,191 @@
+"""Parent proxies chosen by consistent hashing.
+
+Each destination maps to a point on a hash ring with many points per
+parent (proportional to its weight), so every destination goes to the
+same parent and the parents' caches do not hold copies of the same
+objects.  When a parent is down its destinations move to the next
+parents on the ring and the rest stay put.
+
+Parents are marked down after consecutive failed requests or connects
+and checked with a tcp connect in the background until they answer.
+The checks are what bring a parent back, so they cannot be turned off.
+"""
+from __future__ import print_function
+__all__ = ['Parent', 'ParentSet', 'connectrequest', 'parsestatus']
+import bisect
+import hashlib
+import struct
+import threading
+import traceback
+
+from .resolver import Resolver
+
+def _hash(key):
+    return struct.unpack_from(
+        '>Q', hashlib.md5(key.encode('utf-8')).digest())[0]
+
+def connectrequest(host, port):
+    """Return a CONNECT request head for host:port."""
+    if ':' in host:
+        host = '[{}]'.format(host)
+    return 'CONNECT {0}:{1} HTTP/1.1\r\nHost: {0}:{1}\r\n\r\n'.format(
+        host, port).encode('utf-8')
+
+def parsestatus(head):
+    """Return (code, reason) from a response head."""
+    parts = head.split(b'\r\n', 1)[0].decode('latin-1').split(None, 2)
+    try:
+        code = int(parts[1])
+    except (IndexError, ValueError):
+        raise ValueError('Bad status line {!r}'.format(head[:80]))
+    return code, parts[2] if len(parts) > 2 else ''
+
+class Parent(object):
+    """A parent proxy."""
+    def __init__(self, host, port, weight=1):
+        self.host = host
+        self.port = port
+        self.weight = weight
+        self.healthy = True
+        self.fails = 0
+        hostname = '[{}]'.format(host) if ':' in host else host
+        self.url = 'http://{}:{}'.format(hostname, port)
+
+    @classmethod
+    def parse(cls, spec):
+        """Parse 'host:port' or 'host:port=weight'."""
+        weight = 1
+        if '=' in spec:
+            spec, weight = spec.rsplit('=', 1)
+            weight = float(weight)
+        host, port = spec.rsplit(':', 1)
+        return cls(host.strip('[]'), int(port), weight)
+
+    def __repr__(self):
+        return '{}:{}'.format(self.host, self.port)
+
+
+class ParentSet(object):
+    """Choose parent proxies per destination."""
+    def __init__(
+            self, parents, vnodes=100, maxfails=3, interval=5, timeout=2,
+            resolver=None, log=print):
+        """Initialize.
+
+        parents: Parents or specs for Parent.parse().
+        vnodes: ring points for a parent of weight 1.
+        maxfails: consecutive failures to mark a parent down.
+        interval: seconds between health checks, must be positive.
+        timeout: health check connect timeout.
+        resolver: Resolver for health check connects.
+        log: called with a message when a parent goes down or up.
+        """
+        if not interval > 0:
+            raise ValueError('Bad health check interval {!r}'.format(interval))
+        self.parents = [
+            Parent.parse(p) if isinstance(p, str) else p for p in parents]
+        if not self.parents:
+            raise ValueError('No parents')
+        ring = []
+        for parent in self.parents:
+            for idx in range(max(1, int(round(vnodes * parent.weight)))):
+                ring.append((_hash('{!r}-{}'.format(parent, idx)), parent))
+        ring.sort(key=lambda point: point[0])
+        self.points = [point for point, _ in ring]
+        self.ring = [parent for _, parent in ring]
+        self.nhealthy = len(self.parents)
+        self.maxfails = maxfails
+        self.interval = interval
+        self.timeout = timeout
+        self.resolver = Resolver() if resolver is None else resolver
+        self.log = log
+        self.lock = threading.Lock()
+        self.counts = dict(selected=0, failed=0, down=0, up=0, nohealthy=0)
+        self._stop = threading.Event()
+        self.t = None
+
+    def select(self, key):
+        """Return the healthy parent for destination key, or None."""
+        ring = self.ring
+        idx = bisect.bisect(self.points, _hash(key))
+        n = len(ring)
+        with self.lock:
+            if not self.nhealthy:
+                self.counts['nohealthy'] += 1
+                return None
+            self.counts['selected'] += 1
+            for offset in range(n):
+                parent = ring[(idx + offset) % n]
+                if parent.healthy:
+                    return parent
+
+    def failed(self, parent):
+        """A request or connect through parent failed."""
+        down = False
+        with self.lock:
+            self.counts['failed'] += 1
+            parent.fails += 1
+            if parent.healthy and parent.fails >= self.maxfails:
+                parent.healthy = False
+                self.nhealthy -= 1
+                self.counts['down'] += 1
+                down = True
+        if down:
+            self.log('parent', parent, 'down')
+
+    def succeeded(self, parent):
+        up = False
+        with self.lock:
+            parent.fails = 0
+            if not parent.healthy:
+                parent.healthy = True
+                self.nhealthy += 1
+                self.counts['up'] += 1
+                up = True
+        if up:
+            self.log('parent', parent, 'up')
+
+    def check(self):
+        """Connect to every parent once and update their health.
+
+        A failed connect marks a parent down at once.
+        """
+        for parent in self.parents:
+            try:
+                sock = self.resolver.connect(
+                    parent.host, parent.port, self.timeout)
+            except Exception:
+                with self.lock:
+                    parent.fails = max(parent.fails, self.maxfails - 1)
+                self.failed(parent)
+            else:
+                sock.close()
+                self.succeeded(parent)
+
+    def _checkloop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                traceback.print_exc()
+
+    def start(self):
+        """Start health checks in a background thread."""
+        if self.t is None:
+            self._stop.clear()
+            self.t = threading.Thread(target=self._checkloop)
+            self.t.daemon = True
+            self.t.start()
+
+    def close(self):
+        self._stop.set()
+        if self.t is not None:
+            self.t.join()
+            self.t = None
+
+    def stats(self):
+        """Return dict of counts and healthy parents."""
+        with self.lock:
+            ret = dict(self.counts)
+            ret['healthy'] = [repr(p) for p in self.parents if p.healthy]
+        return ret
@@ -0,0 +1,153 @@
+"""Profile a running proxy for a while.
+
+The stacks of all threads are sampled with sys._current_frames() so no
+thread has to install a profiler, and allocations are traced with
+tracemalloc for the same period.  Samples are wall clock: threads
+waiting in poll or on the queue show up where they wait.
+
+Results are written as a folded stacks file (one "thread;outer;...;inner
+count" line per stack, for flame graph tools) and a text report of the
+top functions and allocation growth.
+"""
+from __future__ import division, print_function
+__all__ = ['Profiler', 'sample']
+from collections import Counter
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import traceback
+
+def sample(seconds, interval=0.005):
+    """Return Counter of stacks of the other threads.
+
+    Stacks are tuples from the thread name to the innermost frame.
+    """
+    me = threading.get_ident()
+    labels = {}
+    counts = Counter()
+    end = time.time() + seconds
+    while time.time() < end:
+        names = dict([(t.ident, t.name) for t in threading.enumerate()])
+        for tid, frame in sys._current_frames().items():
+            if tid == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                label = labels.get(code)
+                if label is None:
+                    label = labels[code] = '{} ({}:{})'.format(
+                        code.co_name, os.path.basename(code.co_filename),
+                        code.co_firstlineno)
+                stack.append(label)
+                frame = frame.f_back
+            stack.append(names.get(tid, str(tid)))
+            stack.reverse()
+            counts[tuple(stack)] += 1
+        time.sleep(interval)
+    return counts
+
+class Profiler(object):
+    """Sample stacks and trace allocations in a background thread."""
+    def __init__(self, outdir=None, interval=0.005, top=30, log=print):
+        """Initialize.
+
+        outdir: directory for results, default the temp directory.
+        interval: seconds between stack samples.
+        top: number of functions and allocation sites to report.
+        log: called with a message when results are written.
+        """
+        self.outdir = tempfile.gettempdir() if outdir is None else outdir
+        self.interval = interval
+        self.top = top
+        self.log = log
+        self.lock = threading.Lock()
+        self.t = None
+        self.report = None
+
+    def start(self, seconds):
+        """Profile for seconds.
+
+        Return the paths of the folded stacks and report files, or None
+        if already profiling.  Raise ValueError if seconds is not a
+        positive number.
+        """
+        if not 0 < seconds < float('inf'):
+            raise ValueError('Bad profile seconds {!r}'.format(seconds))
+        with self.lock:
+            if self.t is not None:
+                return None
+            base = os.path.join(self.outdir, 'proxy-{}-{}'.format(
+                os.getpid(), time.strftime('%Y%m%d-%H%M%S')))
+            paths = (base + '.folded', base + '.txt')
+            self.t = threading.Thread(
+                target=self._run, args=(seconds, paths), name='profiler')
+            self.t.daemon = True
+            self.t.start()
+        return paths
+
+    def running(self):
+        with self.lock:
+            return self.t is not None
+
+    def _run(self, seconds, paths):
+        report = None
+        try:
+            report = self.profile(seconds, *paths)
+            self.log('profile written to', *paths)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            with self.lock:
+                self.t = None
+                if report is not None:
+                    self.report = report
+
+    def profile(self, seconds, foldedpath=None, reportpath=None):
+        """Profile for seconds in this thread, return the report."""
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        try:
+            before = tracemalloc.take_snapshot()
+            started = time.time()
+            stacks = sample(seconds, self.interval)
+            elapsed = time.time() - started
+            after = tracemalloc.take_snapshot()
+        finally:
+            if not tracing:
+                tracemalloc.stop()
+        report = self._report(stacks, elapsed, after.compare_to(before, 'lineno'))
+        if foldedpath is not None:
+            with open(foldedpath, 'w') as f:
+                for stack, count in stacks.most_common():
+                    f.write('{} {}\n'.format(';'.join(stack), count))
+        if reportpath is not None:
+            with open(reportpath, 'w') as f:
+                f.write(report)
+        return report
+
+    def _report(self, stacks, elapsed, allocs):
+        own = Counter()
+        total = Counter()
+        nsamples = 0
+        for stack, count in stacks.items():
+            nsamples += count
+            own[stack[-1]] += count
+            for label in set(stack[1:]):
+                total[label] += count
+        lines = ['{} thread stack samples in {:.1f}s'.format(nsamples, elapsed)]
+        for title, counts in (('own', own), ('inclusive', total)):
+            lines.append('')
+            lines.append('top functions by {} samples:'.format(title))
+            for label, count in counts.most_common(self.top):
+                lines.append('{:8d} {:6.1%} {}'.format(
+                    count, count / max(nsamples, 1), label))
+        lines.append('')
+        lines.append('top allocation growth:')
+        lines.extend([str(stat) for stat in allocs[:self.top]])
+        lines.append('')
+        return '\n'.join(lines)
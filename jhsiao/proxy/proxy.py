@@ -1,8 +1,10 @@
 from __future__ import print_function
 __all__ = ['Proxy']
-from collections import deque
-import datetime
+from collections import deque, OrderedDict
+import errno
 import io
+import json
+import os
 import struct
 import sys
 import threading
@@ -10,13 +12,32 @@ import threading
 import time
 import traceback
 import itertools
-
-import requests
+import select
+import signal
+import socket
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
 
 from jhsiao.ipc import sockets, polling, pollable
+from requests.exceptions import ConnectTimeout, ProxyError
 
-from .http import Startline, Headers, HTTPError
-from .multiforward import MultiForwarder
+from .http import HTTPError, Body, RequestParser
+from .multiforward import MultiForwarder, ShardedForwarder
+from .upstream import UpstreamPool
+from .resolver import Resolver, Race
+from .nets import NetTrie
+from .cache import HTTPCache
+from .metrics import Registry, BYTE_BUCKETS, render_snapshots
+from .admission import Admission, QueuePolicy
+from .timerwheel import TimerWheel
+from .accesslog import AccessLog
+from .parents import ParentSet, connectrequest, parsestatus
+from .collapse import Collapser, collapsible
+from .compress import Compressor, GzipStream, accepts, gzipheaders
+from .tracing import Tracer
+from .profiling import Profiler
 
 def name(f):
     name = f.name
@@ -27,6 +48,55 @@ def name(f):
 
 class StopServing(Exception): pass
 
+def bind_reuseport(addr):
+    """Bind a tcp socket with SO_REUSEPORT.
+
+    Several processes can bind the same addr and the kernel spreads
+    new connections between them.
+    """
+    family, socktype, proto, _, sockaddr = socket.getaddrinfo(
+        addr[0], addr[1], 0, socket.SOCK_STREAM, 0, socket.AI_PASSIVE)[0]
+    sock = socket.socket(family, socktype, proto)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(sockaddr)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+RELAY_CHUNKSIZE = 0x10000
+RELAY_HOP_HEADERS = frozenset(['connection', 'keep-alive', 'proxy-connection'])
+SERVICE_UNAVAILABLE = (
+    b'HTTP/1.1 503 Service Unavailable\r\n'
+    b'Content-Length: 0\r\n'
+    b'Connection: close\r\n\r\n')
+REQUEST_TIMEOUT = (
+    b'HTTP/1.1 408 Request Timeout\r\n'
+    b'Content-Length: 0\r\n'
+    b'Connection: close\r\n\r\n')
+TOO_MANY_REQUESTS = (
+    b'HTTP/1.1 429 Too Many Requests\r\n'
+    b'Retry-After: 1\r\n'
+    b'Content-Length: 0\r\n'
+    b'Connection: close\r\n\r\n')
+LOOPBACK = [('127.0.0.0', 8), ('::1', 128)]
+
+def sendv(sock, buffers):
+    """Send a sequence of buffers with vectored sends."""
+    sendmsg = getattr(sock, 'sendmsg', None)
+    if sendmsg is None:
+        sock.sendall(b''.join(buffers))
+        return
+    buffers = deque(buffers)
+    while buffers:
+        sent = sendmsg(list(itertools.islice(buffers, 0, 1024)))
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers.popleft())
+        if sent:
+            buffers[0] = memoryview(buffers[0])[sent:]
+
 
 def int2ipv6(nums, _fmt=':'.join(['{:04x}']*8)):
     """Expand 8 ints into a full IPV6 address.
@@ -60,31 +130,35 @@ class Server(object):
 
     bstructv6 = struct.Struct('>8H')
     ustructv6 = struct.Struct('>2Q')
-    def __init__(self, proxy):
-        self.socket = sockets.bind(proxy.addr)
-        print('bound to', proxy.addr)
-        self.socket.listen(5)
+    def __init__(self, proxy, sock=None):
+        """Initialize.
+
+        sock: listening socket to share, default to bind proxy.addr.
+        """
+        if sock is not None:
+            self.socket = sock
+        else:
+            if proxy.reuseport:
+                self.socket = bind_reuseport(proxy.addr)
+            else:
+                self.socket = sockets.bind(proxy.addr)
+            proxy.bound(self.socket)
+            self.socket.listen(5)
         self.fileno = self.socket.fileno
         self.timeout = proxy.timeout
 
-        self.allowed = self.compile_nets(proxy.allowed)
-        self.blocked = self.compile_nets(proxy.blocked)
+        self.filter = IPFilter(proxy.allowed, proxy.blocked, proxy.ipcachesize)
+        self.allowed = self.filter.allowed
+        self.blocked = self.filter.blocked
 
     @classmethod
     def matchip(cls, ipnums, targets):
         """Return whether ipnums matches any networks in targets
 
         ip: sequence  of ints
-        targets: sequence of pairs of sequence of int.
-            [(targetipnums, targetipmasks), ...]
+        targets: NetTrie from compile_nets()
         """
-        for target, masks in targets:
-            if len(ipnums) == len(target) and all(
-                    [inum & tmask == tnum
-                    for inum, tnum, tmask
-                    in zip(ipnums, target, masks)]):
-                return True
-        return False
+        return targets.match(ipnums)
 
     @classmethod
     def ip2nums(cls, ip):
@@ -106,49 +180,36 @@ class Server(object):
             return cls.ustruct.unpack(
                 cls.bstruct.pack(*map(int, ip.split('.'))))
 
-    @classmethod
-    def netbits2mask(cls, nbits, v6):
-        """Convert network prefix bitcount into a sequence of masks.
-
-        Parallel to ip2nums.
-        """
-        if v6:
-            IPV6BITS = 128
-            IPV6MASK = 0xFFFFFFFFFFFFFFFF
-            if nbits > 64:
-                return (IPV6MASK, (IPV6MASK << (IPV6BITS-nbits)) & IPV6MASK)
-            else:
-                return ((IPV6MASK << (64-nbits)) & IPV6MASK, 0)
-        else:
-            IPV4BITS = 32
-            IPV4MASK = 0xFFFFFFFF
-            return ((IPV4MASK << (IPV4BITS-nbits)) & IPV4MASK,)
-
     @classmethod
     def compile_nets(cls, nets):
-        ret = []
-        for net, maskbits in nets:
-            isipv6 = ':' in net
-            nums = cls.ip2nums(net)
-            masks = cls.netbits2mask(maskbits, isipv6)
-            ret.append((tuple([n&m for n,m in zip(nums, masks)]), masks))
-        return ret
+        """Compile sequence of (ip, maskbits) into a NetTrie."""
+        return NetTrie([(cls.ip2nums(net), maskbits) for net, maskbits in nets])
 
 
     def __call__(self, proxy):
-        c, addr = self.socket.accept()
+        start = time.time()
+        try:
+            c, addr = self.socket.accept()
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                # Another loop sharing the socket accepted it.
+                return
+            raise
         c.settimeout(self.timeout)
-        client = Client(c)
+        client = Client(c, addr[0])
+        proxy.metrics.connections.inc()
 
-        nums = self.ip2nums(addr[0])
-        if (
-                (self.blocked and self.matchip(nums, self.blocked))
-                or (self.allowed and not self.matchip(nums, self.allowed))):
+        if not self.filter(addr[0]):
             proxy.log('blocked ip', addr[0])
+            proxy.metrics.blocked.inc()
             self._trysend(client, b'HTTP/1.1 403 Forbidden\r\n\r\n')
             return
         with proxy.cond:
             proxy.poller.register(client, proxy.poller.OFLAGS|proxy.poller.RFLAGS)
+        client.settimer(proxy, proxy.headertimeout, client.headerexpired)
+        tracer = proxy.tracer
+        if tracer is not None:
+            tracer.span('accept', start, time.time(), 'accept', client=addr[0])
 
     @staticmethod
     def _trysend(client, data):
@@ -169,10 +230,45 @@ class Server(object):
     def close(self, proxy):
         self.socket.close()
 
+class IPFilter(object):
+    """Allow/block decisions for client ips.
+
+    Recent decisions are kept in an LRU.  Not thread-safe.
+    """
+    def __init__(self, allowed, blocked, cachesize=1024):
+        """Initialize.
+
+        allowed, blocked: sequences of (ip, maskbits)
+        cachesize: number of recent decisions to remember.
+        """
+        self.allowed = Server.compile_nets(allowed)
+        self.blocked = Server.compile_nets(blocked)
+        self.cache = OrderedDict()
+        self.cachesize = cachesize
+
+    def __call__(self, ip):
+        """Return whether ip is allowed."""
+        cache = self.cache
+        ret = cache.get(ip)
+        if ret is not None:
+            cache.move_to_end(ip)
+            return ret
+        nums = Server.ip2nums(ip)
+        ret = not (
+            (self.blocked and self.blocked.match(nums))
+            or (self.allowed and not self.allowed.match(nums)))
+        if self.cachesize:
+            cache[ip] = ret
+            if len(cache) > self.cachesize:
+                cache.popitem(last=False)
+        return ret
+
 
 class Event(pollable.Pollable):
     def __call__(self, proxy):
-        poller = proxy.poller
+        if proxy.signalled:
+            proxy.runsignalled()
+        dones = None
         with proxy.lock:
             self.clear()
             if not proxy.running:
@@ -181,53 +277,166 @@ class Event(pollable.Pollable):
                 dones = list(proxy.done)
                 del proxy.done[:]
         if dones:
-            reflags = poller.RFLAGS|poller.OFLAGS
             for client, code in dones:
-                if code == proxy.REARM:
-                    try:
-                        poller.modify(client, reflags)
-                    except Exception:
-                        traceback.print_exc()
-                        code = proxy.CLOSE
-                else:
-                    try:
-                        poller.unregister(client)
-                    except Exception:
-                        traceback.print_exc()
-                    if code == proxy.FORWARD:
-                        client.detach()
-                    elif code == proxy.CLOSE:
-                        client.close()
+                proxy.finish(client, code)
 
 class Client(object):
-    def __init__(self, sock):
+    def __init__(self, sock, ip=None):
         self.socket = sock
+        self.ip = ip
         self.f = sockets.Sockfile(sock, 'rwb')
         self.r = io.BufferedReader(self.f)
         self.w = io.BufferedWriter(self.f)
         self.fileno = sock.fileno
+        self.remote = None
+        self.queued = None
+        self.parser = None
+        self.timer = None
+        self.status = None
+        self.nbytes = 0
+        self.upstream = None
 
     def __call__(self, proxy):
-        with proxy.cond:
+        """Read what is available of the request head.
+
+        Dispatch the client once the head is complete.  Only one read
+        is done so this never blocks.
+        """
+        try:
+            data = self.r.peek()
+        except Exception:
+            data = b''
+        if not data:
+            self.drop(proxy)
+            return
+        if self.parser is None:
+            self.parser = RequestParser(**proxy.headlimits)
+            self.settimer(proxy, proxy.headertimeout, self.headerexpired)
+        tracer = proxy.tracer
+        start = time.time()
+        try:
+            self.r.read(self.parser.feed(data))
+        except HTTPError as e:
+            proxy.log(name(self.f), e.code, ':', e.args[0])
+            self.settimer(proxy)
+            if e.code > 0:
+                self.reject(proxy, 'HTTP/1.1 {} {}\r\n{}'.format(
+                    e.code, e.args[0],
+                    'Content-Length: 0\r\nConnection: close\r\n\r\n'
+                ).encode('utf-8'))
+            else:
+                self.drop(proxy)
+            return
+        if tracer is not None:
+            tracer.span('parse', start, time.time(), 'parse', client=name(self.f))
+        if not self.parser.done:
             try:
-                if len(proxy.q) >= proxy.maxsize:
-                    self.w.write(
-                        b'HTTP/1.1 503 Service Unavailable\r\n'
-                        b'User-Agent: PyTestApp\r\n'
-                        b'\r\n'
-                    )
+                proxy.poller.modify(self, proxy.poller.RFLAGS|proxy.poller.OFLAGS)
             except Exception:
-                try:
-                    proxy.poller.unregister(self)
-                except Exception:
-                    traceback.print_exc()
-                try:
-                    self.close()
-                except Exception:
-                    self.w.close()
+                traceback.print_exc()
+                self.drop(proxy)
+            return
+        if proxy.requesttimeout is None:
+            self.settimer(proxy)
+        else:
+            self.settimer(proxy, proxy.requesttimeout, self.requestexpired)
+        now = time.time()
+        reason = proxy.admission.admit(self.ip, now)
+        if reason is not None:
+            proxy.metrics.rejected.labels(reason).inc()
+            self.settimer(proxy)
+            self.reject(proxy, TOO_MANY_REQUESTS)
+            return
+        if not proxy.dispatch(self, now):
+            proxy.admission.release(self.ip)
+            proxy.metrics.rejected.labels('full').inc()
+            self.settimer(proxy)
+            self.reject(proxy, SERVICE_UNAVAILABLE)
+
+    def reject(self, proxy, response):
+        """Stop polling, send response and close."""
+        try:
+            proxy.poller.unregister(self)
+        except Exception:
+            traceback.print_exc()
+        Server._trysend(self, response)
+
+    def drop(self, proxy):
+        """Stop polling and close."""
+        self.settimer(proxy)
+        try:
+            proxy.poller.unregister(self)
+        except Exception:
+            traceback.print_exc()
+        try:
+            self.close()
+        except Exception:
+            traceback.print_exc()
 
-            proxy.q.append(self)
-            proxy.cond.notify()
+    def settimer(self, proxy, delay=None, callback=None):
+        """Replace the client's deadline, None to only cancel it."""
+        proxy.cancel(self.timer)
+        if delay is None:
+            self.timer = None
+        else:
+            self.timer = proxy.schedule(delay, callback)
+
+    def headerexpired(self, proxy):
+        """The request head took too long to arrive."""
+        self.timer = None
+        proxy.metrics.timeouts.labels('header').inc()
+        proxy.log(name(self.f), 'request head timed out')
+        self.reject(proxy, REQUEST_TIMEOUT)
+
+    def idleexpired(self, proxy):
+        """No new request on a kept-alive connection."""
+        self.timer = None
+        proxy.metrics.timeouts.labels('idle').inc()
+        self.drop(proxy)
+
+    def requestexpired(self, proxy):
+        """The request is taking too long, make the handler give up."""
+        self.timer = None
+        proxy.metrics.timeouts.labels('request').inc()
+        proxy.log(name(self.f), 'request timed out')
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            traceback.print_exc()
+
+    def buffered(self):
+        """Return whether read data is waiting in the read buffer."""
+        return self.f.rtell() != self.r.tell()
+
+    def readable(self):
+        """Return whether a read would not block."""
+        if self.buffered():
+            return True
+        # Socket timeouts make recv() wait even with MSG_DONTWAIT.
+        if hasattr(select, 'poll'):
+            p = select.poll()
+            p.register(self.socket, select.POLLIN)
+            return bool(p.poll(0))
+        return bool(select.select([self.socket], [], [], 0)[0])
+
+    def pending(self, headlimits):
+        """Parse a next request head that can be read without blocking.
+
+        Return a done RequestParser or None if there is no whole head.
+        A partial head is kept in self.parser for the poll thread to
+        finish.  Handler thread only.
+        """
+        if not self.readable():
+            return None
+        data = self.r.peek()
+        if not data:
+            return None
+        parser = RequestParser(**headlimits)
+        self.r.read(parser.feed(data))
+        if parser.done:
+            return parser
+        self.parser = parser
+        return None
 
     def detach(self):
         if self.f is not None:
@@ -244,55 +453,832 @@ class Client(object):
         if self.f is not None:
             self.detach().close()
 
-class Proxy(object):
+class _Attempt(object):
+    """Pollable wrapper of a Dialer's connection attempt."""
+    def __init__(self, dialer, sock):
+        self.dialer = dialer
+        self.sock = sock
+        self.fileno = sock.fileno
+
+    def __call__(self, proxy):
+        self.dialer.attempted(proxy, self)
+
+class _Handshake(_Attempt):
+    """Pollable wrapper of a Dialer's CONNECT to a parent proxy."""
+    def __call__(self, proxy):
+        self.dialer.handshaken(proxy)
+
+class Dialer(object):
+    """Non-blocking CONNECT setup driven by the poll thread.
+
+    The destination is resolved and the first connect is started by a
+    handler thread.  The poll thread races the remaining addresses
+    (happy-eyeballs), replies 200 once one connects and hands the pair
+    to the forwarder.
+
+    Through a parent proxy, the parent's addresses are raced instead
+    and the poll thread sends it a CONNECT and waits for its reply
+    before replying to the client.
+    """
+    def __init__(self, proxy, client, host, port, parent=None):
+        """Resolve and start connecting to the first address."""
+        self.client = client
+        self.host = host
+        self.port = port
+        self.parent = parent
+        self.resolver = proxy.resolver
+        if parent is None:
+            self.dest = (host, port)
+        else:
+            self.dest = (parent.host, parent.port)
+        self.race = Race(
+            self.resolver.resolve(*self.dest), self.resolver.delay)
+        self.handshake = None
+        self.reply = b''
+        self.timer = None
+        self.launcher = None
+        self.attempts = []
+        self.started = time.time()
+        if not self._launch():
+            raise self.race.error
+
+    def __repr__(self):
+        return '{}:{}'.format(self.host, self.port)
+
+    def _launch(self, proxy=None):
+        """Start the next attempt, return whether one was started."""
+        sock = self.race.launch(time.time())
+        if sock is None:
+            return False
+        attempt = _Attempt(self, sock)
+        self.attempts.append(attempt)
+        if proxy is not None:
+            proxy.poller.register(attempt, proxy.poller.WFLAGS|proxy.poller.OFLAGS)
+        return True
+
+    def _schedule(self, proxy):
+        proxy.cancel(self.launcher)
+        self.launcher = None
+        if self.race.nextlaunch is not None:
+            self.launcher = proxy.schedule(
+                self.race.nextlaunch - time.time(), self.launch)
+
+    def launch(self, proxy):
+        """Launch the next attempt after the happy-eyeballs delay."""
+        self.launcher = None
+        self._launch(proxy)
+        self._schedule(proxy)
+
+    def start(self, proxy):
+        """Wait for the first attempt to finish."""
+        for attempt in self.attempts:
+            proxy.poller.register(attempt, proxy.poller.WFLAGS|proxy.poller.OFLAGS)
+        self.timer = proxy.schedule(proxy.connecttimeout, self.expire)
+        self._schedule(proxy)
+
+    def _stop(self, proxy):
+        """Stop all timers and attempts."""
+        proxy.cancel(self.timer)
+        self._stopattempts(proxy)
+        handshake = self.handshake
+        if handshake is not None:
+            self.handshake = None
+            try:
+                proxy.poller.unregister(handshake)
+            except Exception:
+                traceback.print_exc()
+            handshake.sock.close()
+
+    def _stopattempts(self, proxy):
+        proxy.cancel(self.launcher)
+        for attempt in self.attempts:
+            try:
+                proxy.poller.unregister(attempt)
+            except Exception:
+                traceback.print_exc()
+        del self.attempts[:]
+        self.race.close()
+
+    def attempted(self, proxy, attempt):
+        """An attempt connected or failed."""
+        if attempt not in self.attempts:
+            # Another attempt won or failed the dial in the same poll.
+            attempt.sock.close()
+            return
+        try:
+            proxy.poller.unregister(attempt)
+        except Exception:
+            traceback.print_exc()
+        self.attempts.remove(attempt)
+        sock = attempt.sock
+        addr = self.race.check(sock)
+        if addr is None:
+            if not self.attempts:
+                self._launch(proxy)
+                self._schedule(proxy)
+            if self.race.failed():
+                self._stop(proxy)
+                self.fail(proxy, self.race.error)
+            return
+        self.resolver.prefer(self.dest[0], self.dest[1], addr)
+        if self.parent is None:
+            self._stop(proxy)
+            self.connected(proxy, sock)
+            return
+        self._stopattempts(proxy)
+        try:
+            sock.send(connectrequest(self.host, self.port))
+        except Exception as e:
+            sock.close()
+            self._stop(proxy)
+            self.fail(proxy, e)
+            return
+        self.handshake = _Handshake(self, sock)
+        proxy.poller.register(
+            self.handshake, proxy.poller.RFLAGS|proxy.poller.OFLAGS)
+
+    def handshaken(self, proxy):
+        """The parent proxy replied to the CONNECT."""
+        handshake = self.handshake
+        sock = handshake.sock
+        try:
+            data = sock.recv(0x10000)
+        except (BlockingIOError, InterruptedError):
+            data = None
+        except Exception as e:
+            self._stop(proxy)
+            self.fail(proxy, e)
+            return
+        if data == b'':
+            self._stop(proxy)
+            self.fail(proxy, socket.error('parent closed the connection'))
+            return
+        if data:
+            self.reply += data
+        head, sep, rest = self.reply.partition(b'\r\n\r\n')
+        if not sep:
+            if len(self.reply) > 0x10000:
+                self._stop(proxy)
+                self.fail(proxy, ValueError('parent reply too long'))
+            else:
+                proxy.poller.modify(
+                    handshake, proxy.poller.RFLAGS|proxy.poller.OFLAGS)
+            return
+        try:
+            code, reason = parsestatus(head)
+        except ValueError as e:
+            self._stop(proxy)
+            self.fail(proxy, e)
+            return
+        proxy.parents.succeeded(self.parent)
+        if not 200 <= code < 300:
+            self._stop(proxy)
+            proxy.metrics.dials.labels('refused').inc()
+            proxy.log('Parent {} refused {}: {} {}'.format(
+                self.parent, self, code, reason))
+            self.record(proxy, code)
+            Server._trysend(self.client, (
+                'HTTP/1.1 {} {}\r\nContent-Length: 0\r\n'
+                'Connection: close\r\n\r\n').format(code, reason).encode('utf-8'))
+            return
+        try:
+            proxy.poller.unregister(handshake)
+        except Exception:
+            traceback.print_exc()
+        self.handshake = None
+        proxy.cancel(self.timer)
+        self.connected(proxy, sock, rest)
+
+    def connected(self, proxy, sock, early=b''):
+        """Reply 200 and forward between the client and sock.
+
+        early: data received from sock before the tunnel started.
+        """
+        proxy.metrics.dials.labels('ok').inc()
+        proxy.metrics.dialtime.observe(time.time() - self.started)
+        self.record(proxy, 200)
+        sock.settimeout(None)
+        client = self.client
+        try:
+            remote = sockets.Sockfile(sock, 'rwb')
+            actual = client.f.rtell()
+            supposed = client.r.tell()
+            if supposed != actual:
+                b = io.BufferedWriter(remote)
+                b.write(client.r.read(actual-supposed))
+                b.flush()
+                b.detach()
+            client.w.write(b'HTTP/1.1 200 OK\r\n\r\n')
+            client.w.write(early)
+            client.w.flush()
+        except Exception:
+            traceback.print_exc()
+            sock.close()
+            client.close()
+        else:
+            proxy.forward(client, remote)
+
+    def record(self, proxy, status):
+        """Add the CONNECT to the access log."""
+        now = time.time()
+        proxy.accesslog.record(
+            name(self.client.f), 'CONNECT', repr(self), status, 0, None,
+            now - self.started)
+        if proxy.tracer is not None:
+            proxy.tracer.span(
+                'dial', self.started, now, 'connect', dest=repr(self),
+                status=status)
+
+    def expire(self, proxy):
+        """Connect timed out."""
+        self.timer = None
+        self._stop(proxy)
+        if self.parent is not None:
+            proxy.parents.failed(self.parent)
+        proxy.metrics.dials.labels('timeout').inc()
+        proxy.log('Timed out connecting to {}'.format(self))
+        self.record(proxy, 504)
+        Server._trysend(self.client, b'HTTP/1.1 504 Gateway Timeout\r\n\r\n')
+
+    def fail(self, proxy, err):
+        proxy.metrics.dials.labels('failed').inc()
+        if self.parent is not None:
+            proxy.parents.failed(self.parent)
+            proxy.log('Failed to connect to {} through {}'.format(
+                self, self.parent))
+            status = '502 Bad Gateway'
+        else:
+            proxy.log('Failed to connect to {}'.format(self))
+            status = '404 Not Found'
+        self.record(proxy, int(status[:3]))
+        msg = str(err).encode('utf-8')
+        Server._trysend(self.client, (
+            'HTTP/1.1 ' + status + '\r\n'
+            'Content-Type: text\r\n'
+            'Content-length: {}\r\n\r\n').format(len(msg)).encode('utf-8') + msg)
+
+def _stat(obj, key):
+    """Return obj.stats()[key], 0 if obj is None."""
+    return 0 if obj is None else obj.stats()[key]
+
+class Metrics(Registry):
+    """The metrics a Proxy updates."""
+    def __init__(self, proxy):
+        super(Metrics, self).__init__()
+        self.connections = self.counter(
+            'proxy_connections_total', 'Accepted client connections.')
+        self.blocked = self.counter(
+            'proxy_blocked_total', 'Connections from blocked ips.')
+        self.rejected = self.counter(
+            'proxy_rejected_total',
+            'Requests refused before queueing: full queue or client ip limits.',
+            ('reason',))
+        self.timeouts = self.counter(
+            'proxy_client_timeouts_total',
+            'Client connections closed by a header, idle or request deadline.',
+            ('deadline',))
+        self.pipelined = self.counter(
+            'proxy_pipelined_total',
+            'Keep-alive requests handled without returning to the poller.')
+        self.shed = self.counter(
+            'proxy_shed_total', 'Queued requests answered 503 for waiting too long.')
+        self.queuedepth = self.gauge(
+            'proxy_queue_depth', 'Clients waiting for a handler thread.',
+            func=lambda: len(proxy.q))
+        self.handlers = self.gauge(
+            'proxy_handlers', 'Handler threads.', func=lambda: proxy.numthreads)
+        self.busy = self.gauge(
+            'proxy_handlers_busy', 'Handler threads handling a request.')
+        self.queuewait = self.histogram(
+            'proxy_queue_wait_seconds',
+            'Time from a client becoming readable to a handler picking it up.')
+        self.requests = self.counter(
+            'proxy_requests_total', 'Requests by method.', ('method',))
+        self.duration = self.histogram(
+            'proxy_request_duration_seconds', 'Time a handler spent on a request.')
+        self.responses = self.counter(
+            'proxy_upstream_responses_total', 'Upstream responses by status.',
+            ('code',))
+        self.upstreamerrors = self.counter(
+            'proxy_upstream_errors_total', 'Failed upstream requests.')
+        self.ttfb = self.histogram(
+            'proxy_upstream_ttfb_seconds',
+            'Time from sending a request upstream to its response head.')
+        self.poolhits = self.counter(
+            'proxy_upstream_pool_hits_total',
+            'Upstream requests that reused a pooled connection.',
+            func=lambda: _stat(proxy.pool, 'hits'))
+        self.poolmisses = self.counter(
+            'proxy_upstream_pool_misses_total',
+            'Upstream requests that needed a new connection.',
+            func=lambda: _stat(proxy.pool, 'misses'))
+        self.poolevicted = self.counter(
+            'proxy_upstream_pool_evicted_total',
+            'Pooled connections closed for being idle or old.',
+            func=lambda: _stat(proxy.pool, 'evicted'))
+        self.dnslookups = self.histogram(
+            'proxy_dns_lookup_seconds',
+            'Time getaddrinfo took for names not in the resolver cache.')
+        self.dnshits = self.counter(
+            'proxy_dns_cache_hits_total',
+            'Lookups answered by the resolver cache, cached failures included.',
+            func=lambda: _stat(proxy.resolver, 'hits')
+                + _stat(proxy.resolver, 'negative'))
+        self.dnsmisses = self.counter(
+            'proxy_dns_cache_misses_total',
+            'Lookups that had to call getaddrinfo.',
+            func=lambda: _stat(proxy.resolver, 'misses')
+                + _stat(proxy.resolver, 'failures'))
+        self.dnsfailures = self.counter(
+            'proxy_dns_failures_total', 'getaddrinfo calls that failed.',
+            func=lambda: _stat(proxy.resolver, 'failures'))
+        self.dnsevicted = self.counter(
+            'proxy_dns_cache_evicted_total',
+            'Names dropped from the full resolver cache.',
+            func=lambda: _stat(proxy.resolver, 'evicted'))
+        self.dials = self.counter(
+            'proxy_connect_total', 'CONNECT upstream connects by result.',
+            ('result',))
+        self.dialtime = self.histogram(
+            'proxy_connect_seconds', 'Time to connect CONNECT upstreams.')
+        self.tunnels = self.counter(
+            'proxy_tunnels_total', 'Tunnels handed to the forwarder.')
+        self.forwarding = self.gauge(
+            'proxy_forwarding', 'Directions being forwarded.',
+            func=lambda: proxy.forwarder.load() if proxy.forwarder else 0)
+        self.tunnelbytes = self.histogram(
+            'proxy_tunnel_bytes', 'Bytes forwarded per tunnel direction.',
+            BYTE_BUCKETS)
+        self.tunnelpeak = self.histogram(
+            'proxy_tunnel_peak_buffered_bytes',
+            'Most bytes buffered at once per tunnel direction.', BYTE_BUCKETS)
+        self.buffered = self.gauge(
+            'proxy_tunnel_buffered_bytes', 'Bytes buffered by all tunnels.',
+            func=lambda: proxy.forwarder.buffered()[0] if proxy.forwarder else 0)
+        self.compressed = self.counter(
+            'proxy_compressed_responses_total', 'Response bodies gzipped.')
+        self.compressin = self.counter(
+            'proxy_compression_input_bytes_total', 'Bytes before gzip.')
+        self.compressout = self.counter(
+            'proxy_compression_output_bytes_total', 'Bytes after gzip.')
+        self.compresssaved = self.counter(
+            'proxy_compression_saved_bytes_total',
+            'Bytes not sent to clients thanks to gzip, including cached variants.')
+        self.compresscpu = self.counter(
+            'proxy_compression_cpu_seconds_total', 'Cpu time spent gzipping.')
+        self.bufferedpeak = self.gauge(
+            'proxy_tunnel_buffered_peak_bytes',
+            'Most bytes buffered by all tunnels at once.',
+            func=lambda: proxy.forwarder.buffered()[1] if proxy.forwarder else 0)
+        self.collapsed = self.counter(
+            'proxy_collapsed_requests_total',
+            'GETs that found the same GET in flight, by whether its'
+            ' response was followed, they had to refetch or they fell'
+            ' behind and were dropped.', ('result',))
+        self.cachehits = self.counter(
+            'proxy_cache_hits_total', 'GETs answered from the cache.',
+            func=lambda: _stat(proxy.cache, 'hits'))
+        self.cachemisses = self.counter(
+            'proxy_cache_misses_total',
+            'GETs not in the cache or found stale and fetched again.',
+            func=lambda: _stat(proxy.cache, 'misses'))
+        self.cacherevalidated = self.counter(
+            'proxy_cache_revalidated_total',
+            'Stale entries refreshed by a 304 from upstream.',
+            func=lambda: _stat(proxy.cache, 'revalidated'))
+        self.cachesaved = self.counter(
+            'proxy_cache_saved_bytes_total',
+            'Body bytes served from the cache instead of upstream.',
+            func=lambda: _stat(proxy.cache, 'bytessaved'))
+        self.cachememevictions = self.counter(
+            'proxy_cache_memory_evictions_total',
+            'Entries dropped from the memory tier to make room.',
+            func=lambda: _stat(proxy.cache, 'memevictions'))
+        self.cachediskevictions = self.counter(
+            'proxy_cache_disk_evictions_total',
+            'Entries dropped from the disk tier to make room.',
+            func=lambda: _stat(proxy.cache, 'diskevictions'))
+        self.cacheratio = self.gauge(
+            'proxy_cache_hit_ratio', 'Cache hits over cache lookups.',
+            func=lambda: _stat(proxy.cache, 'hitratio'))
+
+class PollLoop(object):
+    """Poll thread side of serving clients and its handler threads.
+
+    Subclasses have a poller, _timers (a TimerWheel) and admission.
+    Handler threads running handleloop() take clients from q in the
+    order of queuepolicy and put them on done, waking ev.  lock and
+    cond guard both.
+    """
     CLOSE = 0
     REARM = 1
     FORWARD = 2
+    DIAL = 3
+    def schedule(self, delay, callback):
+        """Call callback(self) after delay seconds in the poll thread.
+
+        Return a handle for cancel().  Poll thread only.
+        """
+        return self._timers.schedule(delay, callback, time.time())
+
+    def cancel(self, timer):
+        self._timers.cancel(timer)
+
+    def _runtimers(self):
+        """Run expired timers, return seconds until the next one."""
+        timers = self._timers
+        for callback in timers.expire(time.time()):
+            try:
+                callback(self)
+            except Exception:
+                traceback.print_exc()
+        return timers.timeout(time.time())
+
+    def _dispatch(self, things):
+        """Call pollables, one that fails does not stop the others."""
+        for thing in things:
+            try:
+                thing(self)
+            except StopServing:
+                raise
+            except Exception:
+                traceback.print_exc()
+
+    def _dispatcherrors(self, r, w, x):
+        """Call things that only got an error or hangup from poll.
+
+        A refused connect attempt can be reported this way.  Their
+        reads or writes find out what happened.
+        """
+        self._dispatch([
+            thing for thing in x if thing not in r and thing not in w])
+
+    def resume(self, client):
+        """Continue with a client whose next request is buffered."""
+        # Already read, poll would not report it.
+        client(self)
+
+    def _hasitems(self):
+        """Cond waiting function."""
+        return bool(self.q) or not self.running
+
+    def dispatch(self, client, now):
+        """Queue a client with a whole request head for a handler.
+
+        Return False if the queue is full.  Poll thread only.
+        """
+        with self.cond:
+            if len(self.q) >= self.maxsize:
+                return False
+            if not self.q:
+                self.queuepolicy.emptied(now)
+            client.queued = now
+            self.q.append(client)
+            self.cond.notify()
+        return True
+
+    def handleloop(self):
+        """Handle requests from queue.
+
+        The poll thread places clients with a whole request head onto
+        the queue.
+        The client is removed from the queue and handled, see work().
+        Finally, it is placed into another queue for rearming.
+        """
+        nonempty = self._hasitems
+        cond = self.cond
+        q = self.q
+        take = self.queuepolicy.take
+        metrics = self.metrics
+        accesslog = self.accesslog
+        tracer = self.tracer
+        while 1:
+            with cond:
+                if q or cond.wait_for(nonempty):
+                    if not self.running:
+                        return
+                    start = time.time()
+                    client, shed = take(q, start)
+            metrics.queuewait.observe(start - client.queued)
+            if tracer is not None:
+                tracer.span(
+                    'queue', client.queued, start, 'queue', shed=shed,
+                    client=name(client.f))
+            if shed:
+                startline = client.parser.startline
+                client.parser = None
+                metrics.shed.inc()
+                try:
+                    client.w.write(SERVICE_UNAVAILABLE)
+                    client.w.flush()
+                except Exception:
+                    traceback.print_exc()
+                accesslog.record(
+                    name(client.f), startline.method, startline.resource, 503,
+                    0, None, 0)
+                code = self.CLOSE
+            else:
+                code = self.work(client)
+            with self.lock:
+                self.done.append((client, code))
+                self.ev.set()
+
+    def finish(self, client, code):
+        """Act on the code a client's requests were handled with.
+
+        Poll thread only.
+        """
+        poller = self.poller
+        self.admission.release(client.ip)
+        client.settimer(self)
+        if code == self.REARM:
+            try:
+                if client.buffered():
+                    self.resume(client)
+                else:
+                    poller.modify(client, poller.RFLAGS|poller.OFLAGS)
+                    if client.parser is None:
+                        client.settimer(
+                            self, self.idletimeout, client.idleexpired)
+                    else:
+                        # Part of a pipelined head was read.
+                        client.settimer(
+                            self, self.headertimeout, client.headerexpired)
+            except Exception:
+                traceback.print_exc()
+                code = self.CLOSE
+        else:
+            try:
+                poller.unregister(client)
+            except Exception:
+                traceback.print_exc()
+            if code == self.FORWARD:
+                self.forward(client, client.remote)
+            elif code == self.DIAL:
+                client.dialer.start(self)
+            elif code == self.CLOSE:
+                client.close()
+
+class Proxy(PollLoop):
     def __init__(
         self, ip='0.0.0.0', port=3128,
         allowed=[('127.0.0.1', 32), ('10.36.0.0', 16), ('192.168.0.0', 16), ('::1', 128)],
-        blocked=(), maxsize=None, numthreads=1, timeout=60):
+        blocked=(), maxsize=None, numthreads=1, timeout=60,
+        poolsize=10, poolhosts=100, poolidle=30, poollifetime=300,
+        shards=1, shardplacement='least', shardprocesses=False,
+        tunnelbudget=None, tunnelslab=0x4000,
+        engine='threads', connecttimeout=10,
+        dnsttl=60, dnsnegttl=5, dnssize=1024, eyeballsdelay=0.25,
+        ipcachesize=1024, cachemem=0, cacheobject=1<<20, cachedir=None,
+        cachedisk=1<<30, maxrequestline=8192, maxheaders=100,
+        maxheadsize=0x10000, reuseport=False, statsdir=None,
+        iprate=None, ipburst=None, ipmaxactive=None, iplimitsize=4096,
+        queuedeadline=None, queueing='fifo', codeltarget=0.005,
+        codelinterval=0.1, headertimeout=10, idletimeout=60,
+        requesttimeout=None, pipelinebudget=16, accesslog=None,
+        accesslogformat='text', accesslogsample=1, accesslogmaxbytes=0,
+        accesslogbackups=5, parents=(), parentvnodes=100, parentmaxfails=3,
+        parentcheck=5, gzip=False, gziplevel=6, gzipmin=1024, gzipcpu=None,
+        gzipcached=8<<20, collapse=False, collapsebuffer=1<<20, trace=0,
+        profiledir=None, profileseconds=10, profilemax=None,
+        debugendpoints=False, debugallowed=(), loopthreads=4):
         """Initialize.
 
         ip, port: bind address
         allowed: if given, a sequence of allowed ips (ip, mask)
+        blocked: a sequence of blocked ips (ip, mask)
+        ipcachesize: number of recent client ip decisions to remember.
+        iprate: requests per second allowed per client ip.
+        ipburst: requests an idle client ip may make at once.
+        ipmaxactive: max queued or in progress requests per client ip.
+        iplimitsize: number of client ips to remember for iprate.
+            Over the limits, requests get 429 Too Many Requests.
+        queuedeadline: requests waiting for a handler thread longer
+            than this many seconds get 503 Service Unavailable.
+        queueing: 'fifo', 'lifo' or 'codel', see QueuePolicy.
+        codeltarget, codelinterval: see QueuePolicy.
+        cachemem: bytes of GET responses to cache in memory.
+        cacheobject: max size of a response cached in memory.
+        cachedir: directory to cache GET responses in.
+        cachedisk: bytes of GET responses to cache in cachedir.
+        maxrequestline: max length of a request line.
+        maxheaders: max number of request headers.
+        maxheadsize: max size of a request line and headers.
+        reuseport: bind with SO_REUSEPORT so other processes can serve
+            the same address.
+        statsdir: directory shared with other worker processes.  The
+            metrics are saved there and /metrics serves their sum.
+        pipelinebudget: max requests a handler thread serves from a
+            connection that can be read without blocking before
+            returning it to the poller.  They are admitted and
+            deadlined as one request.
+        accesslog: file for the access log and diagnostic messages,
+            None for stdout.
+        accesslogformat: 'text' or 'json' lines.
+        accesslogsample: fraction of requests to log.
+        accesslogmaxbytes: rotate the access log at this size.
+        accesslogbackups: number of rotated access logs to keep.
+        timeout: client and upstream read timeout in seconds.
+        headertimeout: seconds a client has to send a whole request
+            head.  Heads are read by the poll thread so slow clients do
+            not hold handler threads.
+        idletimeout: close kept-alive connections idle this long.
+        requesttimeout: abort requests, including the time to send
+            the response, taking longer than this, None for no limit.
+        connecttimeout: timeout for CONNECT upstream connects.
+        parents: parent proxies to send requests and CONNECTs through
+            instead of going direct, 'host:port' or 'host:port=weight'
+            strings or Parents.  Each destination goes to the same
+            parent while it is healthy.  Requests go direct when no
+            parent is healthy.
+        parentvnodes: hash ring points per unit of parent weight.
+        parentmaxfails: consecutive failures to mark a parent down.
+        parentcheck: seconds between parent health checks, > 0.
+        gzip: gzip compressible responses for clients that accept it.
+            Gzipped variants are cached next to the originals.
+        gziplevel: zlib compression level.
+        gzipmin: do not gzip bodies known to be smaller than this.
+        gzipcached: largest cached body to gzip when it is served.
+        gzipcpu: fraction of a cpu to spend gzipping, None for no limit.
+        collapse: GETs for a url whose response is being fetched are
+            sent that response as it arrives instead of fetching it
+            again, see collapse.Collapser.
+        collapsebuffer: bytes of a response after which no more GETs
+            can follow it, and bytes a following GET can fall behind
+            before it is closed.  Followers wait up to timeout for the
+            leader.
+        trace: number of latest spans to keep for dumptrace(), 0 to
+            not record spans.  Spans cover accepts, head parsing,
+            queue waits, requests, upstream connects and responses,
+            relays, CONNECT dials and tunnels.
+        profiledir: directory for profiles and traces, default the
+            temp directory.
+        profileseconds: default duration of profile().
+        profilemax: longest profile(), default 6 * profileseconds.
+        debugendpoints: serve /debug/trace and /debug/profile like
+            /metrics, see localresponse().
+        debugallowed: sequence of (ip, mask) besides loopback that
+            may use the debug endpoints.
+        dnsttl, dnsnegttl: seconds to cache resolved and failed names.
+        dnssize: max number of cached names.
+        eyeballsdelay: delay between racing connects to the addresses
+            of a name.
+        poolsize: max persistent upstream connections per host.
+        poolhosts: max number of upstream hosts to keep pools for.
+        poolidle: close upstream connections idle this many seconds.
+        poollifetime: close upstream connections older than this.
+        shards: number of tunnel forwarding loops.
+        shardplacement: 'least' or 'hash', see ShardedForwarder.
+        shardprocesses: run forwarding shards in separate processes.
+        tunnelbudget: max bytes buffered by all tunnels together, None
+            for no limit.  Tunnels stop reading while it is used up.
+        tunnelslab: size of the buffers tunnels take from tunnelbudget.
+        engine: 'threads' to handle requests with a pool of handler
+            threads or 'asyncio' to handle them as coroutines on a
+            single event loop or 'loops' to run numthreads poll loops
+            that each accept their own clients and handle them with
+            loopthreads handler threads, see LoopEngine.
+            'asyncio' reads with timeout throughout and ignores
+            numthreads, loopthreads, the shard and tunnel budget
+            options, headertimeout, idletimeout, requesttimeout,
+            pipelinebudget, the queueing options, poolhosts, poolidle
+            and poollifetime.  It writes no access log records, only
+            log() messages, and raises ValueError with the cache, gzip,
+            collapse or trace options or an accesslog path.
+        loopthreads: handler threads per loop of the 'loops' engine.
         """
+        if engine not in ('threads', 'asyncio', 'loops'):
+            raise ValueError('Unknown engine {!r}'.format(engine))
+        if engine == 'asyncio':
+            unsupported = [
+                option for option, value in (
+                    ('cache', cachemem or cachedir is not None),
+                    ('gzip', gzip), ('collapse', collapse), ('trace', trace),
+                    ('accesslog', accesslog is not None))
+                if value]
+            if unsupported:
+                raise ValueError('The asyncio engine does not support {}'.format(
+                    ', '.join(unsupported)))
+        self.engine = engine
+        self._engine = None
         self.maxsize = float('inf') if maxsize is None else maxsize
         self.addr = (ip, port)
         self.allowed = allowed
         self.blocked = blocked
+        self.ipcachesize = ipcachesize
+        self.admission = Admission(iprate, ipburst, ipmaxactive, iplimitsize)
+        self.queuepolicy = QueuePolicy(
+            queueing, queuedeadline, codeltarget, codelinterval)
+        self.headlimits = dict(
+            maxline=maxrequestline, maxheaders=maxheaders, maxsize=maxheadsize)
         self.running = False
         self.lock = threading.Lock()
         self.cond = threading.Condition(self.lock)
         self.numthreads = numthreads
+        self.loopthreads = loopthreads
         self.timeout = timeout
+        self.headertimeout = headertimeout
+        self.idletimeout = idletimeout
+        self.requesttimeout = requesttimeout
+        self.pipelinebudget = pipelinebudget
+        self.connecttimeout = connecttimeout
+        self.metrics = Metrics(self)
+        self.resolver = Resolver(
+            dnsttl, dnsnegttl, dnssize, eyeballsdelay, self.metrics.dnslookups)
+        if parents:
+            self.parents = ParentSet(
+                parents, parentvnodes, parentmaxfails, parentcheck,
+                connecttimeout, self.resolver, self.log)
+        else:
+            self.parents = None
+        self.poolargs = dict(
+            maxperhost=poolsize, maxhosts=poolhosts, idle=poolidle,
+            lifetime=poollifetime)
+        self.pool = None
+        if gzip:
+            self.compressor = Compressor(gziplevel, gzipmin, gzipcpu)
+        else:
+            self.compressor = None
+        self.gzipcached = gzipcached
+        self.tracer = Tracer(trace) if trace else None
+        self.profiler = Profiler(profiledir, log=self.log)
+        self.profileseconds = profileseconds
+        if profilemax is None:
+            profilemax = 6 * profileseconds
+        self.profilemax = profilemax
+        self.debugendpoints = debugendpoints
+        self.debugfilter = IPFilter(LOOPBACK + list(debugallowed), (), 0)
+        self.signalled = []
+        if collapse:
+            self.collapser = Collapser(collapsebuffer, timeout=timeout)
+        else:
+            self.collapser = None
+        if cachemem or cachedir is not None:
+            self.cache = HTTPCache(cachemem, cacheobject, cachedir, cachedisk)
+        else:
+            self.cache = None
+        self.shardargs = dict(
+            shards=shards, placement=shardplacement, processes=shardprocesses)
+        self.tunnelargs = dict(budget=tunnelbudget, slabsize=tunnelslab)
         self.q = deque()
         self.done = []
         self.t = None
+        self.ev = None
+        self.forwarder = None
+        self.reuseport = reuseport
+        self.statsdir = statsdir
+        self.statsinterval = 1
+        self.accesslog = AccessLog(
+            accesslog, accesslogformat, accesslogsample, accesslogmaxbytes,
+            accesslogbackups)
 
-    def log(self, *args, **kwargs):
-        now = datetime.datetime.now()
-        now = now.strftime(
-            '%Y-%m-%d %H:%M:%S.{:02d}: '.format(now.microsecond//10000))
-        if args:
-            args = list(args)
-            args[0] = now+args[0]
-        else:
-            args = (now,)
-        with self.lock:
-            print(*args, **kwargs)
+    def log(self, *args):
+        """Log a diagnostic line to the access log without blocking."""
+        self.accesslog.message(*args)
 
-    def _hasitems(self):
-        """Cond waiting function."""
-        return bool(self.q) or not self.running
+    def bound(self, sock):
+        """Note the listening socket was bound.
+
+        With port 0, addr gets the port that was assigned.
+        """
+        if self.addr[1] == 0:
+            self.addr = (self.addr[0], sock.getsockname()[1])
+        print('bound to', self.addr)
+
+    def parent(self, key):
+        """Return the parent proxy for destination key, None for direct."""
+        if self.parents is None:
+            return None
+        return self.parents.select(key)
+
+    def forward(self, client, remote):
+        """Hand client and remote Sockfile to the forwarder.
+
+        client must already be unregistered from the poller.
+        """
+        f = client.detach()
+        self.metrics.tunnels.inc()
+        try:
+            self.forwarder.add(f, remote, duplex=True)
+        except Exception:
+            traceback.print_exc()
+            f.close()
+            remote.close()
 
     def do_CONNECT(self, client, startline, headers):
         host, port = startline.resource.rsplit(':', 1)
+        host = host.strip('[]')
+        parent = self.parent('{}:{}'.format(host, port))
         try:
-            remote = sockets.Sockfile(sockets.connect((host, int(port))), 'rwb')
+            client.dialer = Dialer(self, client, host, int(port), parent)
         except Exception:
+            if parent is not None:
+                self.parents.failed(parent)
+            self.metrics.dials.labels('failed').inc()
             self.log('Failed to connect to {}:{}'.format(host, port))
             msg = traceback.format_exc().encode('utf-8')
+            client.status = 404
+            client.nbytes = len(msg)
             client.w.write((
                 'HTTP/1.1 404 Not Found\r\n'
                 'Content-Type: text\r\n'
@@ -300,106 +1286,660 @@ class Proxy(object):
             client.w.write(msg)
             client.w.flush()
             return self.CLOSE
-        else:
-            actual = client.f.rtell()
-            supposed = client.r.tell()
-            if supposed != actual:
-                b = io.BufferedWriter(remote)
-                b.write(client.r.read(actual-supposed))
-                b.flush()
-                b.detach()
-            client.w.write(b'HTTP/1.1 200 OK\r\n\r\n')
-            client.w.flush()
-            self.forwarder.add(client.f, remote, duplex=True)
-            return self.FORWARD
+        return self.DIAL
+
+    def _sendcached(self, client, entry, headers):
+        """Send a cached response.
 
-    def _basic(self, func, withdata, client, startline, headers):
-        dlen = headers.get('content-length')
+        Return False if the entry's body is no longer available.
+        """
+        cache = self.cache
+        now = time.time()
+        etag = headers.get('if-none-match')
+        if entry.etag and etag is not None and entry.etag in [
+                tag.strip() for tag in etag.split(',')]:
+            client.status = 304
+            lines = ['HTTP/1.1 304 Not Modified']
+            lines.extend(['{}: {}'.format(k, v) for k, v in entry.headers])
+            lines.append('\r\n')
+            client.w.write('\r\n'.join(lines).encode('utf-8'))
+            cache.served(entry)
+            return True
+        f = None
+        if entry.body is None:
+            f = cache.open(entry)
+            if f is None:
+                return False
+        client.status = entry.status
+        client.nbytes = entry.size
+        if entry.encoding is not None and entry.rawsize is not None:
+            self.metrics.compresssaved.inc(entry.rawsize - entry.size)
+        w = client.w
+        try:
+            w.write(entry.head(now))
+            if f is None:
+                w.write(entry.body)
+            else:
+                w.flush()
+                client.socket.sendfile(f, 0, entry.size)
+        finally:
+            if f is not None:
+                f.close()
+        cache.served(entry)
+        return True
+
+    def _basic(
+            self, func, client, startline, headers, cache=False, cached=None,
+            flight=None):
+        """Relay a request upstream with func.
+
+        cache: store the response in self.cache if cacheable.
+        cached: stale cache Entry to revalidate.
+        flight: collapse.Flight to pass the relayed response to.
+        """
         code = self.REARM
-        kwargs = dict(headers=headers)
-        if dlen is None:
-            if withdata:
-                kwargs['data'] = client.r
-                code = self.CLOSE
+        body = Body.fromheaders(client.r, headers)
+        if cached is None:
+            reqheaders = headers
         else:
-            kwargs['data'] = client.r.read(int(dlen))
+            reqheaders = cached.conditional(headers)
+        # requests sets content-length/transfer-encoding for the body
+        kwargs = dict(headers=dict([
+            (k, v) for k, v in reqheaders.items()
+            if k.lower() not in ('content-length', 'transfer-encoding')]))
+        if body is not None:
+            kwargs['data'] = body
+        parent = None
+        if self.parents is not None:
+            url = urlsplit(startline.resource)
+            parent = self.parent('{}:{}'.format(
+                url.hostname, url.port or (443 if url.scheme == 'https' else 80)))
+            if parent is not None:
+                kwargs['proxies'] = dict(http=parent.url, https=parent.url)
         w = client.w
+        metrics = self.metrics
         try:
+            sent = time.time()
             response = func(startline.resource, timeout=self.timeout, stream=True, **kwargs)
-        except Exception:
+        except Exception as e:
+            if parent is not None and isinstance(e, (ProxyError, ConnectTimeout)):
+                self.parents.failed(parent)
+            metrics.upstreamerrors.inc()
             traceback.print_exc()
             data = traceback.format_exc().encode('utf-8')
+            client.status = 500
+            client.nbytes = len(data)
             w.write(
                 b'HTTP/1.1 500 Server Error\r\n'
                 b'Content-Type: text\r\n')
             w.write('Content-Length: {}\r\n\r\n'.format(len(data)).encode('utf-8'))
             w.write(data)
+            if body is not None and not body.done:
+                code = self.CLOSE
         else:
-            self.log(name(client.f), startline.resource, response.status_code, response.reason)
-            w.write(
-                'HTTP/1.1 {} {}\r\n'.format(
-                    response.status_code, response.reason).encode('utf-8'))
-            for header in response.headers.items():
-                w.write(': '.join(header).encode('utf-8'))
-                w.write(b'\r\n')
-            w.write(b'\r\n')
-            with response as resp:
-                for chunk in resp.iter_content(io.DEFAULT_BUFFER_SIZE):
-                    w.write(chunk)
-            w.flush()
-            #client.w.write(response.content)
+            if body is not None and not body.done:
+                # Response before the whole body was sent, cannot find
+                # the next request.
+                code = self.CLOSE
+            if parent is not None:
+                self.parents.succeeded(parent)
+            received = time.time()
+            client.upstream = received - sent
+            client.status = response.status_code
+            tracer = self.tracer
+            if tracer is not None:
+                tracer.span(
+                    'upstream', sent, received, 'upstream',
+                    url=startline.resource, status=response.status_code)
+            metrics.ttfb.observe(client.upstream)
+            metrics.responses.labels(str(response.status_code)).inc()
+            if cached is not None:
+                if response.status_code == 304:
+                    response.close()
+                    updates = list(response.headers.items())
+                    if cached.encoding == 'gzip':
+                        updates = gzipheaders(updates)
+                    entry = self.cache.refresh(cached, updates)
+                    if self._sendcached(client, entry, headers):
+                        return code
+                    return self._basic(
+                        func, client, startline, headers, cache)
+                self.cache.missed()
+            raw = response.raw
+            respheaders = list(getattr(raw.headers, 'iteritems', raw.headers.items)())
+            store = None
+            if cache:
+                store = self.cache.store(
+                    startline.resource, headers, response.status_code,
+                    response.reason, respheaders)
+            gz = None
+            if self.compressor is not None:
+                gz = self.compressor.start(
+                    headers, response.status_code, respheaders)
+            with response:
+                if not self._relay(
+                        client, response, respheaders, store, gz, flight):
+                    code = self.CLOSE
+            if tracer is not None:
+                tracer.span(
+                    'relay', received, time.time(), 'relay',
+                    bytes=client.nbytes, gzip=gz is not None)
         return code
 
-    def do_GET(self, *args):
-        return self._basic(requests.get, False, *args)
+    def _relay(
+            self, client, response, respheaders, store=None, gz=None,
+            flight=None):
+        """Relay response to client with its original encoding.
+
+        The body is copied without content decoding.  Content-Length
+        bodies are copied verbatim and chunked bodies are re-chunked.
+        Return False if the body was delimited by closing the
+        connection.
+
+        gz: GzipStream to gzip the body with instead.  It is sent
+            chunked and stored as a gzip variant next to the original.
+        flight: collapse.Flight led by the request.  What is sent is
+            passed to it for its followers and it is finished if the
+            whole response was sent.
+        """
+        raw = response.raw
+        status = response.status_code
+        chunked = False
+        length = None
+        gzstore = None
+        if gz is not None:
+            if store is not None:
+                gzstore = store.variant('gzip', gzipheaders(store.entry.headers))
+            respheaders = gzipheaders(respheaders)
+            respheaders.append(('Transfer-Encoding', 'chunked'))
+        parts = ['HTTP/1.1 {} {}\r\n'.format(status, response.reason).encode('utf-8')]
+        for k, v in respheaders:
+            lk = k.lower()
+            if lk in RELAY_HOP_HEADERS:
+                continue
+            elif lk == 'transfer-encoding':
+                chunked = 'chunked' in v.lower()
+            elif lk == 'content-length':
+                length = v
+            parts.append('{}: {}\r\n'.format(k, v).encode('utf-8'))
+        bodyless = status < 200 or status in (204, 304)
+        delimited = bodyless or chunked or length is not None
+        if not delimited:
+            parts.append(b'Connection: close\r\n')
+        parts.append(b'\r\n')
+        w = client.w
+        w.flush()
+        sendv(client.socket, parts)
+        if flight is not None and not flight.share(
+                b''.join(parts), status, delimited, respheaders):
+            flight = None
+        if bodyless:
+            if store is not None:
+                store.finish()
+            if flight is not None:
+                flight.finish(True)
+            return True
+        try:
+            for chunk in raw.stream(RELAY_CHUNKSIZE, decode_content=False):
+                if store is not None:
+                    store.write(chunk)
+                if gz is not None:
+                    chunk = gz.compress(chunk)
+                    if not chunk:
+                        continue
+                    if gzstore is not None:
+                        gzstore.write(chunk)
+                if chunked:
+                    size = '{:x}\r\n'.format(len(chunk)).encode('ascii')
+                    w.write(size)
+                    w.write(chunk)
+                    w.write(b'\r\n')
+                    if flight is not None and not flight.write(
+                            b''.join((size, chunk, b'\r\n'))):
+                        flight = None
+                else:
+                    w.write(chunk)
+                    if flight is not None and not flight.write(chunk):
+                        flight = None
+                client.nbytes += len(chunk)
+            tail = b''
+            if gz is not None:
+                chunk = gz.finish()
+                if gzstore is not None:
+                    gzstore.write(chunk)
+                tail = b''.join((
+                    '{:x}\r\n'.format(len(chunk)).encode('ascii'), chunk, b'\r\n'))
+                client.nbytes += len(chunk)
+                self._compressed(gz)
+                self.metrics.compresssaved.inc(gz.nin - gz.nout)
+            if chunked:
+                tail += b'0\r\n\r\n'
+                w.write(tail)
+                if flight is not None:
+                    flight.write(tail)
+        except Exception:
+            for s in (store, gzstore):
+                if s is not None:
+                    s.abort()
+            raise
+        if store is not None:
+            store.finish()
+        if gzstore is not None:
+            gzstore.entry.rawsize = gz.nin
+            gzstore.finish()
+        if flight is not None:
+            flight.finish(True)
+        w.flush()
+        return delimited
+
+    def _compressed(self, gz):
+        """Count a finished GzipStream."""
+        metrics = self.metrics
+        metrics.compressed.inc()
+        metrics.compressin.inc(gz.nin)
+        metrics.compressout.inc(gz.nout)
+        metrics.compresscpu.inc(gz.cpu)
+
+    def _gzipcached(self, entry):
+        """Store entry's body gzipped.
+
+        The body is compressed a chunk at a time and given up on if the
+        cpu budget runs out.  Return the gzip Entry or None if it could
+        not be stored.
+        """
+        cache = self.cache
+        compressor = self.compressor
+        store = cache.variant(entry, 'gzip', gzipheaders(entry.headers))
+        gz = GzipStream(compressor)
+        f = None
+        if entry.body is None:
+            f = cache.open(entry)
+            if f is None:
+                store.abort()
+                return None
+            chunks = iter(lambda: f.read(RELAY_CHUNKSIZE), b'')
+        else:
+            body = memoryview(entry.body)
+            chunks = (
+                body[i:i + RELAY_CHUNKSIZE]
+                for i in range(0, len(body), RELAY_CHUNKSIZE))
+        try:
+            for chunk in chunks:
+                if not compressor.allowed():
+                    store.abort()
+                    return None
+                store.write(gz.compress(chunk))
+            store.write(gz.finish())
+        except Exception:
+            store.abort()
+            raise
+        finally:
+            if f is not None:
+                f.close()
+        self._compressed(gz)
+        store.entry.rawsize = gz.nin
+        return store.finish()
+
+    def localresponse(self, startline, sockname, ip):
+        """Return a response if startline is for the proxy itself.
+
+        sockname: local address the request was received on.
+        ip: the client's ip.
+        Paths are served for themselves and for absolute urls to the
+        proxy:
+
+        /metrics: the metrics.
+        /debug/trace: the recorded spans as Chrome trace event json.
+        /debug/profile?seconds=N: start profile(N).
+        /debug/profile: the report of the last profile.
+
+        /debug paths are only served with debugendpoints and only to
+        loopback and debugallowed clients, the others get 403.
+        """
+        resource = startline.resource
+        if not resource.startswith('/'):
+            parts = urlsplit(resource)
+            try:
+                port = parts.port
+            except ValueError:
+                return None
+            if port != sockname[1] or parts.hostname not in (
+                    sockname[0], 'localhost', socket.gethostname()):
+                return None
+            resource = parts.path
+        path, _, query = resource.partition('?')
+        if path.startswith('/debug/') and self.debugendpoints:
+            try:
+                allowed = self.debugfilter(ip.split('%', 1)[0])
+            except (ValueError, struct.error):
+                allowed = False
+            if not allowed:
+                return self._textresponse(
+                    '403 Forbidden', 'Debug endpoints are local only.\n')
+            return self.debugresponse(path, query)
+        if path != '/metrics':
+            return None
+        if self.statsdir is None:
+            data = self.metrics.render()
+        else:
+            data = self.combinedstats()
+        data = data.encode('utf-8')
+        return (
+            'HTTP/1.1 200 OK\r\n'
+            'Content-Type: text/plain; version=0.0.4\r\n'
+            'Content-Length: {}\r\n\r\n').format(len(data)).encode('utf-8') + data
+
+    def debugresponse(self, path, query):
+        """Return a response for a /debug path, None if unknown."""
+        ctype = 'text/plain'
+        status = '200 OK'
+        if path == '/debug/trace':
+            if self.tracer is None:
+                status = '404 Not Found'
+                data = 'Spans are not recorded, see trace.\n'
+            else:
+                ctype = 'application/json'
+                f = io.StringIO()
+                self.tracer.dump(f)
+                data = f.getvalue()
+        elif path == '/debug/profile':
+            args = dict([
+                arg.partition('=')[::2] for arg in query.split('&') if arg])
+            if 'seconds' in args:
+                try:
+                    seconds = float(args['seconds'])
+                    paths = self.profile(seconds)
+                except ValueError:
+                    status = '400 Bad Request'
+                    data = 'seconds must be a positive number.\n'
+                else:
+                    if paths is None:
+                        status = '409 Conflict'
+                        data = 'Already profiling.\n'
+                    else:
+                        status = '202 Accepted'
+                        data = 'Profiling for {}s into {}\n'.format(
+                            min(seconds, self.profilemax), ', '.join(paths))
+            elif self.profiler.report is None:
+                status = '404 Not Found'
+                data = 'Not profiled yet, add ?seconds=N to start.\n'
+            else:
+                data = self.profiler.report
+        else:
+            return None
+        return self._textresponse(status, data, ctype)
+
+    @staticmethod
+    def _textresponse(status, data, ctype='text/plain'):
+        data = data.encode('utf-8')
+        return (
+            'HTTP/1.1 {}\r\n'
+            'Content-Type: {}\r\n'
+            'Content-Length: {}\r\n\r\n').format(
+                status, ctype, len(data)).encode('utf-8') + data
+
+    def dumptrace(self, path=None):
+        """Write the recorded spans as Chrome trace event json.
+
+        path: file to write, default a new file in profiledir.
+        Return the path or None if spans are not recorded.
+        """
+        if self.tracer is None:
+            return None
+        if path is None:
+            path = os.path.join(self.profiler.outdir, 'proxy-{}-{}.trace.json'.format(
+                os.getpid(), time.strftime('%Y%m%d-%H%M%S')))
+        with open(path, 'w') as f:
+            self.tracer.dump(f)
+        self.log('trace written to', path)
+        return path
+
+    def profile(self, seconds=None):
+        """Sample stacks and trace allocations for seconds.
+
+        Runs in the background, the results are written to profiledir.
+        seconds is limited to profilemax.  Return their paths or None
+        if already profiling.  Raise ValueError if seconds is not a
+        positive number.
+        """
+        if seconds is None:
+            seconds = self.profileseconds
+        if not 0 < seconds < float('inf'):
+            raise ValueError('Bad profile seconds {!r}'.format(seconds))
+        return self.profiler.start(min(seconds, self.profilemax))
+
+    def handlesignals(self):
+        """dumptrace() on SIGUSR1 and profile() on SIGUSR2.
+
+        The handlers only note the signal and wake the poll loop, which
+        does the work in runsignalled().  Main thread only.
+        """
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, self._signal)
+            signal.signal(signal.SIGUSR2, self._signal)
+
+    def _signal(self, signum, frame):
+        self.signalled.append(signum)
+        engine = self._engine
+        if engine is not None:
+            engine.wake()
+        elif self.engine == 'threads' and self.ev is not None:
+            self.ev.set()
+
+    def runsignalled(self):
+        """Do the work for signals noted by the handlers."""
+        while 1:
+            try:
+                signum = self.signalled.pop(0)
+            except IndexError:
+                return
+            try:
+                if signum == signal.SIGUSR1:
+                    self.dumptrace()
+                else:
+                    self.profile()
+            except Exception:
+                traceback.print_exc()
+
+    def savestats(self):
+        """Save this process's metrics to statsdir."""
+        path = os.path.join(self.statsdir, '{}.json'.format(os.getpid()))
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.metrics.snapshot(), f)
+        os.replace(tmp, path)
+
+    def combinedstats(self):
+        """Return the sum of the metrics of all workers in statsdir."""
+        self.savestats()
+        snapshots = []
+        for name in os.listdir(self.statsdir):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.statsdir, name)) as f:
+                    snapshots.append(json.load(f))
+            except (IOError, OSError, ValueError):
+                # worker exited or was restarted
+                pass
+        return render_snapshots(snapshots)
+
+    def _statsloop(self, stop):
+        while not stop.wait(self.statsinterval):
+            try:
+                self.savestats()
+            except Exception:
+                traceback.print_exc()
+
+    def do_GET(self, client, startline, headers):
+        response = self.localresponse(
+            startline, client.socket.getsockname(), client.ip)
+        if response is not None:
+            client.status = 200
+            client.nbytes = len(response)
+            client.w.write(response)
+            return self.REARM
+        return self._get(client, startline, headers)
+
+    def _get(self, client, startline, headers, collapse=True):
+        """Serve a GET from the cache, another request's fetch or upstream.
+
+        collapse: whether the request may lead or follow a Flight.
+        """
+        cache = self.cache
+        compressor = self.compressor
+        encodings = ()
+        if compressor is not None and accepts(headers.get('accept-encoding')):
+            encodings = ('gzip',)
+        entry = None
+        if cache is not None:
+            entry = cache.lookup(startline.resource, headers, encodings)
+        if entry is not None:
+            if entry.fresh(time.time()) and not cache.mustrevalidate(headers):
+                if (
+                        encodings and entry.encoding is None
+                        and entry.size <= self.gzipcached
+                        and compressor.compressible(entry.status, entry.headers + [
+                            ('Content-Length', str(entry.size))])
+                        and compressor.allowed()):
+                    entry = self._gzipcached(entry) or entry
+                if self._sendcached(client, entry, headers):
+                    return self.REARM
+                entry = None
+            elif not (entry.etag or entry.lastmod):
+                entry = None
+        flight = None
+        if collapse and self.collapser is not None and collapsible(headers):
+            flight, follower = self.collapser.join(
+                (startline.resource, encodings), headers)
+            if follower is not None:
+                code = self._follow(client, flight, follower, headers)
+                if code is None:
+                    self.metrics.collapsed.labels('refetched').inc()
+                    return self._get(client, startline, headers, False)
+                self.metrics.collapsed.labels(
+                    'dropped' if follower.dropped else 'followed').inc()
+                return code
+        try:
+            return self._basic(
+                self.pool.get, client, startline, headers,
+                cache is not None, entry, flight)
+        finally:
+            if flight is not None:
+                flight.finish(False)
+
+    def _follow(self, client, flight, follower, headers):
+        """Send the response of the request leading flight.
+
+        Return None if it cannot be shared with this request.  The
+        client is closed if it falls too far behind the leader.
+        """
+        head = flight.wait(follower, headers)
+        if head is None:
+            return None
+        client.status = flight.status
+        w = client.w
+        try:
+            w.write(head)
+            for data in flight.read(follower):
+                w.write(data)
+                client.nbytes += len(data)
+        finally:
+            flight.leave(follower)
+        if flight.complete and flight.delimited and not follower.dropped:
+            return self.REARM
+        return self.CLOSE
+
     def do_POST(self, *args):
-        return self._basic(requests.post, True, *args)
+        return self._basic(self.pool.post, *args)
     def do_PUT(self, *args):
-        return self._basic(requests.put, True, *args)
+        return self._basic(self.pool.put, *args)
 
     def default(self, client, startline, headers):
-        self.log(name(client.f), startline.method, 'unsupported')
+        client.status = 501
         client.f.write(b'HTTP/1.1 501 Not Implemented\r\n\r\n')
         return self.REARM
 
-    def handleloop(self):
-        """Handle requests from queue.
+    def handle(self, client, startline, headers):
+        """Handle one request whose head was parsed, return the code."""
+        metrics = self.metrics
+        metrics.busy.inc()
+        start = time.time()
+        client.status = client.upstream = None
+        client.nbytes = 0
+        try:
+            method = startline.method.upper()
+            func = getattr(self, 'do_'+method, None)
+            if func is None:
+                metrics.requests.labels('other').inc()
+                func = self.default
+            else:
+                metrics.requests.labels(method).inc()
+            code = func(client, startline, headers)
+        except HTTPError as e:
+            self.log(name(client.f), e.code, ':', e.args[0])
+            if e.code>0:
+                client.status = e.code
+                client.w.write('HTTP/1.1 {} {}\r\n\r\n'.format(e.code, e.args[0]).encode('utf-8'))
+            if e.code < 0:
+                # The next request cannot be found after a bad body.
+                code = self.CLOSE
+            else:
+                code = self.REARM
+        except Exception:
+            code = self.CLOSE
+            traceback.print_exc()
+        try:
+            client.w.flush()
+        except Exception:
+            traceback.print_exc()
+            code = self.CLOSE
+        metrics.busy.dec()
+        end = time.time()
+        duration = end - start
+        metrics.duration.observe(duration)
+        if code != self.DIAL:
+            self.accesslog.record(
+                name(client.f), startline.method, startline.resource,
+                client.status, client.nbytes, client.upstream, duration)
+        if self.tracer is not None:
+            self.tracer.span(
+                startline.method, start, end, 'request',
+                url=startline.resource, status=client.status,
+                bytes=client.nbytes)
+        return code
 
-        Clients with pending data are placed onto the queue.
-        The client is removed from the queue and handled.
-        Finally, it is placed into another queue for rearming.
+    def work(self, client):
+        """Handle the client's parsed request and ready requests after it.
+
+        Up to pipelinebudget more requests that can be read without
+        blocking are handled.  Return the code of the last one.
         """
-        nonempty = self._hasitems
-        cond = self.cond
-        q = self.q
-        while 1:
-            with cond:
-                if q or cond.wait_for(nonempty):
-                    if not self.running:
-                        return
-                    client = q.popleft()
+        metrics = self.metrics
+        parser = client.parser
+        client.parser = None
+        code = self.handle(client, parser.startline, parser.headers)
+        budget = self.pipelinebudget
+        while code == self.REARM and budget > 0:
             try:
-                startline = Startline(client.f)
-                headers = Headers(client.f)
-                method = startline.method.upper()
-                self.log(name(client.f), method, startline.resource)
-                code = getattr(self, 'do_'+method, self.default)(client, startline, headers)
+                parser = client.pending(self.headlimits)
             except HTTPError as e:
                 self.log(name(client.f), e.code, ':', e.args[0])
-                if e.code>0:
-                    f.write('HTTP/1.1 {} {}\r\n\r\n'.format(e.code, e.args[0]).encode('utf-8'))
-                code = self.CLOSE if e.code < 0 else self.REARM
-            except Exception:
-                code = self.CLOSE
-                traceback.print_exc()
-            try:
-                client.w.flush()
-            except Exception:
-                traceback.print_exc()
+                if e.code > 0:
+                    try:
+                        client.w.write('HTTP/1.1 {} {}\r\n\r\n'.format(
+                            e.code, e.args[0]).encode('utf-8'))
+                        client.w.flush()
+                    except Exception:
+                        traceback.print_exc()
                 code = self.CLOSE
-            with self.lock:
-                self.done.append((client, code))
-                self.ev.set()
+                break
+            if parser is None:
+                break
+            budget -= 1
+            metrics.pipelined.inc()
+            code = self.handle(client, parser.startline, parser.headers)
+        return code
 
     def run(self):
         """Accept new connections.
@@ -410,8 +1950,61 @@ class Proxy(object):
             if self.running:
                 raise RuntimeError("already running")
             self.running = True
+        self.accesslog.start()
+        if self.parents is not None:
+            self.parents.start()
+        statsstop = threading.Event()
+        if self.statsdir is not None:
+            statst = threading.Thread(target=self._statsloop, args=(statsstop,))
+            statst.daemon = True
+            statst.start()
+        try:
+            if self.engine == 'asyncio':
+                return self._runasync()
+            elif self.engine == 'loops':
+                return self._runloops()
+            return self._run()
+        finally:
+            statsstop.set()
+            if self.parents is not None:
+                self.parents.close()
+                self.log('parents', self.parents.stats())
+            self.accesslog.close()
+
+    def openshared(self):
+        """Create the tunnel forwarder and upstream pool."""
+        kwargs = dict(
+            tunnelbytes=self.metrics.tunnelbytes,
+            tunnelpeak=self.metrics.tunnelpeak, tracer=self.tracer,
+            **self.tunnelargs)
+        if self.shardargs['shards'] > 1 or self.shardargs['processes']:
+            kwargs.update(self.shardargs)
+            self.forwarder = ShardedForwarder(**kwargs)
+        else:
+            self.forwarder = MultiForwarder(**kwargs)
+        self.pool = UpstreamPool(
+            resolver=self.resolver, tracer=self.tracer, **self.poolargs)
+
+    def closeshared(self):
+        """Close the forwarder and upstream pool, log stats."""
+        self.log('tunnel buffers (current, peak)', self.forwarder.buffered())
+        self.forwarder.close()
+        self.log('upstream pool', self.pool.stats())
+        self.log('resolver', self.resolver.stats())
+        if self.cache is not None:
+            self.log('cache', self.cache.stats())
+        if self.compressor is not None:
+            self.log('gzip', self.compressor.stats())
+        if self.collapser is not None:
+            self.log('collapsed forwarding', self.collapser.stats())
+        self.pool.close()
+
+    def _run(self):
+        """Run the threads engine."""
         self.cond = threading.Condition(self.lock)
+        self.openshared()
         self.ev = Event()
+        self._timers = TimerWheel(now=time.time())
         server = Server(self)
         poller = self.poller = polling.Poller()
         poller.register(self.ev, poller.RFLAGS)
@@ -419,14 +2012,16 @@ class Proxy(object):
         handlers = [
             threading.Thread(target=self.handleloop)
             for i in range(self.numthreads)]
-        self.forwarder = MultiForwarder()
         for h in handlers:
             h.start()
         try:
+            timeout = None
             while 1:
-                r, w, x = poller.poll()
-                for thing in r:
-                    thing(self)
+                r, w, x = poller.poll(timeout)
+                self._dispatch(r)
+                self._dispatch(w)
+                self._dispatcherrors(r, w, x)
+                timeout = self._runtimers()
         except (StopServing, KeyboardInterrupt):
             pass
         except Exception:
@@ -438,12 +2033,33 @@ class Proxy(object):
                 self.cond.notify_all()
             for t in handlers:
                 t.join()
-            self.forwarder.close()
+            self.closeshared()
             self.poller.unregister(self.ev)
             self.poller.unregister(server)
             self.poller.close()
             self.ev.close()
 
+    def _runloops(self):
+        from .loops import LoopEngine
+        self._engine = LoopEngine(self)
+        try:
+            self._engine.run()
+        finally:
+            with self.lock:
+                self._engine = None
+
+    def _runasync(self):
+        from .aioproxy import AsyncEngine
+        self._engine = AsyncEngine(self)
+        try:
+            self._engine.run()
+        except Exception:
+            traceback.print_exc()
+        finally:
+            with self.lock:
+                self.running = False
+                self._engine = None
+
     def start(self):
         """Start server in separate thread."""
         with self.lock:
@@ -457,7 +2073,10 @@ class Proxy(object):
             if self.t is None:
                 return
             self.running = False
-            self.ev.set()
+            if self.engine == 'threads':
+                self.ev.set()
+            elif self._engine is not None:
+                self._engine.stop()
         self.t.join()
         with self.lock:
             self.t = None
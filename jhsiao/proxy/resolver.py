@@ -0,0 +1,245 @@
+"""Cached name resolution and happy-eyeballs connects.
+
+Resolver caches getaddrinfo results (including failures) for a fixed
+ttl in a bounded LRU.  Addresses are interleaved by family and the
+address that answered first is moved to the front for later connects.
+
+Race implements RFC 8305 style staggered connection attempts.  It only
+manages non-blocking sockets so it can be driven by a poll loop or by
+Resolver.connect() which blocks with a selector.
+"""
+from __future__ import print_function
+__all__ = ['Resolver', 'Race']
+from collections import OrderedDict
+import errno
+import os
+import selectors
+import socket
+import threading
+import time
+
+
+def interleave(addrs):
+    """Alternate address families, keeping the first result first."""
+    if not addrs:
+        return addrs
+    first = addrs[0][0]
+    a = [info for info in addrs if info[0] == first]
+    b = [info for info in addrs if info[0] != first]
+    ret = []
+    for pair in zip(a, b):
+        ret.extend(pair)
+    n = min(len(a), len(b))
+    ret.extend(a[n:])
+    ret.extend(b[n:])
+    return ret
+
+
+class Race(object):
+    """Staggered non-blocking connection attempts."""
+    def __init__(self, addrs, delay=0.25, source_address=None):
+        """Initialize.
+
+        addrs: getaddrinfo results in order of preference.
+        delay: seconds between launching attempts.
+        source_address: address to bind before connecting.
+        """
+        self.pending = list(reversed(addrs))
+        self.attempts = {}
+        self.delay = delay
+        self.source_address = source_address
+        self.error = None
+        self.nextlaunch = None
+
+    def launch(self, now):
+        """Start the next connection attempt.
+
+        Return the non-blocking socket or None if there are no more
+        addresses.
+        """
+        while self.pending:
+            family, socktype, proto, _, addr = self.pending.pop()
+            sock = socket.socket(family, socktype, proto)
+            sock.setblocking(False)
+            try:
+                if self.source_address:
+                    sock.bind(self.source_address)
+                code = sock.connect_ex(addr)
+            except socket.error as e:
+                code = e.errno
+            if code in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                self.attempts[sock] = addr
+                self.nextlaunch = now + self.delay if self.pending else None
+                return sock
+            sock.close()
+            self.error = socket.error(code, os.strerror(code))
+        self.nextlaunch = None
+        return None
+
+    def check(self, sock):
+        """Return the address if writable sock connected.
+
+        Otherwise close it and return None.
+        """
+        addr = self.attempts.pop(sock)
+        code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if code:
+            sock.close()
+            self.error = socket.error(code, os.strerror(code))
+            return None
+        return addr
+
+    def failed(self):
+        """Return whether every attempt failed."""
+        return not self.pending and not self.attempts
+
+    def close(self):
+        """Close any attempts still in flight."""
+        for sock in self.attempts:
+            sock.close()
+        self.attempts.clear()
+        del self.pending[:]
+
+
+class Resolver(object):
+    """Thread-safe getaddrinfo cache."""
+    def __init__(
+            self, ttl=60, negttl=5, maxsize=1024, delay=0.25, lookups=None):
+        """Initialize.
+
+        ttl: seconds to cache successful lookups.
+        negttl: seconds to cache failed lookups.
+        maxsize: max number of cached names.
+        delay: happy-eyeballs delay between connection attempts.
+        lookups: metrics.Histogram to observe the seconds each
+            getaddrinfo call took, failed ones included.
+        """
+        self.ttl = ttl
+        self.negttl = negttl
+        self.maxsize = maxsize
+        self.delay = delay
+        self.lookups = lookups
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.counts = dict(
+            hits=0, misses=0, negative=0, failures=0, evicted=0,
+            resolvetime=0.0)
+
+    def cached(self, host, port):
+        """Return cached addresses without resolving.
+
+        Return None on a miss.  Raise the cached error for negative
+        entries.
+        """
+        key = (host, port)
+        now = time.time()
+        with self.lock:
+            item = self.cache.get(key)
+            if item is None:
+                return None
+            expires, addrs = item
+            if expires <= now:
+                del self.cache[key]
+                return None
+            self.cache.move_to_end(key)
+            if isinstance(addrs, Exception):
+                self.counts['negative'] += 1
+                raise addrs
+            self.counts['hits'] += 1
+            return list(addrs)
+
+    def resolve(self, host, port):
+        """Return getaddrinfo results for stream connections to host."""
+        addrs = self.cached(host, port)
+        if addrs is not None:
+            return addrs
+        start = time.time()
+        try:
+            addrs = interleave(socket.getaddrinfo(
+                host, port, 0, socket.SOCK_STREAM))
+        except socket.gaierror as e:
+            now = time.time()
+            self._store((host, port), now + self.negttl, e, now - start, 'failures')
+            raise
+        now = time.time()
+        self._store((host, port), now + self.ttl, addrs, now - start, 'misses')
+        return list(addrs)
+
+    def _store(self, key, expires, addrs, elapsed, counter):
+        with self.lock:
+            cache = self.cache
+            cache[key] = (expires, addrs)
+            cache.move_to_end(key)
+            while len(cache) > self.maxsize:
+                cache.popitem(last=False)
+                self.counts['evicted'] += 1
+            counts = self.counts
+            counts[counter] += 1
+            counts['resolvetime'] += elapsed
+        if self.lookups is not None:
+            self.lookups.observe(elapsed)
+
+    def prefer(self, host, port, sockaddr):
+        """Move sockaddr to the front of the cached addresses."""
+        key = (host, port)
+        with self.lock:
+            item = self.cache.get(key)
+            if item is None or isinstance(item[1], Exception):
+                return
+            addrs = item[1]
+            for i, info in enumerate(addrs):
+                if info[4] == sockaddr:
+                    if i:
+                        addrs = [info] + addrs[:i] + addrs[i+1:]
+                        self.cache[key] = (item[0], addrs)
+                    return
+
+    def connect(self, host, port, timeout=None, source_address=None):
+        """Return a socket connected to host by racing its addresses.
+
+        The socket has the given timeout.
+        """
+        race = Race(
+            self.resolve(host, port), self.delay, source_address)
+        deadline = None if timeout is None else time.time() + timeout
+        sel = selectors.DefaultSelector()
+        try:
+            now = time.time()
+            sock = race.launch(now)
+            if sock is None:
+                raise race.error
+            sel.register(sock, selectors.EVENT_WRITE)
+            while 1:
+                waits = [t - now for t in (deadline, race.nextlaunch) if t is not None]
+                for key, _ in sel.select(max(min(waits), 0) if waits else None):
+                    sock = key.fileobj
+                    sel.unregister(sock)
+                    addr = race.check(sock)
+                    if addr is not None:
+                        self.prefer(host, port, addr)
+                        sock.settimeout(timeout)
+                        return sock
+                now = time.time()
+                if deadline is not None and now >= deadline:
+                    raise socket.timeout('timed out')
+                if not race.attempts or (
+                        race.nextlaunch is not None and now >= race.nextlaunch):
+                    sock = race.launch(now)
+                    if sock is not None:
+                        sel.register(sock, selectors.EVENT_WRITE)
+                if race.failed():
+                    raise race.error
+        finally:
+            race.close()
+            sel.close()
+
+    def stats(self):
+        """Return dict of cache counts, hit rate, and mean resolve time."""
+        with self.lock:
+            ret = dict(self.counts)
+            ret['size'] = len(self.cache)
+        lookups = ret['hits'] + ret['negative'] + ret['misses'] + ret['failures']
+        resolved = ret['misses'] + ret['failures']
+        ret['hitrate'] = (ret['hits'] + ret['negative']) / float(lookups) if lookups else 0.0
+        ret['meanresolve'] = ret['resolvetime'] / resolved if resolved else 0.0
+        return ret
@@ -0,0 +1,110 @@
+"""Fixed-size buffers shared under a byte budget.
+
+Forwarders take slabs as data arrives and give them back as soon as it
+is written, so idle tunnels hold no buffer memory.  Once the budget is
+used up acquire() fails and the caller should stop reading until one
+of its waiters is called.
+"""
+__all__ = ['SlabPool']
+import threading
+
+class SlabPool(object):
+    """Thread-safe pool of bytearray slabs.
+
+    Slabs are taken and returned in batches so a read costs one lock
+    acquisition no matter how many slabs it spans.  reserve() charges
+    slabs against the budget without allocating them, for data held
+    elsewhere such as in a splice pipe.
+    """
+    def __init__(self, budget=None, slabsize=0x4000, maxfree=0x400000):
+        """Initialize.
+
+        budget: max bytes of slabs in use, None for no limit.
+        slabsize: bytes per slab.
+        maxfree: bytes of released slabs to keep for reuse.
+        """
+        if budget is not None and budget < slabsize:
+            raise ValueError(
+                'budget {} is smaller than a slab ({})'.format(budget, slabsize))
+        self.budget = budget
+        self.slabsize = slabsize
+        self.maxfree = maxfree // slabsize
+        self.lock = threading.Lock()
+        self.free = []
+        self.waiters = []
+        self.inuse = 0
+        self.peak = 0
+
+    def _charge(self, count, waiter):
+        """Charge up to count slabs, return the number charged.
+
+        Lock must be held.
+        """
+        if self.budget is not None:
+            count = min(count, (self.budget - self.inuse) // self.slabsize)
+            if count <= 0:
+                if waiter is not None and waiter not in self.waiters:
+                    self.waiters.append(waiter)
+                return 0
+        self.inuse += count * self.slabsize
+        if self.inuse > self.peak:
+            self.peak = self.inuse
+        return count
+
+    def reserve(self, count=1, waiter=None):
+        """Charge up to count slabs without allocating them.
+
+        Return the number charged.  If none could be, waiter is called
+        once with no args when slabs are released.
+        """
+        with self.lock:
+            return self._charge(count, waiter)
+
+    def _slabs(self, count):
+        """Return count slabs, reusing free ones.  Lock must be held."""
+        free = self.free
+        reuse = min(count, len(free))
+        slabs = free[len(free)-reuse:]
+        del free[len(free)-reuse:]
+        return slabs
+
+    def acquire(self, count=1, waiter=None):
+        """Return a list of up to count slabs, see reserve()."""
+        with self.lock:
+            count = self._charge(count, waiter)
+            slabs = self._slabs(count)
+        return self._alloc(slabs, count)
+
+    def fill(self, count):
+        """Return count slabs for reservations already charged."""
+        with self.lock:
+            slabs = self._slabs(count)
+        return self._alloc(slabs, count)
+
+    def _alloc(self, slabs, count):
+        slabsize = self.slabsize
+        for _ in range(count - len(slabs)):
+            slabs.append(bytearray(slabsize))
+        return slabs
+
+    def release(self, slabs=(), reserved=0):
+        """Return slabs from acquire() and reserved reservations."""
+        with self.lock:
+            self.inuse -= (len(slabs) + reserved) * self.slabsize
+            free = self.free
+            keep = self.maxfree - len(free)
+            if keep > 0:
+                free.extend(slabs[:keep])
+            waiters = self.waiters
+            if not waiters:
+                return
+            self.waiters = []
+        for waiter in waiters:
+            waiter()
+
+    def stats(self):
+        """Return dict of budget, inuse, peak and free bytes."""
+        with self.lock:
+            return dict(
+                budget=self.budget, inuse=self.inuse, peak=self.peak,
+                free=len(self.free) * self.slabsize)
@@ -0,0 +1,96 @@
+"""Hashed timer wheel.
+
+Timers are hashed into slots by their expiry tick so scheduling and
+cancelling are O(1) no matter how many connections have deadlines.
+Expiry is rounded up to the tick so timers never fire early.
+"""
+__all__ = ['TimerWheel']
+import itertools
+import math
+
+class TimerWheel(object):
+    """Timers with tick resolution.
+
+    Not thread-safe.
+    """
+    def __init__(self, tick=0.01, slots=1024, now=0):
+        """Initialize.
+
+        tick: resolution in seconds.
+        slots: number of slots.  Timers further than tick*slots away
+            stay in their slot for multiple rotations.
+        now: the current time.
+        """
+        self.tick = tick
+        self.slots = [dict() for _ in range(slots)]
+        self.current = int(now / tick)
+        self.ids = itertools.count()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def schedule(self, delay, callback, now):
+        """Add a timer for callback at now+delay.
+
+        Return a handle for cancel().
+        """
+        ticks = max(
+            int(math.ceil((now + delay) / self.tick)), self.current + 1)
+        timer = [ticks, next(self.ids), callback]
+        self.slots[ticks % len(self.slots)][timer[1]] = timer
+        self.size += 1
+        return timer
+
+    def cancel(self, timer):
+        """Cancel a timer if it has not expired yet."""
+        if timer is not None and timer[2] is not None:
+            if self.slots[timer[0] % len(self.slots)].pop(timer[1], None):
+                self.size -= 1
+            timer[2] = None
+
+    def expire(self, now):
+        """Remove and return the callbacks of timers due by now.
+
+        Callbacks are in expiry order.
+        """
+        target = int(now / self.tick)
+        current = self.current
+        if target <= current:
+            return []
+        self.current = target
+        if not self.size:
+            return []
+        slots = self.slots
+        nslots = len(slots)
+        if target - current >= nslots:
+            visit = slots
+        else:
+            visit = [slots[t % nslots] for t in range(current + 1, target + 1)]
+        due = []
+        for slot in visit:
+            if slot:
+                for tid in [
+                        tid for tid, timer in slot.items()
+                        if timer[0] <= target]:
+                    due.append(slot.pop(tid))
+        if not due:
+            return []
+        self.size -= len(due)
+        due.sort()
+        ret = []
+        for timer in due:
+            ret.append(timer[2])
+            timer[2] = None
+        return ret
+
+    def timeout(self, now):
+        """Return seconds until the next slot with timers, None if none."""
+        if not self.size:
+            return None
+        slots = self.slots
+        nslots = len(slots)
+        for ticks in range(self.current + 1, self.current + 1 + nslots):
+            if slots[ticks % nslots]:
+                return max(0, ticks * self.tick - now)
+        return None
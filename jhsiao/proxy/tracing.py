@@ -0,0 +1,56 @@
+"""Per-request spans exportable as Chrome trace events.
+
+Spans are recorded when they end, as (name, category, start, end,
+thread, args) in a ring buffer of the latest ones.  Appending to a
+deque is thread-safe so recording takes no lock.  events() converts
+them to the trace event format read by chrome://tracing and Perfetto.
+"""
+__all__ = ['Tracer']
+from collections import deque
+import json
+import os
+import threading
+
+class Tracer(object):
+    """Record the latest spans."""
+    def __init__(self, maxspans=100000):
+        """Initialize.
+
+        maxspans: number of latest spans to keep.
+        """
+        self.spans = deque(maxlen=maxspans)
+        self.pid = os.getpid()
+
+    def span(self, name, start, end, cat='proxy', **args):
+        """Record a span from start to end (time.time() seconds).
+
+        It is attributed to the calling thread.  args are shown with
+        the span.
+        """
+        self.spans.append(
+            (name, cat, start, end, threading.get_ident(), args))
+
+    def events(self):
+        """Return the spans as a list of trace event dicts."""
+        pid = self.pid
+        spans = list(self.spans)
+        tids = set()
+        ret = []
+        for name, cat, start, end, tid, args in spans:
+            tids.add(tid)
+            ret.append(dict(
+                name=name, cat=cat, ph='X', ts=start * 1e6,
+                dur=(end - start) * 1e6, pid=pid, tid=tid, args=args))
+        names = dict([(t.ident, t.name) for t in threading.enumerate()])
+        for tid in tids:
+            ret.append(dict(
+                name='thread_name', ph='M', pid=pid, tid=tid,
+                args=dict(name=names.get(tid, str(tid)))))
+        return ret
+
+    def dump(self, f):
+        """Write the spans to text file f as trace event json."""
+        json.dump(dict(traceEvents=self.events(), displayTimeUnit='ms'), f)
+
+    def stats(self):
+        return dict(spans=len(self.spans), maxspans=self.spans.maxlen)
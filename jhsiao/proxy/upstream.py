@@ -0,0 +1,251 @@
+"""Pooled persistent upstream connections.
+
+The module-level requests.get/post/put create a new Session for every
+call so connections to the origin are never reused.  UpstreamPool owns
+a single Session shared by all handler threads whose urllib3 pools keep
+persistent connections per host.  Connections idle for too long or
+older than the max lifetime are closed instead of being reused.
+Requests sent through a parent proxy are pooled per parent the same way.
+New connections are made through the proxy's Resolver so lookups are
+cached and addresses are raced.
+"""
+from __future__ import print_function
+__all__ = ['UpstreamPool']
+import numbers
+import socket
+import threading
+import time
+import traceback
+try:
+    from http.cookiejar import DefaultCookiePolicy
+except ImportError:
+    from cookielib import DefaultCookiePolicy
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import connection, connectionpool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+from .resolver import Resolver
+
+
+class _ConnectionMixin(object):
+    """Connect a urllib3 connection with a Resolver."""
+    resolver = None
+    tracer = None
+
+    def _new_conn(self):
+        timeout = self.timeout
+        if not isinstance(timeout, numbers.Number):
+            timeout = None
+        start = time.time()
+        try:
+            sock = self.resolver.connect(
+                self._dns_host, self.port, timeout, self.source_address)
+        except socket.timeout:
+            raise ConnectTimeoutError(
+                self, 'Connection to {} timed out. (connect timeout={})'.format(
+                    self.host, timeout))
+        except socket.error as e:
+            raise NewConnectionError(
+                self, 'Failed to establish a new connection: {}'.format(e))
+        for opt in self.socket_options or ():
+            sock.setsockopt(*opt)
+        if self.tracer is not None:
+            self.tracer.span(
+                'upstream connect', start, time.time(), 'upstream',
+                host=self.host, port=self.port)
+        return sock
+
+
+class _PoolMixin(object):
+    """Track reuse and expire connections of a urllib3 connection pool.
+
+    Connections are stamped with their connect time and the time they
+    were last returned to the pool.
+    """
+    upstream = None
+
+    def _get_conn(self, timeout=None):
+        conn = super(_PoolMixin, self)._get_conn(timeout)
+        upstream = self.upstream
+        now = time.time()
+        if getattr(conn, 'sock', None) is not None and upstream.expired(conn, now):
+            conn.close()
+            upstream._count('evicted')
+        if getattr(conn, 'sock', None) is None:
+            # urllib3 (re)connects lazily when the request is made.
+            conn._upstream_born = now
+            upstream._count('misses')
+        else:
+            upstream._count('hits')
+        return conn
+
+    def _put_conn(self, conn):
+        if conn is not None:
+            conn._upstream_used = time.time()
+        super(_PoolMixin, self)._put_conn(conn)
+
+    def evict(self, now):
+        """Close expired idle connections, return number closed."""
+        conns = []
+        q = self.pool
+        if q is None:
+            return 0
+        try:
+            while 1:
+                conns.append(q.get(block=False))
+        except Empty:
+            pass
+        closed = 0
+        try:
+            for conn in conns:
+                if (
+                        getattr(conn, 'sock', None) is not None
+                        and self.upstream.expired(conn, now)):
+                    conn.close()
+                    closed += 1
+        finally:
+            for conn in conns:
+                q.put(conn, block=False)
+        return closed
+
+
+class _Adapter(HTTPAdapter):
+    """HTTPAdapter whose poolmanager uses the tracking pools."""
+    def __init__(self, upstream, **kwargs):
+        self.upstream = upstream
+        super(_Adapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(_Adapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = self.upstream.poolclasses
+
+    def proxy_manager_for(self, proxy, **kwargs):
+        """Pool connections to parent proxies like origin connections."""
+        manager = super(_Adapter, self).proxy_manager_for(proxy, **kwargs)
+        manager.pool_classes_by_scheme = self.upstream.poolclasses
+        return manager
+
+
+class UpstreamPool(object):
+    """A requests Session with bounded persistent per-host pools."""
+    def __init__(
+            self, maxperhost=10, maxhosts=100, idle=30, lifetime=300,
+            resolver=None, tracer=None):
+        """Initialize.
+
+        maxperhost: max connections per origin host.  Handlers block
+            waiting for a free connection when reached.
+        maxhosts: number of per-host pools to keep.
+        idle: close connections idle for longer than this many seconds.
+        lifetime: close connections older than this many seconds.
+        resolver: Resolver to use for connecting.
+        tracer: tracing.Tracer to record connects with.
+        """
+        self.idle = float('inf') if idle is None else idle
+        self.lifetime = float('inf') if lifetime is None else lifetime
+        self.lock = threading.Lock()
+        self.counts = dict(hits=0, misses=0, evicted=0)
+        self.resolver = Resolver() if resolver is None else resolver
+        connattrs = dict(resolver=self.resolver, tracer=tracer)
+        self.poolclasses = {
+            'http': type(
+                'UpstreamHTTPConnectionPool',
+                (_PoolMixin, connectionpool.HTTPConnectionPool),
+                dict(upstream=self, ConnectionCls=type(
+                    'UpstreamHTTPConnection',
+                    (_ConnectionMixin, connection.HTTPConnection), connattrs))),
+            'https': type(
+                'UpstreamHTTPSConnectionPool',
+                (_PoolMixin, connectionpool.HTTPSConnectionPool),
+                dict(upstream=self, ConnectionCls=type(
+                    'UpstreamHTTPSConnection',
+                    (_ConnectionMixin, connection.HTTPSConnection), connattrs))),
+        }
+        self.adapter = _Adapter(
+            self, pool_connections=maxhosts, pool_maxsize=maxperhost,
+            pool_block=True)
+        session = self.session = requests.Session()
+        # Only send the client's headers.  The default Accept-Encoding
+        # would get bodies the client did not ask for since they are
+        # relayed without decoding.
+        session.headers.clear()
+        # Session would otherwise share cookies between proxy clients.
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        session.mount('http://', self.adapter)
+        session.mount('https://', self.adapter)
+        self.get = session.get
+        self.post = session.post
+        self.put = session.put
+        self.request = session.request
+
+        self._stop = threading.Event()
+        self.t = None
+        interval = min(self.idle, self.lifetime)
+        if interval != float('inf'):
+            self.t = threading.Thread(target=self._sweeploop, args=(interval,))
+            self.t.daemon = True
+            self.t.start()
+
+    def _count(self, key, amt=1):
+        with self.lock:
+            self.counts[key] += amt
+
+    def expired(self, conn, now):
+        """Return whether an idle connection should be closed."""
+        born = getattr(conn, '_upstream_born', now)
+        used = getattr(conn, '_upstream_used', now)
+        return now - born >= self.lifetime or now - used >= self.idle
+
+    def managers(self):
+        """Return the direct and per parent proxy pool managers."""
+        adapter = self.adapter
+        return [adapter.poolmanager] + list(adapter.proxy_manager.values())
+
+    def pools(self):
+        """Return the current per-host connection pools."""
+        ret = []
+        for manager in self.managers():
+            pools = manager.pools
+            for key in list(pools.keys()):
+                try:
+                    ret.append(pools[key])
+                except KeyError:
+                    pass
+        return ret
+
+    def evict(self):
+        """Close expired idle connections in every pool."""
+        now = time.time()
+        closed = 0
+        for pool in self.pools():
+            closed += pool.evict(now)
+        if closed:
+            self._count('evicted', closed)
+        return closed
+
+    def _sweeploop(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.evict()
+            except Exception:
+                traceback.print_exc()
+
+    def stats(self):
+        """Return dict of pool hits, misses, evicted, and hosts."""
+        with self.lock:
+            ret = dict(self.counts)
+        ret['hosts'] = sum([len(m.pools) for m in self.managers()])
+        return ret
+
+    def close(self):
+        self._stop.set()
+        if self.t is not None:
+            self.t.join()
+            self.t = None
+        self.session.close()
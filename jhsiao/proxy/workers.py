@@ -0,0 +1,144 @@
+"""Run a Proxy in several worker processes.
+
+Each worker binds the same address with SO_REUSEPORT so the kernel
+spreads connections across processes and the GIL no longer limits the
+proxy to one core.  Workers share a stats directory so /metrics on any
+of them shows the sum over all workers.  SIGUSR1 and SIGUSR2 sent to
+the supervisor are forwarded to every worker.
+"""
+from __future__ import print_function
+__all__ = ['Supervisor']
+import multiprocessing
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+from .proxy import Proxy
+
+
+def _workermain(kwargs):
+    """Run a Proxy until SIGTERM.  Exit 1 if it stopped on its own."""
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    # ctrl-c goes to the supervisor, it stops the workers.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    p = Proxy(**kwargs)
+    p.start()
+    p.handlesignals()
+    while not stop.wait(1):
+        if not p.t.is_alive():
+            p.stop()
+            sys.exit(1)
+    p.stop()
+
+
+class Supervisor(object):
+    """Start worker processes and restart them if they die."""
+    def __init__(self, kwargs, workers=2, restartdelay=1):
+        """Initialize.
+
+        kwargs: Proxy kwargs for every worker.  port must not be 0.
+        workers: number of worker processes.
+        restartdelay: min seconds between starts of the same worker.
+        """
+        self.kwargs = dict(kwargs)
+        self.kwargs['reuseport'] = True
+        self.numworkers = workers
+        self.restartdelay = restartdelay
+        self.procs = []
+        self.started = []
+        self.restarts = 0
+        self.statsdir = None
+        self.signalled = []
+        self._stop = threading.Event()
+        try:
+            self.ctx = multiprocessing.get_context('fork')
+        except ValueError:
+            self.ctx = multiprocessing.get_context()
+
+    def log(self, *args):
+        print(time.strftime('%Y-%m-%d %H:%M:%S'), 'supervisor:', *args)
+
+    def _start(self, idx):
+        p = self.ctx.Process(target=_workermain, args=(self.kwargs,))
+        p.start()
+        self.procs[idx] = p
+        self.started[idx] = time.time()
+        self.log('started worker', idx, 'pid', p.pid)
+
+    def _reap(self, idx):
+        """Remove a dead worker's saved stats."""
+        p = self.procs[idx]
+        try:
+            os.remove(os.path.join(self.statsdir, '{}.json'.format(p.pid)))
+        except OSError:
+            pass
+
+    def run(self):
+        """Run workers until stop() or SIGTERM/ctrl-c."""
+        self.statsdir = tempfile.mkdtemp(prefix='jhsiao-proxy-stats-')
+        self.kwargs['statsdir'] = self.statsdir
+        self.procs = [None] * self.numworkers
+        self.started = [0] * self.numworkers
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda *args: self.stop())
+            if hasattr(signal, 'SIGUSR1'):
+                for signum in (signal.SIGUSR1, signal.SIGUSR2):
+                    signal.signal(
+                        signum, lambda signum, frame:
+                        self.signalled.append(signum))
+        try:
+            for idx in range(self.numworkers):
+                self._start(idx)
+            while not self._stop.wait(0.5):
+                self._forward()
+                now = time.time()
+                for idx, p in enumerate(self.procs):
+                    if p.is_alive() or self.started[idx] + self.restartdelay > now:
+                        continue
+                    self.log('worker', idx, 'pid', p.pid, 'exited', p.exitcode)
+                    self._reap(idx)
+                    self.restarts += 1
+                    self._start(idx)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._shutdown()
+
+    def _forward(self):
+        """Send signals the supervisor got to the workers."""
+        while self.signalled:
+            signum = self.signalled.pop(0)
+            for p in self.procs:
+                if p is not None and p.is_alive():
+                    try:
+                        os.kill(p.pid, signum)
+                    except OSError:
+                        pass
+
+    def _shutdown(self):
+        for p in self.procs:
+            if p is not None and p.is_alive():
+                p.terminate()
+        deadline = time.time() + 10
+        for p in self.procs:
+            if p is None:
+                continue
+            p.join(max(0, deadline - time.time()))
+            if p.is_alive():
+                self.log('killing worker pid', p.pid)
+                p.kill()
+                p.join()
+        try:
+            shutil.rmtree(self.statsdir)
+        except Exception:
+            traceback.print_exc()
+
+    def stop(self):
+        """Stop all workers, can be called from other threads."""
+        self._stop.set()
@@ -0,0 +1,63 @@
+from jhsiao.tests import simple
+
+import json
+import os
+import shutil
+import tempfile
+
+from jhsiao.proxy.accesslog import AccessLog
+
+def test_json():
+    d = tempfile.mkdtemp()
+    try:
+        path = os.path.join(d, 'access.log')
+        log = AccessLog(path, 'json', interval=60)
+        log.start()
+        log.record('1.2.3.4:5', 'GET', 'http://a/', 200, 10, 0.5, 1.0)
+        log.message('hello', 1)
+        assert not os.path.exists(path)
+        log.close()
+        with open(path) as f:
+            lines = f.read().splitlines()
+        rec = json.loads(lines[0])
+        assert rec['client'] == '1.2.3.4:5'
+        assert rec['status'] == 200
+        assert rec['bytes'] == 10
+        assert rec['upstream'] == 0.5
+        assert lines[1].endswith(': hello 1')
+    finally:
+        shutil.rmtree(d)
+
+def test_text():
+    log = AccessLog()
+    line = log.format((0, 'c', 'GET', 'http://a/', None, 0, None, 0.25))
+    assert line.endswith(': c GET http://a/ - 0 - 0.250000\n')
+
+def test_sample():
+    d = tempfile.mkdtemp()
+    try:
+        path = os.path.join(d, 'access.log')
+        log = AccessLog(path, sample=0)
+        for _ in range(10):
+            log.record('c', 'GET', 'http://a/', 200, 0, None, 0)
+        log.close()
+        assert not os.path.exists(path)
+    finally:
+        shutil.rmtree(d)
+
+def test_rotate():
+    d = tempfile.mkdtemp()
+    try:
+        path = os.path.join(d, 'access.log')
+        log = AccessLog(path, maxbytes=100, backups=2)
+        for i in range(20):
+            log.message('x' * 60, i)
+        log.close()
+        assert sorted(os.listdir(d)) == ['access.log.1', 'access.log.2']
+        with open(path + '.1') as f:
+            assert f.read().endswith(' 19\n')
+    finally:
+        shutil.rmtree(d)
+
+if __name__ == '__main__':
+    simple(globals())
@@ -0,0 +1,92 @@
+from jhsiao.tests import simple
+
+from collections import deque
+import threading
+
+from jhsiao.proxy.admission import Admission, LockedAdmission, QueuePolicy
+
+def test_rate():
+    adm = Admission(rate=2, burst=3)
+    assert [adm.admit('a', 0) for _ in range(4)] == [None, None, None, 'rate']
+    assert adm.admit('b', 0) is None
+    assert adm.admit('a', 0.25) == 'rate'
+    assert adm.admit('a', 0.5) is None
+    assert adm.active('a') == 4
+
+def test_concurrency():
+    adm = Admission(maxactive=2)
+    assert adm.admit('a', 0) is None
+    assert adm.admit('a', 0) is None
+    assert adm.admit('a', 0) == 'concurrency'
+    adm.release('a')
+    assert adm.admit('a', 0) is None
+    adm.release('unknown')
+    assert not Admission()
+    assert Admission().admit('a', 0) is None
+
+def test_locked():
+    adm = LockedAdmission(maxactive=4000)
+    def admit():
+        for _ in range(1000):
+            assert adm.admit('a', 0) is None
+    threads = [threading.Thread(target=admit) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert adm.active('a') == 4000
+    assert adm.admit('a', 0) == 'concurrency'
+
+def test_evict():
+    adm = Admission(maxactive=5, maxips=2)
+    adm.admit('a', 0)
+    adm.release('a')
+    adm.admit('b', 0)
+    adm.admit('c', 0)
+    assert list(adm.ips) == ['b', 'c']
+    adm.admit('d', 0)
+    # b and c are active
+    assert list(adm.ips) == ['b', 'c', 'd']
+    adm.release('b')
+    adm.admit('e', 0)
+    assert list(adm.ips) == ['c', 'd', 'e']
+
+class Item(object):
+    def __init__(self, queued):
+        self.queued = queued
+
+def test_deadline():
+    policy = QueuePolicy('fifo', deadline=1)
+    q = deque([Item(0), Item(0.5), Item(2)])
+    item, shed = policy.take(q, 1.25)
+    assert item.queued == 0 and shed
+    item, shed = policy.take(q, 1.25)
+    assert item.queued == 0.5 and not shed
+    assert len(q) == 1
+
+def test_lifo():
+    policy = QueuePolicy('lifo')
+    q = deque([Item(0), Item(1)])
+    assert policy.take(q, 100)[0].queued == 1
+    assert policy.take(q, 100)[0].queued == 0
+
+def test_codel():
+    policy = QueuePolicy('codel', target=0.01, interval=0.1)
+    policy.emptied(0)
+    q = deque([Item(0.02), Item(0.03), Item(0.04)])
+    # Not overloaded yet: fifo.
+    item, shed = policy.take(q, 0.05)
+    assert item.queued == 0.02 and not shed
+    # Queue has stood for longer than interval: lifo and shed old items.
+    q.append(Item(0.2))
+    assert policy.overloaded(0.205)
+    item, shed = policy.take(q, 0.205)
+    assert item.queued == 0.03 and shed
+    item, shed = policy.take(q, 0.205)
+    assert item.queued == 0.04 and shed
+    item, shed = policy.take(q, 0.205)
+    assert item.queued == 0.2 and not shed
+    assert not q and not policy.overloaded(0.21)
+
+if __name__ == '__main__':
+    simple(globals())
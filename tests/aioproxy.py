@@ -0,0 +1,267 @@
+import socket
+import socketserver
+import threading
+import time
+
+from jhsiao.tests import simple
+
+from jhsiao.proxy.proxy import Proxy
+
+def _hasipv6():
+    if not socket.has_ipv6:
+        return False
+    try:
+        s = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    except socket.error:
+        return False
+    try:
+        s.bind(('::1', 0))
+    except socket.error:
+        return False
+    finally:
+        s.close()
+    return True
+
+class _Echo(socketserver.StreamRequestHandler):
+    """Answer with the request line, Host and body it received.
+
+    Expect: 100-continue is answered before reading the body.
+    """
+    def _body(self, headers):
+        rfile = self.rfile
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            chunks = []
+            size = int(rfile.readline().split(b';')[0], 16)
+            while size:
+                chunks.append(rfile.read(size))
+                rfile.readline()
+                size = int(rfile.readline().split(b';')[0], 16)
+            while rfile.readline().strip():
+                pass
+            return b''.join(chunks)
+        return rfile.read(int(headers.get('content-length', 0)))
+
+    def handle(self):
+        line = self.rfile.readline()
+        while line:
+            method, path, version = line.decode('utf-8').split()
+            headers = {}
+            line = self.rfile.readline()
+            while line.strip():
+                k, v = line.decode('utf-8').split(':', 1)
+                headers[k.strip().lower()] = v.strip()
+                line = self.rfile.readline()
+            if headers.get('expect', '').lower() == '100-continue':
+                self.wfile.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+            body = self._body(headers)
+            data = '{} {}\nhost={}\nconn={}\n'.format(
+                method, path, headers.get('host'),
+                self.client_address[1]).encode('utf-8') + body
+            self.wfile.write((
+                'HTTP/1.1 200 OK\r\nContent-Length: {}\r\n\r\n').format(
+                    len(data)).encode('utf-8') + data)
+            line = self.rfile.readline()
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+class _Server6(_Server):
+    address_family = socket.AF_INET6
+
+def _upstream(ipv6=False):
+    cls = _Server6 if ipv6 else _Server
+    server = cls(('::1' if ipv6 else '127.0.0.1', 0), _Echo)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
+
+def _proxy():
+    p = Proxy(port=0, engine='asyncio')
+    p.start()
+    end = time.time() + 2
+    while not p.addr[1]:
+        assert time.time() < end
+        time.sleep(0.01)
+    sock = socket.create_connection(('localhost', p.addr[1]))
+    sock.settimeout(2)
+    return p, sock
+
+def _response(f):
+    """Return (status line, headers dict, body) from file f."""
+    status = f.readline()
+    headers = {}
+    line = f.readline()
+    while line not in (b'\r\n', b''):
+        k, v = line.decode('utf-8').split(':', 1)
+        headers[k.strip().lower()] = v.strip()
+        line = f.readline()
+    body = f.read(int(headers.get('content-length', 0)))
+    return status, headers, body
+
+def test_get():
+    server = _upstream()
+    host, port = server.server_address[:2]
+    p, sock = _proxy()
+    f = sock.makefile('rb')
+    try:
+        conns = []
+        for _ in range(2):
+            sock.sendall((
+                'GET http://{}:{}/a%20b?c=d HTTP/1.1\r\n'
+                'Host: {}:{}\r\n\r\n').format(
+                    host, port, host, port).encode('utf-8'))
+            status, headers, body = _response(f)
+            assert status.split()[1] == b'200'
+            lines = body.decode('utf-8').splitlines()
+            assert lines[0] == 'GET /a%20b?c=d'
+            assert lines[1] == 'host={}:{}'.format(host, port)
+            conns.append(lines[2])
+        # the upstream connection was reused
+        assert conns[0] == conns[1]
+    finally:
+        f.close()
+        sock.close()
+        p.stop()
+        server.shutdown()
+        server.server_close()
+
+def test_post():
+    server = _upstream()
+    host, port = server.server_address[:2]
+    p, sock = _proxy()
+    f = sock.makefile('rb')
+    try:
+        sock.sendall((
+            'POST http://{}:{}/sized HTTP/1.1\r\n'
+            'Content-Length: 11\r\n\r\nhello world').format(
+                host, port).encode('utf-8'))
+        status, headers, body = _response(f)
+        assert status.split()[1] == b'200'
+        assert body.endswith(b'\nhello world')
+        assert body.startswith(b'POST /sized\n')
+        sock.sendall((
+            'PUT http://{}:{}/chunked HTTP/1.1\r\n'
+            'Transfer-Encoding: chunked\r\n\r\n'
+            '5\r\nhello\r\n6;x=y\r\n world\r\n0\r\n\r\n').format(
+                host, port).encode('utf-8'))
+        status, headers, body = _response(f)
+        assert status.split()[1] == b'200'
+        assert body.startswith(b'PUT /chunked\n')
+        assert body.endswith(b'\nhello world')
+    finally:
+        f.close()
+        sock.close()
+        p.stop()
+        server.shutdown()
+        server.server_close()
+
+def test_expect():
+    server = _upstream()
+    host, port = server.server_address[:2]
+    p, sock = _proxy()
+    f = sock.makefile('rb')
+    try:
+        sock.sendall((
+            'POST http://{}:{}/expect HTTP/1.1\r\n'
+            'Expect: 100-continue\r\n'
+            'Content-Length: 5\r\n\r\n').format(host, port).encode('utf-8'))
+        # Sent before the body, else the client would wait for it.
+        assert f.readline().split()[1] == b'100'
+        while f.readline() != b'\r\n':
+            pass
+        sock.sendall(b'hello')
+        status, headers, body = _response(f)
+        assert status.split()[1] == b'200'
+        assert body.endswith(b'\nhello')
+    finally:
+        f.close()
+        sock.close()
+        p.stop()
+        server.shutdown()
+        server.server_close()
+
+def test_ipv6():
+    if not _hasipv6():
+        print('ipv6 not supported')
+        return
+    server = _upstream(True)
+    port = server.server_address[1]
+    l = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    l.bind(('::1', 0))
+    l.listen(1)
+    l.settimeout(2)
+    p, sock = _proxy()
+    f = sock.makefile('rb')
+    s = None
+    try:
+        sock.sendall((
+            'GET http://[::1]:{}/six HTTP/1.1\r\n'
+            'Host: [::1]:{}\r\n\r\n').format(port, port).encode('utf-8'))
+        status, headers, body = _response(f)
+        assert status.split()[1] == b'200'
+        lines = body.decode('utf-8').splitlines()
+        assert lines[0] == 'GET /six'
+        assert lines[1] == 'host=[::1]:{}'.format(port)
+
+        tunnel = socket.create_connection(('localhost', p.addr[1]))
+        tunnel.settimeout(2)
+        try:
+            tunnel.sendall('CONNECT [::1]:{} HTTP/1.1\r\n\r\n'.format(
+                l.getsockname()[1]).encode('utf-8'))
+            assert tunnel.recv(100).startswith(b'HTTP/1.1 200')
+            s, a = l.accept()
+            s.settimeout(2)
+            tunnel.sendall(b'ping')
+            assert s.recv(4) == b'ping'
+        finally:
+            tunnel.close()
+    finally:
+        if s is not None:
+            s.close()
+        l.close()
+        f.close()
+        sock.close()
+        p.stop()
+        server.shutdown()
+        server.server_close()
+
+def test_connect():
+    l = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    l.bind(('127.0.0.1', 0))
+    l.listen(1)
+    l.settimeout(2)
+    p, sock = _proxy()
+    s = None
+    try:
+        sock.sendall('CONNECT 127.0.0.1:{} HTTP/1.1\r\n\r\n'.format(
+            l.getsockname()[1]).encode('utf-8'))
+        assert sock.recv(100).startswith(b'HTTP/1.1 200')
+        s, a = l.accept()
+        s.settimeout(2)
+        sock.sendall(b'hello world!')
+        assert s.recv(12) == b'hello world!'
+        s.sendall(b'goodbye world')
+        assert sock.recv(13) == b'goodbye world'
+        s.shutdown(socket.SHUT_WR)
+        assert sock.recv(1) == b''
+    finally:
+        if s is not None:
+            s.close()
+        sock.close()
+        l.close()
+        p.stop()
+
+def test_unsupported():
+    for kwargs in (
+            dict(cachemem=1<<20), dict(gzip=True), dict(collapse=True),
+            dict(trace=100), dict(accesslog='-')):
+        try:
+            Proxy(engine='asyncio', **kwargs)
+        except ValueError:
+            pass
+        else:
+            assert False, 'asyncio accepted {}'.format(kwargs)
+
+if __name__ == '__main__':
+    simple(globals())
@@ -0,0 +1,122 @@
+import shutil
+import tempfile
+import time
+
+from jhsiao.tests import simple
+
+from jhsiao.proxy.cache import HTTPCache, parse_cc
+from jhsiao.proxy.proxy import Proxy
+
+class H(dict):
+    """Lowercase request headers."""
+
+def _store(cache, url, body, headers, req=H()):
+    store = cache.store(url, req, 200, 'OK', headers)
+    if store is not None:
+        for i in range(0, len(body), 3):
+            store.write(body[i:i+3])
+        store.finish()
+    return store
+
+def test_parse_cc():
+    assert parse_cc('max-age=5, no-cache, private="x"') == {
+        'max-age': '5', 'no-cache': True, 'private': 'x'}
+
+def test_memory():
+    cache = HTTPCache(memsize=20, maxobject=10)
+    assert _store(cache, 'a', b'0123456789', [('Cache-Control', 'max-age=60')])
+    assert _store(cache, 'b', b'x', [('Cache-Control', 'no-store')]) is None
+    assert _store(cache, 'c', b'x', []) is None
+    entry = cache.lookup('a', H())
+    assert entry.body == b'0123456789'
+    assert entry.fresh(time.time())
+    assert b'Content-Length: 10\r\n' in entry.head(time.time())
+    _store(cache, 'd', b'0123456789', [('Cache-Control', 'max-age=60')])
+    _store(cache, 'e', b'0123456789', [('Cache-Control', 'max-age=60')])
+    assert cache.lookup('a', H()) is None
+    assert cache.stats()['memevictions'] == 1
+
+def test_metrics():
+    p = Proxy(cachemem=20, cacheobject=10)
+    cache = p.cache
+    _store(cache, 'a', b'0123456789', [('Cache-Control', 'max-age=60')])
+    cache.served(cache.lookup('a', H()))
+    assert cache.lookup('b', H()) is None
+    _store(cache, 'd', b'0123456789', [('Cache-Control', 'max-age=60')])
+    _store(cache, 'e', b'0123456789', [('Cache-Control', 'max-age=60')])
+    lines = p.metrics.render().splitlines()
+    assert 'proxy_cache_hits_total 1' in lines
+    assert 'proxy_cache_misses_total 1' in lines
+    assert 'proxy_cache_saved_bytes_total 10' in lines
+    assert 'proxy_cache_memory_evictions_total 1' in lines
+    assert 'proxy_cache_hit_ratio 0.5' in lines
+    lines = Proxy().metrics.render().splitlines()
+    assert 'proxy_cache_hits_total 0' in lines
+
+def test_vary():
+    cache = HTTPCache(memsize=100)
+    hdrs = [('Cache-Control', 'max-age=60'), ('Vary', 'Accept-Encoding')]
+    _store(cache, 'a', b'gz', hdrs, H({'accept-encoding': 'gzip'}))
+    _store(cache, 'a', b'plain', hdrs, H())
+    assert cache.lookup('a', H({'accept-encoding': 'gzip'})).body == b'gz'
+    assert cache.lookup('a', H()).body == b'plain'
+    assert cache.lookup('a', H({'accept-encoding': 'br'})) is None
+
+def test_variant():
+    cache = HTTPCache(memsize=100)
+    hdrs = [('Cache-Control', 'max-age=60'), ('ETag', '"1"')]
+    _store(cache, 'a', b'plain', hdrs)
+    entry = cache.lookup('a', H(), ('gzip',))
+    assert entry.encoding is None
+    store = cache.variant(entry, 'gzip', hdrs + [('Content-Encoding', 'gzip')])
+    store.write(b'gz')
+    store.entry.rawsize = entry.size
+    gz = store.finish()
+    assert gz.encoding == 'gzip' and gz.rawsize == 5
+    assert cache.lookup('a', H(), ('gzip',)).body == b'gz'
+    assert cache.lookup('a', H()).body == b'plain'
+    _store(cache, 'a', b'plain2', hdrs)
+    assert cache.lookup('a', H()).body == b'plain2'
+    assert cache.lookup('a', H(), ('gzip',)).body == b'gz'
+
+def test_revalidate():
+    cache = HTTPCache(memsize=100)
+    _store(cache, 'a', b'body', [('Cache-Control', 'no-cache'), ('ETag', '"1"')])
+    entry = cache.lookup('a', H())
+    assert not entry.fresh(time.time())
+    assert entry.conditional(H())['If-None-Match'] == '"1"'
+    entry = cache.refresh(entry, [('Cache-Control', 'max-age=60')])
+    assert entry.fresh(time.time())
+
+def test_revalidate_tiers():
+    d = tempfile.mkdtemp()
+    try:
+        cache = HTTPCache(memsize=100, diskdir=d)
+        _store(cache, 'a', b'body', [
+            ('Cache-Control', 'no-cache'), ('ETag', '"1"')])
+        entry = cache.lookup('a', H())
+        assert entry.body == b'body'
+        cache.refresh(entry, [('Cache-Control', 'max-age=60')])
+        ondisk = cache.disk['a'][0]
+        assert ondisk is not entry and ondisk.fresh(time.time())
+        assert HTTPCache(0, diskdir=d).lookup('a', H()).fresh(time.time())
+    finally:
+        shutil.rmtree(d)
+
+def test_disk():
+    d = tempfile.mkdtemp()
+    try:
+        cache = HTTPCache(memsize=0, diskdir=d, disksize=15)
+        _store(cache, 'a', b'0123456789', [('Cache-Control', 'max-age=60')])
+        cache = HTTPCache(memsize=0, diskdir=d, disksize=15)
+        entry = cache.lookup('a', H())
+        with cache.open(entry) as f:
+            assert f.read() == b'0123456789'
+        _store(cache, 'b', b'0123456789', [('Cache-Control', 'max-age=60')])
+        assert cache.lookup('a', H()) is None
+        assert cache.stats()['diskevictions'] == 1
+    finally:
+        shutil.rmtree(d)
+
+if __name__ == '__main__':
+    simple(globals())
@@ -0,0 +1,129 @@
+import threading
+
+from jhsiao.tests import simple
+
+from jhsiao.proxy.collapse import Collapser, collapsible, shareable
+
+class H(dict):
+    """Lowercase request headers."""
+
+def _follow(flight, follower, headers, out):
+    head = flight.wait(follower, headers)
+    out.append(head)
+    if head is not None:
+        out.extend(flight.read(follower))
+        flight.leave(follower)
+
+def test_collapsible():
+    assert collapsible(H({'accept': '*/*'}))
+    assert not collapsible(H({'authorization': 'x'}))
+    assert not collapsible(H({'range': 'bytes=0-1'}))
+    assert not collapsible(H({'if-none-match': '"1"'}))
+    assert shareable([('Vary', 'Accept-Encoding, Cookie')]) == [
+        'accept-encoding', 'cookie']
+    assert shareable([('Cache-Control', 'no-store')]) == []
+    assert shareable([('Cache-Control', 'private, max-age=5')]) is None
+    assert shareable([('Set-Cookie', 'a=b')]) is None
+    assert shareable([('Vary', '*')]) is None
+
+def test_follow():
+    c = Collapser()
+    flight, follower = c.join('a', H())
+    assert follower is None
+    outs = []
+    threads = []
+    for _ in range(3):
+        f, follower = c.join('a', H())
+        assert f is flight
+        out = []
+        outs.append(out)
+        threads.append(threading.Thread(
+            target=_follow, args=(f, follower, H(), out)))
+    for t in threads:
+        t.start()
+    assert flight.share(b'head', 200, True, [('Cache-Control', 'no-cache')])
+    for data in (b'a', b'b', b'c'):
+        assert flight.write(data)
+    flight.finish(True)
+    for t in threads:
+        t.join()
+    assert outs == [[b'head', b'a', b'b', b'c']] * 3
+    assert flight.complete
+    f, follower = c.join('a', H())
+    assert follower is None and f is not flight
+    assert c.stats() == dict(leaders=2, followers=3, inflight=1)
+
+def test_notshared():
+    c = Collapser()
+    flight, _ = c.join('a', H({'cookie': 'a'}))
+    f1, cookie = c.join('a', H({'cookie': 'a'}))
+    f2, other = c.join('a', H({'cookie': 'b'}))
+    assert flight.share(b'head', 200, True, [('Vary', 'Cookie')])
+    assert flight.wait(cookie, H({'cookie': 'a'})) == b'head'
+    assert flight.wait(other, H({'cookie': 'b'})) is None
+    flight.finish(False)
+    assert list(flight.read(cookie)) == []
+    assert not flight.complete
+    flight, _ = c.join('b', H())
+    f, follower = c.join('b', H())
+    assert not flight.share(b'head', 200, True, [('Set-Cookie', 'a=b')])
+    assert flight.wait(follower, H()) is None
+    assert c.join('b', H())[1] is None
+
+def test_maxbuffer():
+    c = Collapser(maxbuffer=4)
+    flight, _ = c.join('a', H())
+    f, follower = c.join('a', H())
+    assert flight.share(b'head', 200, True, [])
+    assert flight.wait(follower, H()) == b'head'
+    reader = flight.read(follower)
+    assert flight.write(b'abc')
+    assert flight.joinable
+    assert next(reader) == b'abc'
+    assert flight.write(b'def')
+    assert not flight.joinable
+    assert c.join('a', H())[0] is not flight
+    assert next(reader) == b'def'
+    assert flight.write(b'ghi')
+    assert flight.chunks == [b'ghi']
+    flight.leave(follower)
+    assert not flight.write(b'jkl')
+
+def test_stalled():
+    c = Collapser(maxbuffer=4, maxchunks=3, timeout=0.05)
+    flight, _ = c.join('a', H())
+    f, stalled = c.join('a', H())
+    f, reading = c.join('a', H())
+    assert flight.share(b'head', 200, True, [])
+    assert flight.wait(stalled, H()) == b'head'
+    assert flight.wait(reading, H()) == b'head'
+    reader = flight.read(reading)
+    for data in (b'ab', b'cd', b'ef', b'gh', b'ij'):
+        assert flight.write(data)
+        assert next(reader) == data
+        assert flight.buffered <= 4 and len(flight.chunks) <= 3
+    assert stalled.dropped and not reading.dropped
+    assert list(flight.read(stalled)) == []
+    assert flight.chunks == []
+    for data in (b'a', b'b', b'c'):
+        assert flight.write(data)
+    assert len(flight.chunks) == 3
+    assert not flight.write(b'd')
+    assert reading.dropped
+    assert not flight.followers and flight.chunks is None
+
+def test_timeout():
+    c = Collapser(timeout=0.05)
+    flight, _ = c.join('a', H())
+    f, follower = c.join('a', H())
+    assert flight.wait(follower, H()) is None
+    f, follower = c.join('a', H())
+    assert flight.share(b'head', 200, True, [])
+    assert flight.wait(follower, H()) == b'head'
+    assert flight.write(b'a')
+    assert list(flight.read(follower)) == [b'a']
+    assert follower.dropped
+    assert follower not in flight.followers
+
+if __name__ == '__main__':
+    simple(globals())
@@ -0,0 +1,54 @@
+import gzip
+
+from jhsiao.tests import simple
+
+from jhsiao.proxy.compress import Compressor, accepts, gzipheaders
+
+class H(dict):
+    """Lowercase request headers."""
+
+def test_accepts():
+    assert accepts('gzip, deflate, br')
+    assert accepts('deflate, GZIP;q=0.5')
+    assert not accepts('gzip;q=0, *')
+    assert accepts('br, *')
+    assert not accepts('br')
+    assert not accepts(None)
+
+def test_gzipheaders():
+    headers = gzipheaders([
+        ('Content-Type', 'text/html'), ('Content-Length', '10'),
+        ('ETag', '"1"'), ('Vary', 'Cookie')])
+    assert headers == [
+        ('Content-Type', 'text/html'), ('ETag', 'W/"1"'),
+        ('Vary', 'Cookie, Accept-Encoding'), ('Content-Encoding', 'gzip')]
+
+def test_start():
+    c = Compressor(minsize=100)
+    gzh = H({'accept-encoding': 'gzip'})
+    text = [('Content-Type', 'text/plain; charset=utf-8')]
+    assert c.start(H(), 200, text) is None
+    assert c.start(gzh, 404, text) is None
+    assert c.start(gzh, 200, [('Content-Type', 'image/png')]) is None
+    assert c.start(gzh, 200, text + [('Content-Length', '10')]) is None
+    assert c.start(gzh, 200, text + [('Content-Encoding', 'br')]) is None
+    assert c.start(
+        gzh, 200, text + [('Cache-Control', 'no-transform')]) is None
+    gz = c.start(gzh, 200, text)
+    body = b'hello world ' * 1000
+    data = b''.join([gz.compress(body[i:i+100]) for i in range(0, len(body), 100)])
+    data += gz.finish()
+    assert gzip.decompress(data) == body
+    assert gz.nin == len(body) and gz.nout == len(data)
+    stats = c.stats()
+    assert stats['compressed'] == 1 and stats['ratio'] < 0.1
+
+def test_budget():
+    c = Compressor(cpubudget=0.01)
+    assert c.allowed()
+    c.charge(1)
+    assert not c.allowed()
+    assert c.stats()['overbudget'] == 1
+
+if __name__ == '__main__':
+    simple(globals())
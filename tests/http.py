@@ -0,0 +1,103 @@
+import io
+
+from jhsiao.tests import simple
+
+from jhsiao.proxy.http import (
+    Body, ChunkedBody, LengthBody, HTTPError, RequestParser)
+
+def test_length():
+    f = io.BufferedReader(io.BytesIO(b'helloworldGET'))
+    body = Body.fromheaders(f, {'content-length': '10'}, chunksize=3)
+    assert isinstance(body, LengthBody)
+    assert len(body) == 10
+    assert list(body) == [b'hel', b'low', b'orl', b'd']
+    assert body.done
+    assert f.read() == b'GET'
+
+def test_nobody():
+    assert Body.fromheaders(None, {}) is None
+    assert Body.fromheaders(None, {'content-length': '0'}) is None
+    try:
+        Body(None)
+    except TypeError:
+        pass
+    else:
+        assert False, 'Body is abstract'
+
+def test_chunked():
+    f = io.BufferedReader(io.BytesIO(
+        b'5\r\nhello\r\n6;ext=1\r\n world\r\n0\r\nTrailer: x\r\n\r\nGET'))
+    body = Body.fromheaders(
+        f, {'transfer-encoding': 'chunked', 'content-length': '3'}, chunksize=4)
+    assert isinstance(body, ChunkedBody)
+    assert not hasattr(body, '__len__')
+    assert body.read() == b'hello world'
+    assert body.done
+    assert f.read() == b'GET'
+
+def test_incomplete():
+    f = io.BufferedReader(io.BytesIO(b'5\r\nhel'))
+    body = ChunkedBody(f)
+    try:
+        body.read()
+    except HTTPError as e:
+        assert e.code < 0
+    else:
+        assert False, 'expected HTTPError'
+
+def test_parser():
+    head = (
+        b'\r\nGET http://example.com/a%20b HTTP/1.1\r\n'
+        b'Host: example.com\r\n'
+        b'Accept:  a \r\n'
+        b'accept: b\r\n\r\n')
+    for step in (1, 7, len(head)):
+        p = RequestParser()
+        consumed = 0
+        for i in range(0, len(head), step):
+            consumed += p.feed(head[i:i+step] + b'body'[:(i+step >= len(head))*4])
+            if p.done:
+                break
+        assert consumed == len(head)
+        assert p.startline.method == 'GET'
+        assert p.startline.resource == 'http://example.com/a b'
+        assert p.startline.rawresource == 'http://example.com/a%20b'
+        assert p.startline.version == (1, 1)
+        assert p.headers.get('host') == 'example.com'
+        assert p.headers['accept'] == ['a', 'b']
+        assert p.headers.get('accept') == 'a,b'
+        assert p.headers['missing'] == []
+        assert sorted(p.headers) == ['accept', 'host']
+
+def test_parser_read():
+    f = io.BufferedReader(io.BytesIO(
+        b'POST / HTTP/1.0\r\nContent-Length: 3\r\n\r\nabcGET'))
+    p = RequestParser.read(f)
+    assert p.startline.version == (1, 0)
+    assert f.read(3) == b'abc'
+    try:
+        RequestParser.read(io.BufferedReader(io.BytesIO(b'GET / HT')))
+    except HTTPError as e:
+        assert e.code == -1
+    else:
+        assert False, 'expected HTTPError'
+
+def test_parser_limits():
+    cases = [
+        (dict(maxline=10), b'GET /aaaaaaaaaaaa HTTP/1.1\r\n', 414),
+        (dict(maxheaders=1), b'GET / HTTP/1.1\r\na: 1\r\nb: 2\r\n\r\n', 431),
+        (dict(maxsize=32), b'GET / HTTP/1.1\r\na: 1\r\nb: 2222222222\r\n', 431),
+        ({}, b'GET / HTTP/1.1\r\na: 1\nb: 2\r\n\r\n', 400),
+        ({}, b'GET / HTTP/1.1\r\n folded\r\n\r\n', -3),
+        ({}, b'hello\r\n\r\n', -2),
+    ]
+    for limits, data, code in cases:
+        try:
+            RequestParser(**limits).feed(data)
+        except HTTPError as e:
+            assert e.code == code, (data, e.code)
+        else:
+            assert False, data
+
+if __name__ == '__main__':
+    simple(globals())
@@ -0,0 +1,57 @@
+import json
+
+from jhsiao.tests import simple
+
+from jhsiao.proxy.metrics import Registry, render_snapshots
+
+def test_render():
+    r = Registry()
+    c = r.counter('reqs_total', 'Requests.', ('method',))
+    c.labels('GET').inc()
+    c.labels('GET').inc(2)
+    c.labels('P"UT').inc()
+    assert r.counter('reqs_total', 'Requests.', ('method',)) is c
+    g = r.gauge('depth', 'Depth.', func=lambda: 7)
+    g.set(3)
+    r.counter('hits_total', 'Hits.', func=lambda: 5)
+    text = r.render()
+    assert 'reqs_total{method="GET"} 3\n' in text
+    assert 'reqs_total{method="P\\"UT"} 1\n' in text
+    # func wins over set()
+    assert '# TYPE depth gauge\ndepth 7\n' in text
+    assert '# TYPE hits_total counter\nhits_total 5\n' in text
+    try:
+        r.gauge('reqs_total', 'Requests.')
+    except ValueError:
+        pass
+    else:
+        assert False, 'expected ValueError'
+
+def test_histogram():
+    r = Registry()
+    h = r.histogram('lat', 'Latency.', (0.1, 1))
+    for v in (0.05, 0.1, 0.5, 2):
+        h.observe(v)
+    lines = r.render().splitlines()
+    assert 'lat_bucket{le="0.1"} 2' in lines
+    assert 'lat_bucket{le="1"} 3' in lines
+    assert 'lat_bucket{le="+Inf"} 4' in lines
+    assert 'lat_sum 2.65' in lines
+    assert 'lat_count 4' in lines
+
+def test_snapshots():
+    snapshots = []
+    for amt in (1, 2):
+        r = Registry()
+        r.counter('reqs_total', 'Requests.', ('method',)).labels('GET').inc(amt)
+        r.histogram('lat', 'Latency.', (1,)).observe(amt)
+        # saved as json by each worker
+        snapshots.append(json.loads(json.dumps(r.snapshot())))
+    lines = render_snapshots(snapshots).splitlines()
+    assert 'reqs_total{method="GET"} 3' in lines
+    assert 'lat_bucket{le="1"} 1' in lines
+    assert 'lat_bucket{le="+Inf"} 2' in lines
+    assert 'lat_sum 3' in lines
+
+if __name__ == '__main__':
+    simple(globals())
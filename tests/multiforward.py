@@ -1,9 +1,12 @@
 import sys
 import io
+import os
 import socket
 from jhsiao.ipc import sockets
-from jhsiao.proxy.multiforward import MultiForwarder
+from jhsiao.proxy.multiforward import (
+    MultiForwarder, ProcessShard, SpliceForwarder)
 import threading
+import time
 
 if sys.version_info.major > 2:
     inp = input
@@ -66,6 +69,180 @@ def test_multiforward():
     t.join()
     forwarder.close()
 
+def _pair(l):
+    c = socket.create_connection(l.getsockname())
+    s, _ = l.accept()
+    return c, s
+
+def test_backpressure():
+    forwarder = MultiForwarder(bufsize=0x10000)
+    l = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    l.bind(('localhost', 0))
+    l.listen(5)
+    slowc, slow = _pair(l)
+    slowdst, slowr = _pair(l)
+    fastc, fast = _pair(l)
+    fastdst, fastr = _pair(l)
+    l.close()
+    socks = [slowc, slowdst, fastc, fastdst, slowr, fastr]
+    try:
+        forwarder.add(sockets.Sockfile(slow, 'rwb'), sockets.Sockfile(slowdst, 'rwb'))
+        forwarder.add(sockets.Sockfile(fast, 'rwb'), sockets.Sockfile(fastdst, 'rwb'))
+        # slowr never reads so the slow tunnel's buffers fill up.
+        slowc.setblocking(False)
+        sent = 0
+        end = time.time() + 0.5
+        while time.time() < end:
+            try:
+                sent += slowc.send(b'x' * 0x10000)
+            except socket.error:
+                time.sleep(0.01)
+        fastc.sendall(b'ping')
+        fastr.settimeout(1)
+        assert fastr.recv(4) == b'ping'
+        fastr.sendall(b'pong')
+        fastc.settimeout(1)
+        assert fastc.recv(4) == b'pong'
+
+        slowc.setblocking(True)
+        slowc.shutdown(socket.SHUT_WR)
+        slowr.settimeout(5)
+        received = 0
+        data = slowr.recv(0x10000)
+        while data:
+            received += len(data)
+            data = slowr.recv(0x10000)
+        assert received == sent
+    finally:
+        forwarder.close()
+        for s in socks:
+            s.close()
+
+def _budget(splice):
+    budget = 0x8000
+    forwarder = MultiForwarder(
+        bufsize=0x40000, splice=splice, budget=budget, slabsize=0x4000)
+    l = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    l.bind(('localhost', 0))
+    l.listen(5)
+    c, s = _pair(l)
+    dst, r = _pair(l)
+    l.close()
+    socks = [c, dst, r]
+    try:
+        forwarder.add(sockets.Sockfile(s, 'rwb'), sockets.Sockfile(dst, 'rwb'))
+        # r does not read yet so the tunnel's buffer fills up.
+        c.setblocking(False)
+        sent = 0
+        end = time.time() + 0.5
+        while time.time() < end:
+            try:
+                sent += c.send(b'x' * 0x10000)
+            except socket.error:
+                time.sleep(0.01)
+        current, peak = forwarder.buffered()
+        assert 0 < current <= budget
+        assert peak <= budget
+        (name, pending, tpeak), = [
+            t for t in forwarder.tunnels() if t[1]]
+        assert 0 < pending <= tpeak <= budget
+
+        c.setblocking(True)
+        c.shutdown(socket.SHUT_WR)
+        r.settimeout(5)
+        received = 0
+        data = r.recv(0x10000)
+        while data:
+            received += len(data)
+            data = r.recv(0x10000)
+        assert received == sent
+        assert forwarder.buffered() == (0, peak)
+    finally:
+        forwarder.close()
+        for sock in socks:
+            sock.close()
+
+def test_budget():
+    _budget(False)
+
+def test_budget_splice():
+    try:
+        _budget(True)
+    except ValueError:
+        print('splice not supported')
+
+def test_splice():
+    try:
+        forwarder = MultiForwarder(splice=True)
+    except ValueError:
+        print('splice not supported')
+        return
+    l = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    l.bind(('localhost', 0))
+    l.listen(5)
+    c = socket.create_connection(l.getsockname())
+    s, _ = l.accept()
+    dst = socket.create_connection(l.getsockname())
+    r, _ = l.accept()
+    l.close()
+    socks = [c, dst, r]
+    # More than a pipe holds so splices are partial and repeated.
+    data = os.urandom(0x100000)
+    try:
+        forwarder.add(sockets.Sockfile(s, 'rwb'), sockets.Sockfile(dst, 'rwb'))
+        t = threading.Thread(target=c.sendall, args=(data,))
+        t.start()
+        r.settimeout(5)
+        received = []
+        amt = 0
+        while amt < len(data):
+            chunk = r.recv(0x10000)
+            assert chunk
+            received.append(chunk)
+            amt += len(chunk)
+        t.join()
+        assert b''.join(received) == data
+        assert all([
+            isinstance(f, SpliceForwarder)
+            for f in forwarder.srcs.values()])
+        r.sendall(b'pong')
+        c.settimeout(5)
+        assert c.recv(4) == b'pong'
+        c.shutdown(socket.SHUT_WR)
+        assert r.recv(1) == b''
+        r.shutdown(socket.SHUT_WR)
+        assert c.recv(1) == b''
+    finally:
+        forwarder.close()
+        for sock in socks:
+            sock.close()
+
+def test_processload():
+    l = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    l.bind(('localhost', 0))
+    l.listen(5)
+    c1 = socket.create_connection(l.getsockname())
+    s1, _ = l.accept()
+    c2 = socket.create_connection(l.getsockname())
+    s2, _ = l.accept()
+    l.close()
+    shard = ProcessShard()
+    try:
+        shard.add(
+            sockets.Sockfile(s1, 'rwb'), sockets.Sockfile(c2, 'rwb'), True)
+        assert shard.load() == 2
+        c1.sendall(b'hello')
+        s2.settimeout(5)
+        assert s2.recv(5) == b'hello'
+        c1.close()
+        s2.close()
+        end = time.time() + 10
+        while shard.load() and time.time() < end:
+            time.sleep(0.1)
+        assert shard.load() == 0
+    finally:
+        shard.close()
+
 if __name__ == '__main__':
     from jhsiao.tests import simple
     simple(globals())
@@ -0,0 +1,40 @@
+from jhsiao.tests import simple
+
+from jhsiao.proxy.nets import NetTrie
+
+def test_ipv4():
+    trie = NetTrie([((0x0A240000,), 16), ((0x7F000001,), 32)])
+    assert len(trie) == 2
+    assert trie.match((0x0A24FFFF,))
+    assert trie.match((0x7F000001,))
+    assert not trie.match((0x7F000002,))
+    assert not trie.match((0x0A250000,))
+    assert not trie.match((0, 1))
+
+def test_ipv6():
+    trie = NetTrie([((0, 1), 128), ((0xFE80000000000000, 0), 10)])
+    assert trie.match((0, 1))
+    assert not trie.match((0, 2))
+    assert trie.match((0xFEBF000000000000, 5))
+    assert not trie.match((0xFEC0000000000000, 5))
+    assert not trie.match((1,))
+
+def test_covered():
+    trie = NetTrie([((0x0A240100,), 24), ((0x0A240200,), 24)])
+    assert len(trie) == 2
+    trie.add((0x0A240000,), 16)
+    assert len(trie) == 1
+    trie.add((0x0A240300,), 24)
+    assert len(trie) == 1
+    assert trie.match((0x0A24FF00,))
+
+def test_empty():
+    trie = NetTrie()
+    assert not trie
+    assert not trie.match((1,))
+    trie.add((0,), 0)
+    assert trie
+    assert trie.match((12345,))
+
+if __name__ == '__main__':
+    simple(globals())
@@ -0,0 +1,80 @@
+import socket
+
+from jhsiao.proxy.parents import Parent, ParentSet, parsestatus
+
+def _spread(parents, keys):
+    ret = {}
+    for key in keys:
+        ret[key] = parents.select(key)
+    return ret
+
+def test_consistent():
+    parents = ParentSet(['a:1', 'b:1', 'c:1'])
+    keys = ['host{}:80'.format(i) for i in range(1000)]
+    before = _spread(parents, keys)
+    counts = {}
+    for parent in before.values():
+        counts[repr(parent)] = counts.get(repr(parent), 0) + 1
+    assert sorted(counts) == ['a:1', 'b:1', 'c:1']
+    assert min(counts.values()) > 200
+    assert _spread(parents, keys) == before
+
+    down = parents.parents[1]
+    for _ in range(parents.maxfails):
+        parents.failed(down)
+    assert not down.healthy
+    after = _spread(parents, keys)
+    for key in keys:
+        if before[key] is down:
+            assert after[key] is not down
+        else:
+            assert after[key] is before[key]
+    parents.succeeded(down)
+    assert _spread(parents, keys) == before
+
+def test_weight():
+    parents = ParentSet(['a:1=3', 'b:1'])
+    assert parents.parents[0].weight == 3
+    picked = [parents.select('host{}:80'.format(i)) for i in range(1000)]
+    assert picked.count(parents.parents[0]) > 600
+
+def test_allfailed():
+    messages = []
+    parents = ParentSet(
+        [Parent('a', 1)], maxfails=1, log=lambda *args: messages.append(args))
+    parents.failed(parents.parents[0])
+    assert parents.select('host:80') is None
+    assert parents.stats()['nohealthy'] == 1
+    assert messages == [('parent', parents.parents[0], 'down')]
+
+def test_interval():
+    for interval in (0, -1, None):
+        try:
+            ParentSet(['a:1'], interval=interval)
+        except (ValueError, TypeError):
+            pass
+        else:
+            assert 0, interval
+
+def test_check():
+    l = socket.socket()
+    l.bind(('localhost', 0))
+    l.listen(1)
+    port = l.getsockname()[1]
+    parents = ParentSet(['localhost:{}'.format(port)], timeout=1)
+    parent = parents.parents[0]
+    parents.failed(parent)
+    parents.check()
+    assert parent.healthy and parent.fails == 0
+    l.close()
+    parents.check()
+    assert not parent.healthy
+
+def test_parsestatus():
+    assert parsestatus(b'HTTP/1.1 200 Connection established\r\n') == (
+        200, 'Connection established')
+    assert parsestatus(b'HTTP/1.0 403') == (403, '')
+
+if __name__ == '__main__':
+    from jhsiao.tests import simple
+    simple(globals())
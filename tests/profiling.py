@@ -0,0 +1,67 @@
+import shutil
+import tempfile
+import threading
+
+from jhsiao.tests import simple
+
+from jhsiao.proxy.profiling import Profiler, sample
+
+def _spin(stop):
+    junk = []
+    while not stop.is_set():
+        junk.append(bytearray(100))
+        del junk[:-1000]
+
+def _busy():
+    stop = threading.Event()
+    t = threading.Thread(target=_spin, args=(stop,), name='spinner')
+    t.start()
+    return stop, t
+
+def test_sample():
+    stop, t = _busy()
+    try:
+        stacks = sample(0.1, 0.001)
+    finally:
+        stop.set()
+        t.join()
+    spinning = [
+        count for stack, count in stacks.items()
+        if stack[0] == 'spinner'
+        and [label for label in stack if label.startswith('_spin ')]]
+    assert sum(spinning) > 5
+
+def test_profile():
+    d = tempfile.mkdtemp()
+    stop, t = _busy()
+    try:
+        messages = []
+        profiler = Profiler(d, 0.001, log=lambda *args: messages.append(args))
+        paths = profiler.start(0.2)
+        assert profiler.start(0.2) is None
+        profiler.t.join()
+        assert not profiler.running()
+        assert messages == [('profile written to',) + paths]
+        with open(paths[0]) as f:
+            assert 'spinner;' in f.read()
+        with open(paths[1]) as f:
+            assert f.read() == profiler.report
+        assert 'top allocation growth:' in profiler.report
+    finally:
+        stop.set()
+        t.join()
+        shutil.rmtree(d)
+
+def test_badseconds():
+    profiler = Profiler()
+    for seconds in (0, -1, float('inf'), float('nan')):
+        try:
+            profiler.start(seconds)
+        except ValueError:
+            pass
+        else:
+            assert 0, seconds
+    assert not profiler.running()
+
+if __name__ == '__main__':
+    simple(globals())
@@ -1,11 +1,38 @@
+import gzip
 import io
+import shutil
+import socket
+import tempfile
+import threading
+import time
 
-from jhsiao.ipc import sockets
+from jhsiao.ipc import polling, sockets
 from jhsiao.tests import simple
 
-from jhsiao.proxy.proxy import Proxy
+from jhsiao.proxy.proxy import (
+    Client, Dialer, Proxy, StopServing, sendv, bind_reuseport)
+from jhsiao.proxy.timerwheel import TimerWheel
 from jhsiao.proxy import http
 
+def _connect(addr, timeout=2):
+    """Connect, retrying while the proxy thread is still binding."""
+    end = time.time() + timeout
+    while 1:
+        try:
+            return sockets.connect(addr)
+        except socket.error:
+            if time.time() > end:
+                raise
+            time.sleep(0.01)
+
+def _port(p, timeout=2):
+    """Wait for a Proxy started with port 0 to bind, return its port."""
+    end = time.time() + timeout
+    while not p.addr[1]:
+        assert time.time() < end
+        time.sleep(0.01)
+    return p.addr[1]
+
 def test_proxy():
     p = Proxy()
     p.start()
@@ -85,5 +112,259 @@ def test_connect():
         l.close()
         p.stop()
 
+def test_parent():
+    parent = Proxy(port=0)
+    parent.start()
+    parentport = _port(parent)
+    p = Proxy(parents=['localhost:{}'.format(parentport)])
+    p.start()
+    l = sockets.bind(('localhost', 0))
+    l.listen(1)
+    l.settimeout(1)
+    port = l.getsockname()[1]
+    sock = _connect(('localhost', p.addr[1]))
+    sock.settimeout(2)
+    s = None
+    try:
+        _connect(('localhost', parentport)).close()
+        sock.sendall(
+            'CONNECT localhost:{} HTTP/1.1\r\n\r\n'.format(port).encode('utf-8'))
+        f = sock.makefile('rb')
+        assert f.readline().split()[1] == b'200'
+        while f.readline() != b'\r\n':
+            pass
+        s, a = l.accept()
+        s.settimeout(1)
+        sock.sendall(b'hello world!')
+        assert s.recv(12) == b'hello world!'
+        assert parent.metrics.tunnels.value == 1
+        assert p.parents.stats()['selected'] == 1
+    finally:
+        if s is not None:
+            s.close()
+        sock.close()
+        l.close()
+        p.stop()
+        parent.stop()
+
+def test_connectrace():
+    p = Proxy()
+    p.poller = polling.Poller()
+    p._timers = TimerWheel(now=time.time())
+    forwarded = []
+    p.forward = lambda client, remote: forwarded.append(remote)
+    l = sockets.bind(('localhost', 0))
+    l.listen(2)
+    port = l.getsockname()[1]
+    info = socket.getaddrinfo(
+        '127.0.0.1', port, socket.AF_INET, socket.SOCK_STREAM)[0]
+    p.resolver.resolve = lambda host, port: [info, info]
+    c, s = socket.socketpair()
+    client = Client(s, '127.0.0.1')
+    try:
+        dialer = Dialer(p, client, 'localhost', port)
+        dialer.start(p)
+        dialer.launch(p)
+        attempts = list(dialer.attempts)
+        assert len(attempts) == 2
+        time.sleep(0.1)
+        r, w, x = p.poller.poll(1)
+        assert sorted(w, key=id) == sorted(attempts, key=id)
+        # the loser is still called after the winner stopped the dial
+        for thing in w:
+            thing(p)
+        assert len(forwarded) == 1 and not dialer.attempts
+        assert [a.sock.fileno() for a in attempts].count(-1) == 1
+        c.settimeout(1)
+        assert c.recv(0x100).startswith(b'HTTP/1.1 200')
+
+        def bad(proxy):
+            raise ValueError('bad pollable')
+        def stop(proxy):
+            raise StopServing()
+        called = []
+        p._dispatch([bad, called.append])
+        assert called == [p]
+        try:
+            p._dispatch([stop])
+        except StopServing:
+            pass
+        else:
+            assert False, 'StopServing should end the loop'
+    finally:
+        for f in forwarded:
+            f.close()
+        c.close()
+        client.close()
+        l.close()
+        p.poller.close()
+
+def test_slowhead():
+    p = Proxy(headertimeout=0.5, numthreads=1)
+    p.start()
+    l = sockets.bind(('localhost', 0))
+    l.listen(1)
+    l.settimeout(1)
+    slow = _connect(('localhost', p.addr[1]))
+    slow.settimeout(2)
+    sock = _connect(('localhost', p.addr[1]))
+    sock.settimeout(1)
+    try:
+        slow.sendall(b'GET http://localhost/ HTTP/1.1\r\nHost: local')
+        # The only handler thread is not stuck on the slow client.
+        sock.sendall('CONNECT localhost:{} HTTP/1.1\r\n\r\n'.format(
+            l.getsockname()[1]).encode('utf-8'))
+        assert sock.recv(100).startswith(b'HTTP/1.1 200')
+        l.accept()[0].close()
+        assert slow.recv(100).startswith(b'HTTP/1.1 408')
+        assert slow.recv(100) == b''
+    finally:
+        slow.close()
+        sock.close()
+        l.close()
+        p.stop()
+
+def test_pipelined():
+    p = Proxy(numthreads=1, idletimeout=0.5)
+    p.start()
+    sock = _connect(('localhost', p.addr[1]))
+    sock.settimeout(2)
+    try:
+        sock.sendall(
+            b'GET /metrics HTTP/1.1\r\n\r\n' * 3
+            + b'GET /metrics HTTP/1.1\r\nHo')
+        sock.sendall(b'st: localhost\r\n\r\n')
+        chunks = []
+        chunk = sock.recv(0x10000)
+        while chunk:
+            chunks.append(chunk)
+            chunk = sock.recv(0x10000)
+        assert b''.join(chunks).count(b'HTTP/1.1 200 OK') == 4
+        assert p.metrics.pipelined.value >= 2
+    finally:
+        sock.close()
+        p.stop()
+
+def test_loops():
+    p = Proxy(numthreads=2, engine='loops')
+    p.start()
+    socks = [_connect(('localhost', p.addr[1])) for _ in range(4)]
+    try:
+        for sock in socks:
+            sock.settimeout(2)
+            sock.sendall(
+                b'GET /metrics HTTP/1.1\r\n\r\n'
+                b'GET /metrics HTTP/1.1\r\nConnection: close\r\n\r\n')
+        for sock in socks:
+            data = b''
+            while data.count(b'HTTP/1.1 200 OK') < 2:
+                chunk = sock.recv(0x10000)
+                assert chunk
+                data += chunk
+        # per ip limits are not multiplied by the number of loops
+        first, second = p._engine.loops
+        assert first.admission is second.admission
+    finally:
+        for sock in socks:
+            sock.close()
+        p.stop()
+
+def test_loopsblocking():
+    p = Proxy(numthreads=1, loopthreads=2, engine='loops', requesttimeout=0.5)
+    # Blocks until the request timeout shuts the socket down.
+    p.do_WAIT = lambda client, startline, headers: (
+        client.r.read(1), p.CLOSE)[1]
+    p.start()
+    waiting = _connect(('localhost', p.addr[1]))
+    sock = _connect(('localhost', p.addr[1]))
+    try:
+        waiting.settimeout(2)
+        sock.settimeout(2)
+        start = time.time()
+        waiting.sendall(b'WAIT / HTTP/1.1\r\n\r\n')
+        time.sleep(0.1)
+        sock.sendall(b'GET /metrics HTTP/1.1\r\nConnection: close\r\n\r\n')
+        assert sock.recv(0x10000).startswith(b'HTTP/1.1 200 OK')
+        assert time.time() - start < 0.5
+        assert waiting.recv(0x10000) == b''
+        assert time.time() - start < 1.5
+    finally:
+        waiting.close()
+        sock.close()
+        p.stop()
+
+def test_gzipcached():
+    p = Proxy(cachemem=1<<20, gzip=True, gzipcpu=1)
+    body = b'hello world ' * 20000
+    store = p.cache.store(
+        'http://a/', {}, 200, 'OK',
+        [('Content-Type', 'text/plain'), ('Cache-Control', 'max-age=60')])
+    store.write(body)
+    entry = store.finish()
+    gz = p._gzipcached(entry)
+    assert gzip.decompress(gz.body) == body
+    assert gz.rawsize == len(body)
+    # Checked before every chunk, nothing is stored when over budget.
+    p.compressor.tokens = -1
+    assert p._gzipcached(entry) is None
+    assert p.compressor.stats()['overbudget'] == 1
+
+def test_sendv():
+    a, b = socket.socketpair()
+    try:
+        parts = [b'HTTP/1.1 200 OK\r\n'] + [
+            'X-{}: {}\r\n'.format(i, 'v'*i).encode('ascii') for i in range(2000)]
+        data = b''.join(parts)
+        b.settimeout(5)
+        out = []
+        t = threading.Thread(target=sendv, args=(a, parts))
+        t.start()
+        total = 0
+        while total < len(data):
+            chunk = b.recv(0x10000)
+            out.append(chunk)
+            total += len(chunk)
+        t.join()
+        assert b''.join(out) == data
+    finally:
+        a.close()
+        b.close()
+
+def test_reuseport():
+    a = bind_reuseport(('127.0.0.1', 0))
+    try:
+        b = bind_reuseport(a.getsockname())
+        b.close()
+    finally:
+        a.close()
+
+def _local(p, resource, ip='127.0.0.1'):
+    startline = http.ParsedStartline(b'GET', resource, (1, 1))
+    response = p.localresponse(startline, ('127.0.0.1', 3128), ip)
+    return response.split(b'\r\n', 1)[0]
+
+def test_debugendpoints():
+    p = Proxy(
+        trace=10, profilemax=0.2, debugendpoints=True,
+        debugallowed=[('10.1.0.0', 16)], profiledir=tempfile.mkdtemp())
+    assert _local(p, b'/debug/trace') == b'HTTP/1.1 200 OK'
+    assert _local(p, b'/debug/trace', '::1') == b'HTTP/1.1 200 OK'
+    assert _local(p, b'/debug/trace', '10.1.2.3') == b'HTTP/1.1 200 OK'
+    assert _local(p, b'/debug/trace', '10.2.0.1') == b'HTTP/1.1 403 Forbidden'
+    assert _local(p, b'/debug/profile', '10.2.0.1') == (
+        b'HTTP/1.1 403 Forbidden')
+    for seconds in (b'x', b'inf', b'nan', b'-1', b'0'):
+        assert _local(p, b'/debug/profile?seconds=' + seconds) == (
+            b'HTTP/1.1 400 Bad Request')
+    assert _local(p, b'/debug/profile?seconds=1e9') == (
+        b'HTTP/1.1 202 Accepted')
+    assert _local(p, b'/debug/profile?seconds=1') == b'HTTP/1.1 409 Conflict'
+    try:
+        p.profiler.t.join(10)
+        assert not p.profiler.running()
+        assert _local(p, b'/debug/profile') == b'HTTP/1.1 200 OK'
+    finally:
+        shutil.rmtree(p.profiler.outdir)
+
 if __name__ == '__main__':
     simple(globals())
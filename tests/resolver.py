@@ -0,0 +1,64 @@
+import socket
+
+from jhsiao.tests import simple
+
+from jhsiao.proxy.proxy import Proxy
+from jhsiao.proxy.resolver import Resolver, interleave
+
+def test_interleave():
+    v6 = [(socket.AF_INET6, 0, 0, '', ('::1', i)) for i in range(3)]
+    v4 = [(socket.AF_INET, 0, 0, '', ('127.0.0.1', i)) for i in range(1)]
+    assert interleave(v6+v4) == [v6[0], v4[0], v6[1], v6[2]]
+    assert interleave(v4+v6) == [v4[0], v6[0], v6[1], v6[2]]
+
+def test_cache():
+    r = Resolver()
+    first = r.resolve('localhost', 80)
+    assert r.resolve('localhost', 80) == first
+    stats = r.stats()
+    assert stats['misses'] == 1
+    assert stats['hits'] == 1
+    try:
+        r.resolve('nonexistent.invalid', 80)
+    except socket.gaierror:
+        pass
+    try:
+        r.resolve('nonexistent.invalid', 80)
+    except socket.gaierror:
+        pass
+    assert r.stats()['negative'] == 1
+
+def test_metrics():
+    p = Proxy()
+    r = p.resolver
+    r.resolve('localhost', 80)
+    r.resolve('localhost', 80)
+    try:
+        r.resolve('nonexistent.invalid', 80)
+    except socket.gaierror:
+        pass
+    lines = p.metrics.render().splitlines()
+    assert 'proxy_dns_lookup_seconds_count 2' in lines
+    assert 'proxy_dns_cache_hits_total 1' in lines
+    assert 'proxy_dns_cache_misses_total 2' in lines
+    assert 'proxy_dns_failures_total 1' in lines
+    assert 'proxy_dns_cache_evicted_total 0' in lines
+
+def test_connect():
+    l = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    l.bind(('127.0.0.1', 0))
+    l.listen(1)
+    try:
+        r = Resolver()
+        s = r.connect('127.0.0.1', l.getsockname()[1], 1)
+        try:
+            assert s.gettimeout() == 1
+            c, _ = l.accept()
+            c.close()
+        finally:
+            s.close()
+    finally:
+        l.close()
+
+if __name__ == '__main__':
+    simple(globals())
@@ -0,0 +1,33 @@
+from jhsiao.proxy.slabs import SlabPool
+
+def test_budget():
+    pool = SlabPool(budget=0x400, slabsize=0x100)
+    slabs = pool.acquire(3)
+    assert [len(slab) for slab in slabs] == [0x100] * 3
+    assert len(pool.acquire(2)) == 1
+    assert pool.inuse == 0x400
+    woken = []
+    assert pool.acquire(1, lambda: woken.append(1)) == []
+    assert pool.reserve() == 0
+    pool.release(slabs[:1])
+    assert woken == [1]
+    assert pool.reserve(2) == 1
+    assert pool.acquire() == []
+    pool.release(reserved=1)
+    assert len(pool.acquire()) == 1
+    assert pool.stats()['peak'] == 0x400
+
+def test_reuse():
+    pool = SlabPool(slabsize=0x100, maxfree=0x100)
+    a, b = pool.acquire(2)
+    pool.release([a, b])
+    assert pool.free == [a]
+    assert pool.acquire() == [a]
+    assert pool.inuse == 0x100
+    assert pool.reserve(2) == 2
+    assert len(pool.fill(2)) == 2
+    assert pool.inuse == 0x300
+
+if __name__ == '__main__':
+    from jhsiao.tests import simple
+    simple(globals())
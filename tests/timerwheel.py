@@ -0,0 +1,39 @@
+from jhsiao.tests import simple
+
+from jhsiao.proxy.timerwheel import TimerWheel
+
+def test_expire():
+    wheel = TimerWheel(tick=0.1, slots=8, now=0)
+    wheel.schedule(0.35, 'b', 0)
+    wheel.schedule(0.25, 'a', 0)
+    wheel.schedule(2, 'c', 0)
+    assert len(wheel) == 3
+    assert abs(wheel.timeout(0) - 0.3) < 1e-9
+    assert wheel.expire(0.29) == []
+    assert wheel.expire(0.4) == ['a', 'b']
+    # c is more than a rotation away.
+    assert wheel.expire(1.5) == []
+    assert wheel.expire(2.05) == ['c']
+    assert len(wheel) == 0
+    assert wheel.timeout(2.05) is None
+
+def test_cancel():
+    wheel = TimerWheel(tick=0.1, slots=8, now=0)
+    a = wheel.schedule(0.1, 'a', 0)
+    wheel.schedule(0.1, 'b', 0)
+    wheel.cancel(a)
+    wheel.cancel(a)
+    wheel.cancel(None)
+    assert len(wheel) == 1
+    assert wheel.expire(10) == ['b']
+    wheel.cancel(a)
+    assert len(wheel) == 0
+
+def test_past():
+    wheel = TimerWheel(tick=0.1, slots=8, now=5)
+    wheel.schedule(-1, 'a', 5)
+    assert wheel.expire(5.05) == []
+    assert wheel.expire(5.2) == ['a']
+
+if __name__ == '__main__':
+    simple(globals())
@@ -0,0 +1,35 @@
+import io
+import json
+import threading
+
+from jhsiao.tests import simple
+
+from jhsiao.proxy.tracing import Tracer
+
+def test_events():
+    tracer = Tracer(maxspans=2)
+    tracer.span('a', 1, 2)
+    tracer.span('b', 2, 2.5, 'request', url='/x')
+    t = threading.Thread(target=tracer.span, args=('c', 3, 4), name='other')
+    t.start()
+    t.join()
+    assert tracer.stats() == dict(spans=2, maxspans=2)
+    events = tracer.events()
+    spans = [e for e in events if e['ph'] == 'X']
+    assert [e['name'] for e in spans] == ['b', 'c']
+    assert spans[0]['ts'] == 2e6 and spans[0]['dur'] == 0.5e6
+    assert spans[0]['args'] == {'url': '/x'}
+    assert spans[0]['tid'] != spans[1]['tid']
+    names = dict([(e['tid'], e['args']['name']) for e in events if e['ph'] == 'M'])
+    assert names[spans[0]['tid']] == threading.current_thread().name
+
+def test_dump():
+    tracer = Tracer()
+    tracer.span('a', 1, 2, 'queue', client='x')
+    f = io.StringIO()
+    tracer.dump(f)
+    data = json.loads(f.getvalue())
+    assert data['traceEvents'][0]['cat'] == 'queue'
+
+if __name__ == '__main__':
+    simple(globals())
@@ -0,0 +1,69 @@
+import socketserver
+import threading
+import time
+
+from jhsiao.tests import simple
+
+from jhsiao.proxy.proxy import Proxy
+from jhsiao.proxy.upstream import UpstreamPool
+
+class _OK(socketserver.StreamRequestHandler):
+    """Answer every request on a connection with ok."""
+    def handle(self):
+        line = self.rfile.readline()
+        while line:
+            while line.strip():
+                line = self.rfile.readline()
+            self.wfile.write(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok')
+            line = self.rfile.readline()
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+def test_reuse():
+    server = _Server(('127.0.0.1', 0), _OK)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    pool = UpstreamPool(maxperhost=2)
+    url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    try:
+        for _ in range(3):
+            r = pool.get(url)
+            assert r.status_code == 200 and r.content == b'ok'
+        stats = pool.stats()
+        assert stats['misses'] == 1 and stats['hits'] == 2
+        assert stats['hosts'] == 1
+        p = Proxy()
+        p.pool = pool
+        lines = p.metrics.render().splitlines()
+        assert 'proxy_upstream_pool_hits_total 2' in lines
+        assert 'proxy_upstream_pool_misses_total 1' in lines
+        assert 'proxy_upstream_pool_evicted_total 0' in lines
+    finally:
+        pool.close()
+        server.shutdown()
+        server.server_close()
+
+def test_expired():
+    server = _Server(('127.0.0.1', 0), _OK)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    pool = UpstreamPool(idle=None, lifetime=0.05)
+    url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    try:
+        assert pool.get(url).content == b'ok'
+        time.sleep(0.1)
+        assert pool.get(url).content == b'ok'
+        stats = pool.stats()
+        assert stats['misses'] == 2 and stats['hits'] == 0
+        # the sweep may also have closed the second connection
+        assert stats['evicted'] >= 1
+    finally:
+        pool.close()
+        server.shutdown()
+        server.server_close()
+
+if __name__ == '__main__':
+    simple(globals())